@@ -6,12 +6,25 @@ from datetime import datetime, date, timedelta, timezone
 import time
 import os
 import hashlib
+import hmac
 import smtplib
 from email.mime.text import MIMEText
 import random
 import string
 import re
 import requests
+import plotly.express as px
+import json
+import io
+import copy
+import bisect
+import unicodedata
+import threading
+import sqlite3
+import uuid
+import numpy as np
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 頁面設定 ---
 st.set_page_config(page_title="我的記帳本 Pro", layout="wide", page_icon="💰")
@@ -21,6 +34,7 @@ st.set_page_config(page_title="我的記帳本 Pro", layout="wide", page_icon="
 # ==========================================
 TEMPLATE_URL = "https://docs.google.com/spreadsheets/d/1j7WM4A6bgRr1S-0BvHYPw9Xp5oXs0Ikp969-Ys65JL0/copy" 
 TRIAL_DAYS = 30 
+LOCAL_DATA_DIR = ".ledger_data"  # 本機資料 (SQLite 鏡像、寫入佇列、郵件 outbox)
 
 # ==========================================
 # 0. UI 美化
@@ -89,6 +103,331 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ==========================================
+# [新增] Sheets API 監控 (呼叫次數 / 延遲 / 資料量 / 429 / 快取命中)
+# ==========================================
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+METRICS_MAX_SESSIONS = 200
+METRICS_RECENT_ERRORS = 50
+METRICS_WRITE_METHODS = {"append_row", "append_rows", "update", "update_cell", "update_cells", "batch_update"}
+
+def _payload_cells(value):
+    """回應或寫入內容的儲存格數 (list of list、values_batch_get 回應、batch_update 的範圍清單)"""
+    if isinstance(value, dict):
+        if "valueRanges" in value: return sum(_payload_cells(vr.get("values", [])) for vr in value["valueRanges"])
+        return _payload_cells(value["values"]) if "values" in value else len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_payload_cells(v) if isinstance(v, (list, tuple, dict)) else int(isinstance(v, (str, int, float))) for v in value)
+    return 0
+
+METRICS_REDACT_RE = re.compile(r"https?://[^\s'\"]+|[\w.+-]+@[\w-]+\.[\w.-]+")
+
+def _prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class SheetsMetrics:
+    """跨 Session 共用的統計；Session 由每次執行腳本時綁定在執行緒上，背景執行緒 (預載、寫入佇列) 記在 background"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.salt = uuid.uuid4().hex  # 匯出時雜湊帳本網址 / Email 用，每次啟動不同
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.calls = {}  # (帳本, 方法) -> {"count", "errors", "throttled", "seconds", "cells", "buckets"}
+            self.cache = Counter()  # (帳本, "hit" / "miss")
+            self.sessions = {}  # session -> {"user", "calls", "seconds", "hits", "misses", "seen"}
+            self.recent_errors = deque(maxlen=METRICS_RECENT_ERRORS)
+
+    def bind_session(self, session_id, user=""):
+        self.local.session = session_id
+        with self.lock:
+            stats = self._session(session_id)
+            if user: stats["user"] = user
+
+    def current_session(self):
+        return getattr(self.local, "session", "background")
+
+    def _session(self, session_id):
+        stats = self.sessions.get(session_id)
+        if stats is None:
+            if len(self.sessions) >= METRICS_MAX_SESSIONS:
+                del self.sessions[min(self.sessions, key=lambda s: self.sessions[s]["seen"])]
+            stats = self.sessions[session_id] = {"user": "", "calls": 0, "seconds": 0.0, "hits": 0, "misses": 0, "seen": time.time()}
+        stats["seen"] = time.time()
+        return stats
+
+    def record_call(self, book, method, seconds, cells, error=None):
+        with self.lock:
+            stats = self.calls.get((book, method))
+            if stats is None:
+                stats = self.calls[(book, method)] = {"count": 0, "errors": 0, "throttled": 0, "seconds": 0.0, "cells": 0, "buckets": [0] * len(METRICS_LATENCY_BUCKETS)}
+            stats["count"] += 1; stats["seconds"] += seconds; stats["cells"] += cells
+            stats["buckets"][next(i for i, b in enumerate(METRICS_LATENCY_BUCKETS) if seconds <= b)] += 1
+            session = self._session(self.current_session())
+            session["calls"] += 1; session["seconds"] += seconds
+            if error is not None:
+                stats["errors"] += 1
+                if api_status(error) == 429: stats["throttled"] += 1
+                self._append_error(book, method, error)
+
+    def record_error(self, book, method, error):
+        """背景佇列 (寫入佇列、本機 outbox、郵件) 的失敗也記在最近錯誤，診斷面板看得到"""
+        with self.lock: self._append_error(book, method, error)
+
+    def _append_error(self, book, method, error):
+        self.recent_errors.append({"at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "book": book, "method": method,
+                                   "status": api_status(error) or type(error).__name__, "message": str(error)[:200]})
+
+    def record_cache(self, book, hit):
+        with self.lock:
+            self.cache[(book, "hit" if hit else "miss")] += 1
+            self._session(self.current_session())["hits" if hit else "misses"] += 1
+
+    def timed(self, book, method, fn, args, kwargs):
+        started = time.perf_counter()
+        try: result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record_call(book, method, time.perf_counter() - started, 0, e)
+            raise
+        if method not in METRICS_WRITE_METHODS: sent = 0
+        # update_cell(列, 欄, 值) 的第一個參數是列號，固定寫一格
+        elif method == "update_cell": sent = 1
+        else: sent = _payload_cells(kwargs.get("values", args[0] if args else None))
+        self.record_call(book, method, time.perf_counter() - started, sent + (0 if method in METRICS_WRITE_METHODS else _payload_cells(result)))
+        return result
+
+    @staticmethod
+    def _quantile(buckets, q):
+        """由直方圖估計分位數 (回傳所在區間的上界)"""
+        total = sum(buckets)
+        if total == 0: return 0.0
+        running = 0
+        for bound, n in zip(METRICS_LATENCY_BUCKETS, buckets):
+            running += n
+            if running >= q * total: return bound
+        return METRICS_LATENCY_BUCKETS[-1]
+
+    def _redact(self, value):
+        """帳本網址 / Email -> 短雜湊 (同一個值對應同一個代號，仍可分組比對)"""
+        value = str(value)
+        if value in ("", "client", "background"): return value
+        return "h:" + hashlib.sha256((self.salt + value).encode("utf-8")).hexdigest()[:10]
+
+    def snapshot(self, redact=False):
+        """redact=True 時帳本改成雜湊、拿掉 Session 的使用者、錯誤訊息中的網址與 Email 也換成雜湊 (匯出用)"""
+        with self.lock:
+            calls = [{"book": book, "method": method, "count": s["count"], "errors": s["errors"], "throttled": s["throttled"],
+                      "avg_ms": round(s["seconds"] / s["count"] * 1000, 1) if s["count"] else 0.0,
+                      "p95_ms": self._quantile(s["buckets"], 0.95) * 1000, "cells": s["cells"], "seconds": round(s["seconds"], 3),
+                      "buckets": dict(zip(["+Inf" if b == float("inf") else str(b) for b in METRICS_LATENCY_BUCKETS], s["buckets"]))}
+                     for (book, method), s in sorted(self.calls.items())]
+            books = sorted({book for book, _ in self.cache})
+            cache = [{"book": book, "hits": self.cache[(book, "hit")], "misses": self.cache[(book, "miss")]} for book in books]
+            sessions = [dict(stats, session=sid, seconds=round(stats["seconds"], 3)) for sid, stats in self.sessions.items()]
+            errors = [dict(e) for e in self.recent_errors]
+        if redact:
+            for row in calls + cache + errors: row["book"] = self._redact(row["book"])
+            for row in sessions: row.pop("user", None)
+            for row in errors: row["message"] = METRICS_REDACT_RE.sub(lambda m: self._redact(m.group(0)), row["message"])
+        snap = {"started_at": self.started_at, "generated_at": time.time(), "calls": calls, "cache": cache,
+                "sessions": sessions, "recent_errors": errors}
+        snap["scheduler"] = get_sheets_scheduler().snapshot()
+        return snap
+
+    def to_json(self):
+        return json.dumps(self.snapshot(redact=True), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format (帳本以雜湊代號標示)"""
+        snap = self.snapshot(redact=True)
+        lines = ["# HELP ledger_sheets_requests_total Google Sheets API calls.", "# TYPE ledger_sheets_requests_total counter"]
+        lines += [f'ledger_sheets_requests_total{{book="{_prom_label(c["book"])}",method="{c["method"]}"}} {c["count"]}' for c in snap["calls"]]
+        lines += ["# HELP ledger_sheets_errors_total Failed Google Sheets API calls.", "# TYPE ledger_sheets_errors_total counter"]
+        lines += [f'ledger_sheets_errors_total{{book="{_prom_label(c["book"])}",method="{c["method"]}"}} {c["errors"]}' for c in snap["calls"]]
+        lines += ["# HELP ledger_sheets_throttled_total Calls rejected with HTTP 429.", "# TYPE ledger_sheets_throttled_total counter"]
+        lines += [f'ledger_sheets_throttled_total{{book="{_prom_label(c["book"])}",method="{c["method"]}"}} {c["throttled"]}' for c in snap["calls"]]
+        lines += ["# HELP ledger_sheets_payload_cells_total Cells sent or received.", "# TYPE ledger_sheets_payload_cells_total counter"]
+        lines += [f'ledger_sheets_payload_cells_total{{book="{_prom_label(c["book"])}",method="{c["method"]}"}} {c["cells"]}' for c in snap["calls"]]
+        lines += ["# HELP ledger_sheets_request_seconds Google Sheets API latency.", "# TYPE ledger_sheets_request_seconds histogram"]
+        for c in snap["calls"]:
+            labels = f'book="{_prom_label(c["book"])}",method="{c["method"]}"'
+            running = 0
+            for le, n in c["buckets"].items():
+                running += n
+                lines.append(f'ledger_sheets_request_seconds_bucket{{{labels},le="{le}"}} {running}')
+            lines.append(f"ledger_sheets_request_seconds_sum{{{labels}}} {c['seconds']}")
+            lines.append(f"ledger_sheets_request_seconds_count{{{labels}}} {c['count']}")
+        lines += ["# HELP ledger_cache_requests_total Book cache lookups.", "# TYPE ledger_cache_requests_total counter"]
+        for c in snap["cache"]:
+            lines.append(f'ledger_cache_requests_total{{book="{_prom_label(c["book"])}",result="hit"}} {c["hits"]}')
+            lines.append(f'ledger_cache_requests_total{{book="{_prom_label(c["book"])}",result="miss"}} {c["misses"]}')
+        lines += ["# HELP ledger_session_requests_total Google Sheets API calls per session.", "# TYPE ledger_session_requests_total counter"]
+        lines += [f'ledger_session_requests_total{{session="{_prom_label(s["session"])}"}} {s["calls"]}' for s in snap["sessions"]]
+        lines += ["# HELP ledger_scheduler_stat Request scheduler counters and token bucket state.", "# TYPE ledger_scheduler_stat gauge"]
+        lines += [f'ledger_scheduler_stat{{name="{k}"}} {v}' for k, v in sorted(snap["scheduler"].items())]
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_sheets_metrics():
+    return SheetsMetrics()
+
+# ==========================================
+# [新增] Sheets 請求排程 (配額 token bucket / 退避重試 / 合併相同讀取 / 優先順序)
+# ==========================================
+# Sheets API 每位使用者 (所有 Session 共用同一個服務帳戶) 每分鐘的讀取 / 寫入配額，可在 secrets 調整
+SCHEDULER_READ_PER_MINUTE = 60
+SCHEDULER_WRITE_PER_MINUTE = 60
+SCHEDULER_MAX_RETRIES = 5
+SCHEDULER_BACKOFF_BASE = 1.0
+SCHEDULER_BACKOFF_CAP = 32.0
+SCHEDULER_READ_METHODS = {"open", "open_by_url", "worksheet", "worksheets", "get", "get_all_values", "get_all_records", "batch_get", "values_batch_get", "row_values", "col_values", "cell", "find", "findall"}
+SCHEDULER_READ_RETRY_STATUSES = {429, 500, 502, 503, 504}
+SCHEDULER_WRITE_RETRY_STATUSES = {429}  # 寫入遇到 5xx 可能已經寫進去，不自動重試以免重複
+# 同時等待配額時數字小的先拿：使用者操作的寫入 > 使用者操作的讀取 > 背景寫入 > 背景讀取 (預載、同步)
+PRIORITY_INTERACTIVE_WRITE = 0
+PRIORITY_INTERACTIVE_READ = 1
+PRIORITY_BACKGROUND_WRITE = 2
+PRIORITY_BACKGROUND_READ = 3
+
+class TokenBucket:
+    """每分鐘 per_minute 個請求，最多累積一分鐘的額度"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = Counter()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority):
+        """拿到一個額度才返回，回傳等待的秒數；有更高優先的請求在等就先讓它"""
+        started = time.monotonic()
+        with self.cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1 and not any(n for p, n in self.waiting.items() if p < priority):
+                        self.tokens -= 1
+                        return time.monotonic() - started
+                    self.cond.wait(max((1 - self.tokens) / self.rate, 0.05))
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+
+    def penalize(self):
+        """收到 429：目前累積的額度作廢，之後的請求一起放慢"""
+        with self.cond:
+            self._refill(); self.tokens = min(self.tokens, 0.0)
+
+def _share_result(result):
+    """合併的讀取每個呼叫端各拿一份，避免互相修改到同一個 list"""
+    if isinstance(result, list): return [r.copy() if isinstance(r, (list, dict)) else r for r in result]
+    if isinstance(result, dict): return copy.deepcopy(result)
+    return result
+
+class SheetsScheduler:
+    """所有 gspread 呼叫的共同入口 (跨 Session 共用)"""
+
+    def __init__(self, read_per_minute=SCHEDULER_READ_PER_MINUTE, write_per_minute=SCHEDULER_WRITE_PER_MINUTE):
+        self.buckets = {"read": TokenBucket(read_per_minute), "write": TokenBucket(write_per_minute)}
+        self.lock = threading.Lock()
+        self.inflight = {}  # 讀取的 key -> {"event", "result", "error", "followers"}
+        self.stats = Counter()
+
+    def call(self, target, method, fn, args, kwargs):
+        is_read = method in SCHEDULER_READ_METHODS
+        background = get_sheets_metrics().current_session() == "background"
+        if is_read: priority = PRIORITY_BACKGROUND_READ if background else PRIORITY_INTERACTIVE_READ
+        else: priority = PRIORITY_BACKGROUND_WRITE if background else PRIORITY_INTERACTIVE_WRITE
+        if not is_read: return self._execute("write", priority, fn, SCHEDULER_WRITE_RETRY_STATUSES)
+
+        # 相同物件、相同參數的讀取正在進行中就等它的結果，不再送出一次
+        key = (id(target), method, repr(args), repr(sorted(kwargs.items())))
+        with self.lock:
+            slot = self.inflight.get(key)
+            leader = slot is None
+            if leader: slot = self.inflight[key] = {"event": threading.Event(), "result": None, "error": None, "followers": 0}
+            else: slot["followers"] += 1; self.stats["coalesced"] += 1
+        if not leader:
+            slot["event"].wait()
+            if slot["error"] is not None: raise slot["error"]
+            return _share_result(slot["result"])
+        try: slot["result"] = self._execute("read", priority, fn, SCHEDULER_READ_RETRY_STATUSES)
+        except Exception as e:
+            slot["error"] = e
+            raise
+        finally:
+            with self.lock: self.inflight.pop(key, None)
+            slot["event"].set()
+        return _share_result(slot["result"]) if slot["followers"] else slot["result"]
+
+    def _execute(self, kind, priority, fn, retry_statuses):
+        """配額不足就排隊；可重試的錯誤以指數退避 + 隨機抖動重送"""
+        for attempt in range(SCHEDULER_MAX_RETRIES + 1):
+            waited = self.buckets[kind].acquire(priority)
+            with self.lock:
+                self.stats[kind] += 1; self.stats["wait_seconds"] += waited
+            try: return fn()
+            except gspread.exceptions.APIError as e:
+                if api_status(e) not in retry_statuses or attempt == SCHEDULER_MAX_RETRIES: raise
+                if api_status(e) == 429: self.buckets[kind].penalize()
+                with self.lock: self.stats["retries"] += 1
+                time.sleep(random.uniform(0, min(SCHEDULER_BACKOFF_CAP, SCHEDULER_BACKOFF_BASE * 2 ** attempt)))
+
+    def snapshot(self):
+        with self.lock: stats = dict(self.stats)
+        for kind, bucket in self.buckets.items():
+            with bucket.cond:
+                bucket._refill()
+                stats[f"{kind}_tokens"] = round(bucket.tokens, 2); stats[f"{kind}_waiting"] = sum(bucket.waiting.values())
+        stats["wait_seconds"] = round(stats.get("wait_seconds", 0.0), 3)
+        return stats
+
+@st.cache_resource
+def get_sheets_scheduler():
+    return SheetsScheduler(int(st.secrets.get("sheets_read_per_minute", SCHEDULER_READ_PER_MINUTE)),
+                           int(st.secrets.get("sheets_write_per_minute", SCHEDULER_WRITE_PER_MINUTE)))
+
+class InstrumentedGspread:
+    """gspread Client / Spreadsheet / Worksheet 的代理：公開方法都經過 SheetsScheduler 排程、SheetsMetrics 計時，
+    回傳的 Spreadsheet / Worksheet 也一併包起來；book 為 None 表示 Client 本身 (以開啟的來源當作帳本)"""
+
+    def __init__(self, target, book=None):
+        self._target = target
+        self._book = book
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr): return attr
+        def call(*args, **kwargs):
+            book = self._book if self._book is not None else (str(args[0]) if args else "client")
+            metrics = get_sheets_metrics()
+            result = get_sheets_scheduler().call(self._target, name, lambda: metrics.timed(book, name, attr, args, kwargs), args, kwargs)
+            return _wrap_gspread(result, book)
+        return call
+
+    def __repr__(self):
+        return f"Instrumented({self._target!r})"
+
+def _wrap_gspread(result, book):
+    if isinstance(result, (gspread.Spreadsheet, gspread.Worksheet)): return InstrumentedGspread(result, book)
+    if isinstance(result, list) and result and all(isinstance(r, gspread.Worksheet) for r in result): return [InstrumentedGspread(r, book) for r in result]
+    return result
+
+if "metrics_session" not in st.session_state: st.session_state["metrics_session"] = uuid.uuid4().hex[:8]
+get_sheets_metrics().bind_session(st.session_state["metrics_session"], st.session_state.get("user_info", {}).get("Email", ""))
+
 # ==========================================
 # 1. 核心連線與工具函式
 # ==========================================
@@ -110,17 +449,85 @@ def get_gspread_client():
             creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", scope)
         except FileNotFoundError:
             return None
-    return gspread.authorize(creds)
+    return InstrumentedGspread(gspread.authorize(creds))
 
 def open_spreadsheet(client, source_str):
     if source_str.startswith("http"): return client.open_by_url(source_str)
     else: return client.open(source_str)
 
+# --- [新增] Spreadsheet / Worksheet 物件快取 (省下每次 open + worksheet() 的 metadata 請求) ---
+@st.cache_resource
+def get_handle_cache():
+    """跨 Session 共用：books = {來源: Spreadsheet}, sheets = {(來源, 分頁): Worksheet}, listings = {來源: (時間, [Worksheet])}"""
+    return {"lock": threading.Lock(), "books": {}, "sheets": {}, "listings": {}}
+
+def get_spreadsheet(source_str):
+    cache = get_handle_cache()
+    with cache["lock"]: sh = cache["books"].get(source_str)
+    if sh is None:
+        sh = open_spreadsheet(get_gspread_client(), source_str)
+        with cache["lock"]: cache["books"][source_str] = sh
+    return sh
+
+def get_worksheet(source_str, title, create_header=None):
+    """取得分頁物件；分頁不存在時若有給 create_header 就自動建立"""
+    cache = get_handle_cache()
+    key = (source_str, title)
+    with cache["lock"]: ws = cache["sheets"].get(key)
+    if ws is None:
+        sheet = get_spreadsheet(source_str)
+        try: ws = sheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            if create_header is None: raise
+            ws = sheet.add_worksheet(title, 1000, len(create_header)); ws.append_row(create_header)
+            with cache["lock"]: cache["listings"].pop(source_str, None)
+        with cache["lock"]: cache["sheets"][key] = ws
+    return ws
+
+WORKSHEET_LIST_SECONDS = 300
+
+def list_worksheets(source_str):
+    """sheet.worksheets() 的結果短暫快取 (交易分頁與封存年度都從這裡找，不必各自查一次 metadata)"""
+    cache = get_handle_cache()
+    with cache["lock"]: listing = cache["listings"].get(source_str)
+    if listing is None or time.time() - listing[0] > WORKSHEET_LIST_SECONDS:
+        listing = (time.time(), get_spreadsheet(source_str).worksheets())
+        remember_worksheets(source_str, listing[1])
+        with cache["lock"]: cache["listings"][source_str] = listing
+    return list(listing[1])
+
+def remember_worksheets(source_str, worksheets):
+    """sheet.worksheets() 已經拿到的分頁物件順便放進快取"""
+    cache = get_handle_cache()
+    with cache["lock"]:
+        for ws in worksheets: cache["sheets"][(source_str, ws.title)] = ws
+
+def invalidate_handles(source_str, title=None):
+    cache = get_handle_cache()
+    with cache["lock"]:
+        if title is None: cache["books"].pop(source_str, None)
+        cache["listings"].pop(source_str, None)
+        for key in list(cache["sheets"].keys()):
+            if key[0] == source_str and (title is None or key[1] == title): del cache["sheets"][key]
+
+def api_status(e):
+    """gspread APIError 的 HTTP 狀態碼"""
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def with_worksheet(source_str, title, fn, create_header=None):
+    """用快取的分頁物件執行 fn(ws)；分頁被刪除或改名導致失敗時丟掉快取重試一次"""
+    try: return fn(get_worksheet(source_str, title, create_header))
+    except (gspread.exceptions.WorksheetNotFound, gspread.exceptions.APIError) as e:
+        # 只有「找不到分頁 / 範圍無效」才是快取過期；配額或伺服器錯誤直接往上拋
+        if isinstance(e, gspread.exceptions.APIError) and api_status(e) not in (400, 404): raise
+        invalidate_handles(source_str, title)
+        return fn(get_worksheet(source_str, title, create_header))
+
+def admin_worksheet(title, create_header=None):
+    return get_worksheet(st.secrets["admin_sheet_url"], title, create_header)
+
 def get_sheet_title_safe(source_str):
-    client = get_gspread_client()
-    try:
-        sh = open_spreadsheet(client, source_str)
-        return sh.title
+    try: return get_spreadsheet(source_str).title
     except: return "我的記帳本"
 
 def hash_password(password):
@@ -138,21 +545,353 @@ def mask_email(email):
         return f"{name[:3]}***@{domain}"
     except: return "******"
 
+def _trim_row(row):
+    row = ["" if v is None else str(v) for v in row]
+    while row and row[-1] == "": row.pop()
+    return row
+
+def _pad_row(row, width):
+    row = list(row)[:width]
+    return row + [""] * (width - len(row))
+
+# ==========================================
+# [新增] 背景寫入佇列 (Write-Behind)
+# ==========================================
+# 新交易先寫進本機 spool 檔並立即更新畫面，由背景執行緒合併成一次 append_rows 送到 Google Sheets
+WRITE_SPOOL_PATH = os.path.join(LOCAL_DATA_DIR, "write_spool.json")
+WRITE_MAX_ATTEMPTS = 10  # 同一個 (帳本, 分頁) 連續失敗這麼多次就移到 dead letter，不再重試
+
+class WriteBehindQueue:
+    """待寫入的列會持久化到 spool 檔，程式重啟後仍會繼續補送
+    依 (帳本, 分頁) 分組送出，失敗只影響自己那一組 (各自退避)，重試 max_attempts 次仍失敗就移到 dead letter 檔"""
+
+    def __init__(self, spool_path, writer, batch_window=0.5, max_backoff=60, flush_rows=None, max_attempts=WRITE_MAX_ATTEMPTS):
+        self.spool_path = spool_path
+        self.dead_path = os.path.splitext(spool_path)[0] + "_dead.json"
+        self.writer = writer  # writer(source_str, worksheet_name, rows)
+        self.batch_window = batch_window
+        self.max_backoff = max_backoff
+        self.flush_rows = flush_rows or float("inf")  # 累積到這麼多筆就不等 batch_window，直接送出
+        self.max_attempts = max_attempts
+        self.cond = threading.Condition()
+        self.groups = {}  # (帳本, 分頁) -> {"failures", "last_error", "retry_at"}
+        self.inflight = set()  # 正在送出的 id：pending_rows 不再回傳，避免和已寫入 Sheets 的資料重複計算
+        self.items = self._load(self.spool_path)
+        self.dead = self._load(self.dead_path)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _load(self, path):
+        try:
+            with open(path, encoding="utf-8") as f: return json.load(f)
+        except (FileNotFoundError, ValueError): return []
+
+    def _save(self, path=None, items=None):
+        path = path or self.spool_path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(self.items if items is None else items, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def enqueue(self, source_str, worksheet_name, row):
+        with self.cond:
+            self.items.append({"id": uuid.uuid4().hex, "source": source_str, "worksheet": worksheet_name, "row": row, "queued_at": time.time()})
+            self._save()
+            self.cond.notify()
+
+    def pending_count(self, source_str=None):
+        with self.cond: return sum(1 for it in self.items if source_str is None or it["source"] == source_str)
+
+    def pending_rows(self, source_str, worksheet_name):
+        with self.cond: return [list(it["row"]) for it in self.items if it["source"] == source_str and it["worksheet"] == worksheet_name and it["id"] not in self.inflight]
+
+    def last_error(self, source_str):
+        """該帳本最近一次的同步錯誤 (只看自己的帳本)"""
+        with self.cond: return next((g["last_error"] for (src, _), g in self.groups.items() if src == source_str and g["last_error"]), None)
+
+    def dead_count(self, source_str=None):
+        with self.cond: return sum(1 for it in self.dead if source_str is None or it["source"] == source_str)
+
+    def dead_items(self, source_str):
+        """該帳本停止重試的列 (給畫面顯示 / 下載)"""
+        with self.cond: return [dict(it) for it in self.dead if it["source"] == source_str]
+
+    def retry_dead(self, source_str):
+        """把該帳本的 dead letter 放回佇列重新送出 (例如恢復帳本權限之後)；回傳筆數"""
+        with self.cond:
+            back = [it for it in self.dead if it["source"] == source_str]
+            if not back: return 0
+            self.dead = [it for it in self.dead if it["source"] != source_str]
+            self.items.extend({k: v for k, v in it.items() if k != "error"} for it in back)
+            for key in {(it["source"], it["worksheet"]) for it in back}: self.groups.pop(key, None)
+            self._save(self.dead_path, self.dead); self._save()
+            self.cond.notify()
+        return len(back)
+
+    def _retry_at(self, it):
+        return self.groups.get((it["source"], it["worksheet"]), {}).get("retry_at", 0)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                # 只有退避中的分組時，等到最早可以重試的時間 (有新資料會被 notify 叫醒)
+                while True:
+                    waits = [self._retry_at(it) - time.time() for it in self.items]
+                    if waits and min(waits) <= 0: break
+                    self.cond.wait(min(waits) if waits else None)
+                # 等一小段時間，讓連續輸入的幾筆合併成同一批
+                deadline = time.time() + self.batch_window
+                while len(self.items) < self.flush_rows and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+            self.flush()
+
+    def flush(self):
+        """送出所有不在退避中的分組；回傳是否全部成功"""
+        groups = {}
+        with self.cond:
+            now = time.time()
+            for it in self.items:
+                if self._retry_at(it) <= now: groups.setdefault((it["source"], it["worksheet"]), []).append(it)
+            # 送出前先標記，讀取端不會同時從 Sheets 與 pending_rows 拿到同一筆
+            self.inflight.update(it["id"] for items in groups.values() for it in items)
+        ok = True
+        for (source_str, worksheet_name), items in groups.items():
+            ids = {it["id"] for it in items}
+            try: self.writer(source_str, worksheet_name, [it["row"] for it in items])
+            except Exception as e:
+                ok = False
+                get_sheets_metrics().record_error(source_str, f"write_queue:{worksheet_name}", e)
+                with self.cond:
+                    self.inflight -= ids
+                    group = self.groups.setdefault((source_str, worksheet_name), {"failures": 0})
+                    group["failures"] += 1; group["last_error"] = str(e)
+                    group["retry_at"] = time.time() + min(self.max_backoff, 2 ** group["failures"])
+                    if group["failures"] >= self.max_attempts:
+                        # 帳本被刪除 / 權限被收回之類的錯誤重試也沒用，移出佇列保留在 dead letter 檔
+                        self.dead.extend(dict(it, error=str(e)) for it in items)
+                        self.items = [it for it in self.items if it["id"] not in ids]
+                        self._save(self.dead_path, self.dead); self._save()
+                        del self.groups[(source_str, worksheet_name)]
+                continue
+            with self.cond:
+                self.items = [it for it in self.items if it["id"] not in ids]
+                self.inflight -= ids
+                self.groups.pop((source_str, worksheet_name), None)
+                self._save()
+        return ok
+
+@st.cache_resource
+def get_write_queue():
+    return WriteBehindQueue(WRITE_SPOOL_PATH, lambda source_str, worksheet_name, rows: get_storage_backend().append_rows(source_str, worksheet_name, rows))
+
+# --- [新增] 操作紀錄 (System_Logs) 也走寫入佇列：不佔用使用者操作的時間，定時或累積一定筆數才批次寫入 ---
+AUDIT_SPOOL_PATH = os.path.join(LOCAL_DATA_DIR, "audit_spool.json")
+AUDIT_FLUSH_SECONDS = 5
+AUDIT_FLUSH_ROWS = 50
+SYSTEM_LOG_COLUMNS = ["Timestamp", "Operator", "Action", "Target_Email", "Book_Name", "Sheet_URL"]
+
+def _append_system_logs(source_str, worksheet_name, rows):
+    with_worksheet(source_str, worksheet_name, lambda ws: ws.append_rows(rows), create_header=SYSTEM_LOG_COLUMNS)
+
+@st.cache_resource
+def get_audit_log_queue():
+    return WriteBehindQueue(AUDIT_SPOOL_PATH, _append_system_logs, batch_window=AUDIT_FLUSH_SECONDS, flush_rows=AUDIT_FLUSH_ROWS)
+
+# ==========================================
+# [新增] 郵件外寄佇列 (背景寄送 + 共用 SMTP 連線 + 持久化 outbox)
+# ==========================================
+MAIL_OUTBOX_PATH = os.path.join(LOCAL_DATA_DIR, "mail_outbox.json")
+MAIL_IDLE_TIMEOUT = 60
+MAIL_MAX_ATTEMPTS = 6
+MAIL_MAX_BACKOFF = 300
+MAIL_FAILED_KEEP = 100
+MAIL_STATUS_KEEP = 500  # 最近幾封信的寄送狀態 (給等待驗證碼的畫面查詢)
+MAIL_OTP_TTL = 300  # 驗證碼信件超過這麼久還沒寄出就丟掉，不再重試
+
+def mail_settings():
+    """secrets 的 [email]：sender / password，另可設定 smtp_host、smtp_port、smtp_security (ssl / starttls / none)"""
+    conf = dict(st.secrets["email"])
+    port = int(conf.get("smtp_port", 465))
+    return {"sender": conf["sender"], "password": conf.get("password", ""), "host": conf.get("smtp_host", "smtp.gmail.com"), "port": port,
+            "security": conf.get("smtp_security", "ssl" if port == 465 else "starttls"), "timeout": float(conf.get("smtp_timeout", 30))}
+
+class MailOutbox:
+    """寄信只排入 outbox (持久化到本機檔案，重啟後繼續寄)；背景執行緒用同一條已登入的 SMTP 連線依序寄出，
+    閒置超過 idle_timeout 才關閉連線，失敗的信以指數退避重試。
+    有期限的信 (驗證碼) 內文含明碼，只留在記憶體，不寫入檔案"""
+
+    def __init__(self, path, settings, idle_timeout=MAIL_IDLE_TIMEOUT, max_attempts=MAIL_MAX_ATTEMPTS):
+        self.path = path
+        self.settings = settings
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.cond = threading.Condition()
+        self.server = None  # 只有背景執行緒會碰
+        self.last_used = 0
+        self.last_error = None
+        self.statuses = {}  # id -> {"state": pending / sent / failed / expired, "error", "attempts"}
+        state = self._load()
+        self.items = [it for it in state.get("pending", []) if not it.get("expires_at")]
+        self.failed = state.get("failed", [])[-MAIL_FAILED_KEEP:]
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f: return json.load(f)
+        except (FileNotFoundError, ValueError): return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        pending = [it for it in self.items if not it.get("expires_at")]
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump({"pending": pending, "failed": self.failed[-MAIL_FAILED_KEEP:]}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def enqueue(self, to_email, subject, body, ttl=None):
+        """ttl (秒)：超過時間還沒寄出就放棄 (驗證碼用)；回傳信件 id"""
+        now = time.time()
+        item = {"id": uuid.uuid4().hex, "to": to_email, "subject": subject, "body": body, "attempts": 0, "next_at": 0, "queued_at": now,
+                "expires_at": now + ttl if ttl else None}
+        with self.cond:
+            self.items.append(item)
+            self._set_status(item["id"], "pending")
+            self._save()
+            self.cond.notify()
+        return item["id"]
+
+    def pending_count(self):
+        with self.cond: return len(self.items)
+
+    def status(self, mail_id):
+        with self.cond:
+            found = self.statuses.get(mail_id)
+            return dict(found) if found else None
+
+    def snapshot(self):
+        with self.cond: return {"pending": len(self.items), "failed": len(self.failed), "last_error": self.last_error}
+
+    def _set_status(self, mail_id, state, error=None, attempts=0):
+        self.statuses.pop(mail_id, None)
+        self.statuses[mail_id] = {"state": state, "error": error, "attempts": attempts}
+        while len(self.statuses) > MAIL_STATUS_KEEP: del self.statuses[next(iter(self.statuses))]
+
+    @staticmethod
+    def _expired(item):
+        return bool(item.get("expires_at")) and time.time() > item["expires_at"]
+
+    def _drop(self, item, state, error):
+        """移出佇列；有期限的信 (驗證碼) 不保留內文"""
+        self.items = [it for it in self.items if it["id"] != item["id"]]
+        self._set_status(item["id"], state, error, item["attempts"])
+        if state == "failed":
+            self.failed.append({k: v for k, v in dict(item, error=error).items() if k != "body" or not item.get("expires_at")})
+            del self.failed[:-MAIL_FAILED_KEEP]
+
+    def _connect(self):
+        conf = self.settings
+        if conf["security"] == "ssl": server = smtplib.SMTP_SSL(conf["host"], conf["port"], timeout=conf["timeout"])
+        else:
+            server = smtplib.SMTP(conf["host"], conf["port"], timeout=conf["timeout"])
+            if conf["security"] == "starttls": server.starttls()
+        if conf["password"]: server.login(conf["sender"], conf["password"])
+        return server
+
+    def _close(self):
+        if self.server is not None:
+            try: self.server.quit()
+            except Exception: pass
+        self.server = None
+
+    def _send(self, item):
+        msg = MIMEText(item["body"])
+        msg['Subject'] = item["subject"]
+        msg['From'] = self.settings["sender"]
+        msg['To'] = item["to"]
+        for attempt in range(2):
+            if self.server is None or time.time() - self.last_used > self.idle_timeout:
+                self._close(); self.server = self._connect()
+            try:
+                self.server.sendmail(self.settings["sender"], item["to"], msg.as_string())
+                self.last_used = time.time()
+                return
+            except smtplib.SMTPServerDisconnected:
+                # 伺服器先關掉了閒置連線：重新連線登入再送一次
+                self._close()
+                if attempt: raise
+
+    def _deliver(self, item):
+        try: self._send(item)
+        except Exception as e:
+            self._close()
+            get_sheets_metrics().record_error("mail", "mail_outbox", e)
+            with self.cond:
+                self.last_error = str(e)
+                for it in self.items:
+                    if it["id"] != item["id"]: continue
+                    it["attempts"] += 1
+                    if it["attempts"] >= self.max_attempts or isinstance(e, smtplib.SMTPRecipientsRefused): self._drop(it, "failed", str(e))
+                    elif self._expired(it): self._drop(it, "expired", str(e))
+                    else:
+                        it["next_at"] = time.time() + random.uniform(0.5, 1.0) * min(MAIL_MAX_BACKOFF, 2 ** it["attempts"] * 5)
+                        self._set_status(it["id"], "pending", str(e), it["attempts"])
+                    break
+                self._save()
+            return False
+        with self.cond:
+            self.items = [it for it in self.items if it["id"] != item["id"]]
+            self._set_status(item["id"], "sent", attempts=item["attempts"] + 1)
+            self.last_error = None
+            self._save()
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                # 過期的驗證碼信直接丟掉 (使用者早就不會用這個碼了)
+                expired = [it for it in self.items if self._expired(it)]
+                for it in expired: self._drop(it, "expired", "超過有效時間仍未寄出")
+                if expired: self._save()
+                now = time.time()
+                due = [dict(it) for it in self.items if it["next_at"] <= now]
+                if not due:
+                    # 等下一封到期的信、新信，或是連線閒置到期
+                    timeouts = [it["next_at"] - now for it in self.items] + [it["expires_at"] - now for it in self.items if it.get("expires_at")]
+                    if self.server is not None: timeouts.append(self.idle_timeout - (now - self.last_used))
+                    self.cond.wait(max(min(timeouts), 0.05) if timeouts else None)
+            if not due:
+                if self.server is not None and time.time() - self.last_used >= self.idle_timeout: self._close()
+                continue
+            for item in due:
+                if not self._deliver(item): break
+
+@st.cache_resource
+def get_mail_outbox():
+    return MailOutbox(MAIL_OUTBOX_PATH, mail_settings())
+
 # --- Email 相關函式 ---
 def send_otp_email(to_email, code, subject="【記帳本】驗證碼"):
-    if "email" not in st.secrets: return False, "尚未設定 Email Secrets"
-    sender = st.secrets["email"]["sender"]
-    pwd = st.secrets["email"]["password"]
-    msg = MIMEText(f"{subject}：{code}\n\n請在頁面上輸入此驗證碼以完成操作。")
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = to_email
+    if "email" not in st.secrets: return False, "尚未設定 Email Secrets", None
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender, pwd)
-            server.sendmail(sender, to_email, msg.as_string())
-        return True, "驗證碼已發送"
-    except Exception as e: return False, f"寄信失敗: {e}"
+        mail_id = get_mail_outbox().enqueue(to_email, subject, f"{subject}：{code}\n\n請在頁面上輸入此驗證碼以完成操作。", ttl=MAIL_OTP_TTL)
+        return True, "驗證碼已排入寄送", mail_id
+    except Exception as e: return False, f"寄信失敗: {e}", None
+
+def otp_mail_notice(mail_id, to_email):
+    """等待驗證碼畫面顯示信件的寄送狀態；寄送失敗或過期回傳 True"""
+    status = get_mail_outbox().status(mail_id) if mail_id and "email" in st.secrets else None
+    # 驗證碼信件只在記憶體：伺服器重新啟動後就找不到了
+    state = status["state"] if status else ("lost" if mail_id and "email" in st.secrets else "sent")
+    if state == "sent": st.success(f"驗證碼已寄至 {to_email}")
+    elif state == "pending":
+        st.info(f"驗證碼寄送中：{to_email}" + (f"（第 {status['attempts']} 次失敗，稍後重試：{status['error']}）" if status["error"] else ""))
+        if st.button("🔄 更新寄送狀態", key="otp_mail_refresh"): st.rerun()
+    else:
+        if state == "failed": st.error(f"驗證碼寄送失敗：{status['error']}")
+        elif state == "expired": st.error("驗證碼信件逾時未寄出")
+        else: st.error("找不到驗證碼信件的寄送紀錄 (伺服器可能已重新啟動)，請重新發送")
+        return True
+    return False
 
 # [修改] 發送邀請通知信函式 (已加入個資遮罩、標題改用暱稱)
 def send_invitation_email(to_email, inviter_email, book_name, inviter_nickname=None):
@@ -161,9 +900,6 @@ def send_invitation_email(to_email, inviter_email, book_name, inviter_nickname=N
     # ⚠️ 請確認這裡的網址是您正確的 App 連結
     APP_URL = "https://expense-tracker-test.streamlit.app" 
     
-    sender = st.secrets["email"]["sender"]
-    pwd = st.secrets["email"]["password"]
-    
     # --- 1. 決定顯示名稱 (有暱稱用暱稱，沒暱稱用遮罩 Email) ---
     if inviter_nickname:
         display_name = inviter_nickname
@@ -198,34 +934,200 @@ def send_invitation_email(to_email, inviter_email, book_name, inviter_nickname=N
     祝記帳愉快！
     """
     
-    msg = MIMEText(body)
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = to_email
-    
+    # 排入 outbox 由背景寄出 (同時邀請多人時共用同一條 SMTP 連線)
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender, pwd)
-            server.sendmail(sender, to_email, msg.as_string())
-        return True, "邀請信已發送"
+        get_mail_outbox().enqueue(to_email, subject, body)
+        return True, "邀請信已排入寄送"
     except Exception as e:
         print(f"Mail Error: {e}")
         return False, f"寄信失敗: {e}"
 
+# ==========================================
+# [新增] 使用者 / 帳本綁定目錄 (記憶體索引)
+# ==========================================
+USER_DIRECTORY_TTL = 300
+USER_DIRECTORY_FORCE_SECONDS = 10  # 強制重讀 (密碼錯誤、列號失準) 的最短間隔，避免連續登入失敗打爆配額
+USER_COLUMNS = ["Email", "Sheet_Name", "Join_Date", "Password_Hash", "Status", "Expire_Date", "Plan", "Nickname"]
+BINDING_COLUMNS = ["Email", "Sheet_URL", "Book_Name", "Role"]
+
+def _values_to_records(values, default_header):
+    """工作表原始值 -> [dict]，每筆附上 _row (工作表列號)"""
+    header = _trim_row(values[0]) if values else list(default_header)
+    records = []
+    for i, r in enumerate(values[1:]):
+        if not any(str(v).strip() for v in r): continue
+        rec = dict(zip(header, _pad_row(r, len(header))))
+        rec["_row"] = i + 2
+        records.append(rec)
+    return header, records
+
+def _load_user_directory_tables():
+    admin_book = get_spreadsheet(st.secrets["admin_sheet_url"])
+    try: result = admin_book.values_batch_get(["Users", "Book_Bindings"])
+    except gspread.exceptions.APIError as e:
+        # 只有「範圍無效」(400) 代表 Book_Bindings 尚未建立；配額或伺服器錯誤直接往上拋，不要在額度吃緊時多打兩次
+        if api_status(e) != 400: raise
+        admin_worksheet("Book_Bindings", create_header=BINDING_COLUMNS)
+        result = admin_book.values_batch_get(["Users", "Book_Bindings"])
+    tables = [vr.get("values", []) for vr in result.get("valueRanges", [])]
+    return tables[0], tables[1]
+
+class UserDirectory:
+    """Users / Book_Bindings 的共用快取：以 Email 與 Sheet_URL 建索引，查詢 O(1)，逾時才重新讀取"""
+
+    def __init__(self, loader, ttl=USER_DIRECTORY_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.loaded_at = 0
+        self.users_by_email = {}
+        self.bindings = []
+        self.bindings_by_email = {}
+        self.bindings_by_url = {}
+        self.user_rows = 1
+        self.binding_rows = 1
+        self.version = 0  # 本機索引被寫入更新的次數
+        self.loading = None  # 正在讀取時的 Event，其他執行緒等它讀完就好
+
+    def refresh(self, force=False):
+        """重新讀取兩張表；回傳是否真的有重新讀取。
+        強制重讀也至少間隔 USER_DIRECTORY_FORCE_SECONDS；讀取 Sheets 時不持有鎖，同時間只有一個執行緒去讀"""
+        with self.lock:
+            if time.time() - self.loaded_at < (USER_DIRECTORY_FORCE_SECONDS if force else self.ttl): return False
+            loading = self.loading
+            if loading is None: self.loading = threading.Event(); version = self.version
+        if loading is not None:
+            loading.wait()
+            return False
+        try:
+            users_values, bindings_values = self.loader()
+            _, users = _values_to_records(users_values, USER_COLUMNS)
+            _, bindings = _values_to_records(bindings_values, BINDING_COLUMNS)
+            with self.lock:
+                # 讀取期間有新增 / 修改 (寫入 Sheets 後才更新索引)，讀到的可能是舊資料：保留本機索引，下次再讀
+                if self.version != version: return False
+                self.users_by_email = {u["Email"]: u for u in users}
+                self.user_rows = max(len(users_values), 1)
+                self.bindings = bindings
+                self.binding_rows = max(len(bindings_values), 1)
+                self._reindex_bindings()
+                self.loaded_at = time.time()
+                return True
+        finally:
+            with self.lock: loading, self.loading = self.loading, None
+            loading.set()
+
+    def _reindex_bindings(self):
+        self.bindings_by_email = {}; self.bindings_by_url = {}
+        for b in self.bindings:
+            self.bindings_by_email.setdefault(b["Email"], []).append(b)
+            self.bindings_by_url.setdefault(b["Sheet_URL"], []).append(b)
+
+    def invalidate(self):
+        with self.lock: self.loaded_at = 0
+
+    def get_user(self, email, refresh_on_miss=True):
+        """找不到時 (可能是其他程序剛新增) 最多強制重讀一次"""
+        refreshed = self.refresh()
+        with self.lock: user = self.users_by_email.get(email)
+        if user is None and refresh_on_miss and not refreshed:
+            self.refresh(force=True)
+            with self.lock: user = self.users_by_email.get(email)
+        return dict(user) if user else None
+
+    def books_of(self, email):
+        self.refresh()
+        with self.lock: return [dict(b) for b in self.bindings_by_email.get(email, [])]
+
+    def members_of(self, sheet_url):
+        self.refresh()
+        with self.lock: return [dict(b) for b in self.bindings_by_url.get(sheet_url, [])]
+
+    def binding(self, email, sheet_url):
+        return next((b for b in self.members_of(sheet_url) if b["Email"] == email), None)
+
+    def owner_of(self, sheet_url):
+        return next((b for b in self.members_of(sheet_url) if b.get("Role") == "Owner"), None)
+
+    def nickname_map(self):
+        self.refresh()
+        with self.lock: return {email: u.get("Nickname", "") for email, u in self.users_by_email.items()}
+
+    # --- 寫入 Sheets 成功後同步更新索引，不必整張重讀 ---
+    def add_user(self, record):
+        with self.lock:
+            self.version += 1
+            self.user_rows += 1
+            self.users_by_email[record["Email"]] = dict(record, _row=self.user_rows)
+
+    def update_user(self, email, **fields):
+        with self.lock:
+            self.version += 1
+            if email in self.users_by_email: self.users_by_email[email].update(fields)
+
+    def add_binding(self, record):
+        with self.lock:
+            self.version += 1
+            self.binding_rows += 1
+            self.bindings.append(dict(record, _row=self.binding_rows))
+            self._reindex_bindings()
+
+    def remove_binding(self, row_no):
+        with self.lock:
+            self.version += 1
+            self.bindings = [b for b in self.bindings if b["_row"] != row_no]
+            for b in self.bindings:
+                if b["_row"] > row_no: b["_row"] -= 1
+            self.binding_rows -= 1
+            self._reindex_bindings()
+
+    def set_role(self, email, sheet_url, role):
+        with self.lock:
+            self.version += 1
+            for b in self.bindings_by_url.get(sheet_url, []):
+                if b["Email"] == email: b["Role"] = role
+
+@st.cache_resource
+def get_user_directory():
+    return UserDirectory(_load_user_directory_tables)
+
+def _confirm_row(ws, row_no, expected):
+    """確認目錄記錄的列號仍指向同一筆資料 (其他人可能已刪除或插入列)"""
+    if not row_no: return False
+    values = ws.row_values(row_no)
+    return all(i < len(values) and str(values[i]) == str(v) for i, v in enumerate(expected))
+
+def _locate_user_row(users_sheet, email):
+    """回傳 (列號, 使用者資料)；目錄列號失準時強制重讀一次"""
+    directory = get_user_directory()
+    user = directory.get_user(email)
+    if user and _confirm_row(users_sheet, user["_row"], [email]): return user["_row"], user
+    directory.refresh(force=True)
+    user = directory.get_user(email, refresh_on_miss=False)
+    if user and _confirm_row(users_sheet, user["_row"], [email]): return user["_row"], user
+    return None, None
+
+def _locate_binding_row(bindings_sheet, email, sheet_url):
+    directory = get_user_directory()
+    b = directory.binding(email, sheet_url)
+    if b and _confirm_row(bindings_sheet, b["_row"], [email, sheet_url]): return b["_row"], b
+    directory.refresh(force=True)
+    b = directory.binding(email, sheet_url)
+    if b and _confirm_row(bindings_sheet, b["_row"], [email, sheet_url]): return b["_row"], b
+    return None, None
+
 def reset_user_password(email, new_password, new_nickname=None):
     """重設密碼，並處理試用期重置與暱稱更新"""
-    client = get_gspread_client()
     try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        users_sheet = admin_book.worksheet("Users")
+        users_sheet = admin_worksheet("Users")
         
         # 尋找使用者 Row
-        cell = users_sheet.find(email)
-        if not cell: return False, "找不到使用者"
+        row, user = _locate_user_row(users_sheet, email)
+        if not row: return False, "找不到使用者"
         
-        row = cell.row
-        old_hash = users_sheet.cell(row, 4).value
+        old_hash = user.get("Password_Hash", "")
         new_hash = hash_password(new_password)
+        changes = {"Password_Hash": new_hash}
         
         updates = []
         updates.append({'range': f'D{row}', 'values': [[new_hash]]}) # 更新密碼
@@ -236,50 +1138,46 @@ def reset_user_password(email, new_password, new_nickname=None):
             expire_date = today + timedelta(days=TRIAL_DAYS)
             updates.append({'range': f'C{row}', 'values': [[str(today)]]}) # Join_Date
             updates.append({'range': f'F{row}', 'values': [[str(expire_date)]]}) # Expire_Date
+            changes.update({"Join_Date": str(today), "Expire_Date": str(expire_date)})
         
         if new_nickname:
             updates.append({'range': f'H{row}', 'values': [[new_nickname]]})
+            changes["Nickname"] = new_nickname
             
         users_sheet.batch_update(updates)
+        get_user_directory().update_user(email, **changes)
         return True, "密碼更新成功 (若是首次啟用，試用期已重置)"
-    except Exception as e: return False, f"資料庫錯誤: {e}"
+    except Exception as e:
+        invalidate_handles(st.secrets["admin_sheet_url"], "Users")
+        return False, f"資料庫錯誤: {e}"
 
 def update_user_nickname(email, new_nickname):
     """更新使用者暱稱"""
-    client = get_gspread_client()
     try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        users_sheet = admin_book.worksheet("Users")
-        cell = users_sheet.find(email)
-        if not cell: return False, "找不到使用者"
-        users_sheet.update_cell(cell.row, 8, new_nickname)
+        users_sheet = admin_worksheet("Users")
+        row, _ = _locate_user_row(users_sheet, email)
+        if not row: return False, "找不到使用者"
+        users_sheet.update_cell(row, 8, new_nickname)
+        get_user_directory().update_user(email, Nickname=new_nickname)
         return True, "暱稱更新成功"
-    except Exception as e: return False, f"Error: {e}"
+    except Exception as e:
+        invalidate_handles(st.secrets["admin_sheet_url"], "Users")
+        return False, f"Error: {e}"
 
-@st.cache_data(ttl=600)
 def get_all_users_nickname_map():
     """回傳 {email: nickname} 的字典，用於顯示"""
-    client = get_gspread_client()
-    try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        users_sheet = admin_book.worksheet("Users")
-        records = users_sheet.get_all_records()
-        return {row["Email"]: row.get("Nickname", "") for row in records}
+    try: return get_user_directory().nickname_map()
     except: return {}
 
 # ==========================================
 # [新增] 寫入系統日誌 (Audit Log)
 # ==========================================
 def write_system_log(operator, action, target_email, book_name, sheet_url):
-    client = get_gspread_client()
+    """只寫入本機 spool 就返回，由背景批次寫到 System_Logs (時間戳記是發生當下的時間)"""
     try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        try: log_sheet = admin_book.worksheet("System_Logs")
-        except: log_sheet = admin_book.add_worksheet("System_Logs", 1000, 6); log_sheet.append_row(["Timestamp", "Operator", "Action", "Target_Email", "Book_Name", "Sheet_URL"])
-        
         tz_tw = timezone(timedelta(hours=8))
         now_str = datetime.now(tz_tw).strftime("%Y-%m-%d %H:%M:%S")
-        log_sheet.append_row([now_str, operator, action, target_email, book_name, sheet_url])
+        get_audit_log_queue().enqueue(st.secrets["admin_sheet_url"], "System_Logs", [now_str, operator, action, target_email, book_name, sheet_url])
         return True
     except Exception as e:
         print(f"Log Error: {e}")
@@ -291,33 +1189,18 @@ def write_system_log(operator, action, target_email, book_name, sheet_url):
 def validate_registration_pre_check(email, sheet_url):
     client = get_gspread_client()
     if not client: return False, "API Error"
-    admin_url = st.secrets.get("admin_sheet_url")
     
     try:
-        admin_book = client.open_by_url(admin_url)
-        users_sheet = admin_book.worksheet("Users")
-        try: cell = users_sheet.find(email); 
-        except: cell = None
-        if cell: return False, "❌ 此 Email 已存在系統中。請直接「登入」。"
+        directory = get_user_directory()
+        if directory.get_user(email): return False, "❌ 此 Email 已存在系統中。請直接「登入」。"
 
-        try:
-            bindings_sheet = admin_book.worksheet("Book_Bindings")
-            b_records = bindings_sheet.get_all_records()
-            df_bind = pd.DataFrame(b_records)
-            if not df_bind.empty and "Sheet_URL" in df_bind.columns:
-                conflict = df_bind[df_bind["Sheet_URL"] == sheet_url]
-                if not conflict.empty:
-                    owner_email = conflict.iloc[0]["Email"]
-                    owner_nickname = ""
-                    try:
-                        records_u = users_sheet.get_all_records()
-                        df_u = pd.DataFrame(records_u)
-                        o_row = df_u[df_u["Email"] == owner_email]
-                        if not o_row.empty: owner_nickname = o_row.iloc[0]["Nickname"]
-                    except: pass
-                    display_name = owner_nickname if owner_nickname else mask_email(owner_email)
-                    return False, f"❌ 此帳本已被 **{display_name}** 綁定為擁有者。請聯繫他邀請您加入。"
-        except: pass
+        conflict = directory.members_of(sheet_url)
+        if conflict:
+            owner_email = conflict[0]["Email"]
+            owner = directory.get_user(owner_email, refresh_on_miss=False)
+            owner_nickname = owner.get("Nickname", "") if owner else ""
+            display_name = owner_nickname if owner_nickname else mask_email(owner_email)
+            return False, f"❌ 此帳本已被 **{display_name}** 綁定為擁有者。請聯繫他邀請您加入。"
         return True, "OK"
     except Exception as e: return False, f"系統檢查失敗: {e}"
 
@@ -331,57 +1214,49 @@ def handle_user_login(email, password, user_sheet_name=None, nickname=None, is_r
     if not admin_url: return True, {"Plan": "Dev", "Status": "Active", "Nickname": "Dev"} 
 
     try:
-        admin_book = client.open_by_url(admin_url)
-        users_sheet = admin_book.worksheet("Users")
-        try: bindings_sheet = admin_book.worksheet("Book_Bindings")
-        except: bindings_sheet = admin_book.add_worksheet("Book_Bindings", 100, 4); bindings_sheet.append_row(["Email", "Sheet_URL", "Book_Name", "Role"])
-        
-        records = users_sheet.get_all_records()
-        if not records:
-            df_users = pd.DataFrame(columns=["Email", "Sheet_Name", "Join_Date", "Password_Hash", "Status", "Expire_Date", "Plan", "Nickname"])
-        else:
-            df_users = pd.DataFrame(records)
-            if "Nickname" not in df_users.columns: df_users["Nickname"] = ""
-
-        user_row = df_users[df_users["Email"] == email]
+        directory = get_user_directory()
+        user_row = directory.get_user(email)
         pwd_hash = hash_password(password)
         today = datetime.now().date()
 
         if is_register:
-            if not user_row.empty: return False, "帳號已存在"
+            if user_row: return False, "帳號已存在"
+            users_sheet = admin_worksheet("Users")
+            bindings_sheet = admin_worksheet("Book_Bindings", create_header=BINDING_COLUMNS)
             expire_date = today + timedelta(days=TRIAL_DAYS)
             final_nickname = nickname if nickname else email.split("@")[0]
             new_user = {"Email": email, "Sheet_Name": user_sheet_name, "Join_Date": str(today), "Password_Hash": pwd_hash, "Status": "Active", "Expire_Date": str(expire_date), "Plan": "Trial", "Nickname": final_nickname}
             row_data = [new_user["Email"], new_user["Sheet_Name"], new_user["Join_Date"], new_user["Password_Hash"], new_user["Status"], new_user["Expire_Date"], new_user["Plan"], new_user["Nickname"]]
             users_sheet.append_row(row_data)
+            directory.add_user(new_user)
             book_title = get_sheet_title_safe(user_sheet_name)
             bindings_sheet.append_row([email, user_sheet_name, book_title, "Owner"])
+            directory.add_binding({"Email": email, "Sheet_URL": user_sheet_name, "Book_Name": book_title, "Role": "Owner"})
             write_system_log(email, "註冊並建立帳本(Owner)", email, book_title, user_sheet_name)
             return True, new_user
 
-        if is_register: 
-             records = users_sheet.get_all_records()
-             df_users = pd.DataFrame(records)
-             user_row = df_users[df_users["Email"] == email]
+        if not user_row: return False, "User not found"
 
-        if user_row.empty: return False, "User not found"
-
-        user_info = user_row.iloc[0].to_dict()
+        user_info = {k: v for k, v in user_row.items() if k != "_row"}
         stored_hash = str(user_info.get("Password_Hash", ""))
         
         if stored_hash != "RESET_REQUIRED" and stored_hash != pwd_hash:
-            return False, "Password Incorrect"
+            # 密碼可能剛在其他程序被重設，強制重讀一次再判斷
+            directory.refresh(force=True)
+            user_row = directory.get_user(email, refresh_on_miss=False) or {}
+            user_info = {k: v for k, v in user_row.items() if k != "_row"}
+            stored_hash = str(user_info.get("Password_Hash", ""))
+            if stored_hash != "RESET_REQUIRED" and stored_hash != pwd_hash:
+                return False, "Password Incorrect"
         
         if pd.isna(user_info.get("Nickname")) or user_info.get("Nickname") == "":
             user_info["Nickname"] = email.split("@")[0]
 
-        b_records = bindings_sheet.get_all_records()
-        df_bind = pd.DataFrame(b_records)
-        user_books = df_bind[df_bind["Email"] == email]
+        user_books = directory.books_of(email)
         
         books_list = []
-        if not user_books.empty:
-            for _, row in user_books.iterrows():
+        if user_books:
+            for row in user_books:
                 role = row.get("Role", row.get("Owner", "Member"))
                 books_list.append({"name": row["Book_Name"], "url": row["Sheet_URL"], "role": role})
         else:
@@ -399,36 +1274,26 @@ def handle_user_login(email, password, user_sheet_name=None, nickname=None, is_r
     except Exception as e: return False, f"Login Error: {e}"
 
 def add_binding(target_email, sheet_url, book_name, role="Member", operator_email=None):
-    client = get_gspread_client()
     try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        users_sheet = admin_book.worksheet("Users")
-        bindings_sheet = admin_book.worksheet("Book_Bindings")
+        directory = get_user_directory()
         
         # 1. 檢查使用者是否存在
-        try: cell = users_sheet.find(target_email)
-        except: cell = None
-
-        if not cell:
+        if not directory.get_user(target_email):
             today = str(datetime.now().date())
             row = [target_email, "", today, "RESET_REQUIRED", "Pending", today, "Trial", target_email.split("@")[0]]
-            users_sheet.append_row(row)
+            admin_worksheet("Users").append_row(row)
+            directory.add_user(dict(zip(USER_COLUMNS, row)))
         
         # 2. 檢查是否已經綁定
-        existing = bindings_sheet.get_all_records()
-        df = pd.DataFrame(existing)
-        if not df.empty:
-            check = df[(df["Email"] == target_email) & (df["Sheet_URL"] == sheet_url)]
-            if not check.empty: return True, "該使用者已經在此帳本中，無需重複邀請"
+        if directory.binding(target_email, sheet_url): return True, "該使用者已經在此帳本中，無需重複邀請"
         
         # 3. 檢查 Owner 唯一性
         if role == "Owner":
-            if not df.empty:
-                owner_check = df[(df["Sheet_URL"] == sheet_url) & (df["Role"] == "Owner")]
-                if not owner_check.empty: return False, "❌ 此帳本已經有擁有者"
+            if directory.owner_of(sheet_url): return False, "❌ 此帳本已經有擁有者"
 
         # 4. 寫入綁定
-        bindings_sheet.append_row([target_email, sheet_url, book_name, role])
+        admin_worksheet("Book_Bindings").append_row([target_email, sheet_url, book_name, role])
+        directory.add_binding({"Email": target_email, "Sheet_URL": sheet_url, "Book_Name": book_name, "Role": role})
         
         # 5. 寫入 Log
         op = operator_email if operator_email else "System"
@@ -451,7 +1316,7 @@ def add_binding(target_email, sheet_url, book_name, role="Member", operator_emai
                 is_sent, mail_msg = send_invitation_email(target_email, operator_email, book_name, inviter_nickname=current_nick)
                 
                 if is_sent:
-                    status_msg += " (邀請信已寄出 ✅)"
+                    status_msg += " (邀請信寄送中 ✉️)"
                 else:
                     status_msg += f" (但寄信失敗 ❌: {mail_msg})"
             else:
@@ -459,68 +1324,56 @@ def add_binding(target_email, sheet_url, book_name, role="Member", operator_emai
         
         return True, status_msg
 
-    except Exception as e: return False, f"系統錯誤: {e}"
+    except Exception as e:
+        invalidate_handles(st.secrets["admin_sheet_url"])
+        return False, f"系統錯誤: {e}"
 
 def remove_binding_from_db(target_email, sheet_url, operator_email=None, book_name="Unknown"):
-    client = get_gspread_client()
     try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        bindings_sheet = admin_book.worksheet("Book_Bindings")
-        records = bindings_sheet.get_all_records()
-        row_to_delete = None
-        for i, row in enumerate(records):
-            if row["Email"] == target_email and row["Sheet_URL"] == sheet_url:
-                row_to_delete = i + 2; book_name = row["Book_Name"]; break
+        bindings_sheet = admin_worksheet("Book_Bindings")
+        row_to_delete, binding = _locate_binding_row(bindings_sheet, target_email, sheet_url)
         if row_to_delete:
+            book_name = binding["Book_Name"]
             bindings_sheet.delete_rows(row_to_delete)
+            get_user_directory().remove_binding(row_to_delete)
             op = operator_email if operator_email else target_email
             write_system_log(op, "解除綁定/移除成員", target_email, book_name, sheet_url)
             return True, "解除綁定成功"
         else: return False, "找不到該綁定資料"
-    except Exception as e: return False, f"刪除失敗: {e}"
+    except Exception as e:
+        invalidate_handles(st.secrets["admin_sheet_url"], "Book_Bindings")
+        return False, f"刪除失敗: {e}"
 
 # [新增] 移轉擁有權函式
 def transfer_book_ownership(sheet_url, old_owner_email, new_owner_email, book_name="Unknown"):
-    client = get_gspread_client()
     try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        bindings_sheet = admin_book.worksheet("Book_Bindings")
-        records = bindings_sheet.get_all_records()
-        
-        row_old = None
-        row_new = None
+        bindings_sheet = admin_worksheet("Book_Bindings")
         
         # 尋找兩位的資料列 (Gspread index 從 1 開始，標題是 1，資料從 2 開始)
-        for i, row in enumerate(records):
-            if row["Sheet_URL"] == sheet_url:
-                if row["Email"] == old_owner_email:
-                    row_old = i + 2
-                elif row["Email"] == new_owner_email:
-                    row_new = i + 2
+        row_old, _ = _locate_binding_row(bindings_sheet, old_owner_email, sheet_url)
+        row_new, _ = _locate_binding_row(bindings_sheet, new_owner_email, sheet_url)
         
         if row_old and row_new:
             # 假設 Role 是第 4 欄 (D)
-            bindings_sheet.update_cell(row_old, 4, "Member")
-            bindings_sheet.update_cell(row_new, 4, "Owner")
+            bindings_sheet.batch_update([
+                {'range': f'D{row_old}', 'values': [["Member"]]},
+                {'range': f'D{row_new}', 'values': [["Owner"]]},
+            ])
+            directory = get_user_directory()
+            directory.set_role(old_owner_email, sheet_url, "Member")
+            directory.set_role(new_owner_email, sheet_url, "Owner")
             
             write_system_log(old_owner_email, "移轉擁有權", new_owner_email, book_name, sheet_url)
             return True, "移轉成功！您已成為成員。"
         else:
             return False, "資料庫讀取錯誤，找不到成員資料"
             
-    except Exception as e: return False, f"移轉失敗: {e}"
+    except Exception as e:
+        invalidate_handles(st.secrets["admin_sheet_url"], "Book_Bindings")
+        return False, f"移轉失敗: {e}"
 
 def get_book_members(sheet_url):
-    client = get_gspread_client()
-    try:
-        admin_book = client.open_by_url(st.secrets["admin_sheet_url"])
-        bindings_sheet = admin_book.worksheet("Book_Bindings")
-        records = bindings_sheet.get_all_records()
-        df = pd.DataFrame(records)
-        if not df.empty:
-            members = df[df["Sheet_URL"] == sheet_url]
-            return members.to_dict('records')
-        return []
+    try: return [{k: v for k, v in m.items() if k != "_row"} for m in get_user_directory().members_of(sheet_url)]
     except: return []
 
 # ==========================================
@@ -575,12 +1428,12 @@ def login_flow():
                     else:
                         code = ''.join(random.choices(string.digits, k=6))
                         st.session_state.otp_code = code; st.session_state.reset_email = email_reset
-                        with st.spinner("寄送中..."):
-                            ok, msg = send_otp_email(email_reset, code)
-                            if ok: st.session_state.reset_stage = 2; st.success("✅ 已發送！"); time.sleep(1); st.rerun()
-                            else: st.error(msg)
+                        ok, msg, st.session_state.otp_mail_id = send_otp_email(email_reset, code)
+                        if ok: st.session_state.reset_stage = 2; st.toast("✅ 驗證碼寄送中，請查收信箱"); st.rerun()
+                        else: st.error(msg)
             elif st.session_state.reset_stage == 2:
-                st.success(f"驗證碼已寄至 {st.session_state.reset_email}")
+                if otp_mail_notice(st.session_state.get("otp_mail_id"), st.session_state.reset_email):
+                    if st.button("返回重新發送", key="reset_resend"): st.session_state.reset_stage = 1; st.rerun()
                 otp_input = st.text_input("輸入 6 位數驗證碼", key="otp_input")
                 new_pwd = st.text_input("設定新密碼", type="password", key="reset_new_pwd")
                 new_nick = st.text_input("設定您的暱稱 (若為初次啟用請填寫)", key="reset_new_nick")
@@ -620,7 +1473,6 @@ def login_flow():
                         if not is_valid_email(email_in):
                             st.error("❌ Email 格式不正確")
                         else:
-                            st.cache_data.clear() 
                             with st.spinner("檢查帳戶狀態中..."):
                                 is_valid, msg = validate_registration_pre_check(email_in, sheet_in)
                             if not is_valid: st.error(msg)
@@ -628,15 +1480,14 @@ def login_flow():
                                 code = ''.join(random.choices(string.digits, k=6))
                                 st.session_state.otp_code = code
                                 st.session_state.reg_data = {"email": email_in, "pwd": pwd_in, "nick": nick_in, "sheet": sheet_in}
-                                with st.spinner("寄送驗證碼中..."):
-                                    ok, msg = send_otp_email(email_in, code, subject="【記帳本】註冊驗證碼")
-                                    if ok: st.session_state.reg_stage = 2; st.success("✅ 驗證碼已發送！"); time.sleep(1); st.rerun()
-                                    else: st.error(msg)
+                                ok, msg, st.session_state.otp_mail_id = send_otp_email(email_in, code, subject="【記帳本】註冊驗證碼")
+                                if ok: st.session_state.reg_stage = 2; st.toast("✅ 驗證碼寄送中，請查收信箱"); st.rerun()
+                                else: st.error(msg)
                     else: st.warning("請填寫所有欄位")
             
             elif st.session_state.reg_stage == 2:
                 reg_d = st.session_state.reg_data
-                st.success(f"驗證碼已發送至：{reg_d['email']}")
+                otp_mail_notice(st.session_state.get("otp_mail_id"), reg_d['email'])
                 otp_input = st.text_input("輸入 6 位數驗證碼", key="reg_otp_input")
                 
                 if st.button("✨ 確認註冊", type="primary", use_container_width=True):
@@ -675,90 +1526,1240 @@ with c_title:
     st.markdown("<h2 style='margin-bottom: 0; padding-top: 10px;'>我的記帳本</h2>", unsafe_allow_html=True)
 
 # ... (Data Functions) ...
-@st.cache_data(ttl=300)
+# ==========================================
+# [新增] 交易分頁增量同步 (Delta Sync)
+# ==========================================
+# 增量同步時重疊讀取最後幾列，並輪流抽查前面的一段，發現不同就完整重載
+# 每段至少 SYNC_VERIFY_BLOCK_ROWS 列，並且放大到 SYNC_VERIFY_PASSES 次同步一定抽查完一輪：
+# 交易快取約 60 秒同步一次，在 Google Sheets 上直接修改舊資料最晚約 5 分鐘會被發現，
+# 最久也不超過 FULL_RESYNC_SECONDS 的定期完整重載
+SYNC_VERIFY_TAIL_ROWS = 100
+SYNC_VERIFY_BLOCK_ROWS = 1000
+SYNC_VERIFY_PASSES = 5
+FULL_RESYNC_SECONDS = 600
+
+@st.cache_resource
+def get_sheet_sync_registry():
+    """跨 Session 共用的同步狀態：{(帳本來源, 分頁名稱): state}"""
+    return {"lock": threading.Lock(), "sheets": {}}
+
+def _rows_match(fetched, cached):
+    """API 會省略右側與尾端的空白儲存格，比對前兩邊都先修剪"""
+    a = [_trim_row(r) for r in fetched]; b = [_trim_row(r) for r in cached]
+    while a and not a[-1]: a.pop()
+    while b and not b[-1]: b.pop()
+    return a == b
+
+def _col_letter(col_idx):
+    return re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, max(col_idx, 1)))
+
+def _needs_full_sync(state):
+    return state is None or not state["header"] or time.time() - state["full_at"] > FULL_RESYNC_SECONDS
+
+def _full_sync_worksheet(ws, key):
+    return _store_full_sync(key, ws.get_all_values())
+
+def _store_full_sync(key, values):
+    header = _trim_row(values[0]) if values else []
+    rows = [_pad_row(r, len(header)) for r in values[1:]]
+    state = {
+        "header": header,
+        "rows": rows,
+        "verify_at": 0,
+        "full_at": time.time(),
+        "synced_at": time.time(),
+    }
+    registry = get_sheet_sync_registry()
+    with registry["lock"]: registry["sheets"][key] = state
+    return header, rows
+
+def sync_worksheet_values(ws, source_str):
+    """回傳 (標題列, 資料列)。平常只讀取新增的列，發現前面資料被改動才完整重載"""
+    registry = get_sheet_sync_registry()
+    key = (source_str, ws.title)
+    with registry["lock"]: state = registry["sheets"].get(key)
+    if _needs_full_sync(state): return _full_sync_worksheet(ws, key)
+
+    rows = state["rows"]; synced = len(rows)
+    last_col = _col_letter(len(state["header"]))
+    # 資料列 i 在工作表的第 i + 2 列；尾端重疊 overlap 列，前面 prefix 列輪流抽查一段
+    overlap = min(synced, SYNC_VERIFY_TAIL_ROWS)
+    prefix = synced - overlap
+    ranges = ["1:1", f"A{prefix + 2}:{last_col}"]
+    block_start = state.get("verify_at", 0) % prefix if prefix else 0
+    block_end = min(block_start + max(SYNC_VERIFY_BLOCK_ROWS, -(-prefix // SYNC_VERIFY_PASSES)), prefix)
+    if block_end > block_start: ranges.append(f"A{block_start + 2}:{last_col}{block_end + 1}")
+    # 標題列、尾端與抽查段在同一次 API 呼叫讀取
+    result = ws.batch_get(ranges)
+    header = _trim_row(result[0][0]) if result[0] else []
+    tail = list(result[1])
+    if header != state["header"]: return _full_sync_worksheet(ws, key)
+    # 重疊或抽查的列不同 = 有列被刪除或修改，只能完整重載
+    if not _rows_match(tail[:overlap], rows[prefix:]): return _full_sync_worksheet(ws, key)
+    if len(ranges) > 2 and not _rows_match(result[2], rows[block_start:block_end]): return _full_sync_worksheet(ws, key)
+    state = dict(state)
+    new_rows = [_pad_row(r, len(header)) for r in tail[overlap:]]
+    if new_rows: state["rows"] = rows + new_rows
+    state["verify_at"] = block_end
+    state["synced_at"] = time.time()
+    with registry["lock"]: registry["sheets"][key] = state
+    return state["header"], state["rows"]
+
+SYNC_WORKERS = 4
+
+def _quote_sheet_title(title):
+    return "'" + title.replace("'", "''") + "'"
+
+def sync_worksheets_values(source_str, worksheets):
+    """多個分頁一起同步，回傳 [(分頁名稱, 標題列, 資料列)]
+    需要完整重載的分頁合併成一次 values_batch_get，其餘的增量同步用執行緒平行處理"""
+    registry = get_sheet_sync_registry()
+    with registry["lock"]: needs_full = [_needs_full_sync(registry["sheets"].get((source_str, ws.title))) for ws in worksheets]
+    cold = [ws for ws, full in zip(worksheets, needs_full) if full]
+    warm = [ws for ws, full in zip(worksheets, needs_full) if not full]
+    results = {}
+    if cold:
+        resp = get_spreadsheet(source_str).values_batch_get([_quote_sheet_title(ws.title) for ws in cold])
+        for ws, vr in zip(cold, resp.get("valueRanges", [])):
+            results[ws.title] = _store_full_sync((source_str, ws.title), vr.get("values", []))
+    if len(warm) == 1:
+        results[warm[0].title] = sync_worksheet_values(warm[0], source_str)
+    elif warm:
+        # 工作執行緒沿用呼叫端的 Session，排程優先權與監控統計才不會被當成背景工作
+        session = get_sheets_metrics().current_session()
+        def sync_one(w):
+            get_sheets_metrics().bind_session(session)
+            return sync_worksheet_values(w, source_str)
+        with ThreadPoolExecutor(max_workers=min(len(warm), SYNC_WORKERS)) as pool:
+            for ws, res in zip(warm, pool.map(sync_one, warm)): results[ws.title] = res
+    return [(ws.title,) + tuple(results[ws.title]) for ws in worksheets if ws.title in results]
+
+# ==========================================
+# [新增] 儲存後端 (Storage Backend)
+# ==========================================
+# storage_backend = "sheets" (預設，直接讀寫 Google Sheets) 或 "local" (本機 SQLite 鏡像 + 背景同步回 Sheets)
+LOCAL_SYNC_SECONDS = 60
+LOCAL_OUTBOX_MAX_ATTEMPTS = 8  # 同一個操作重試這麼多次仍失敗就移到 outbox_dead，不再擋住後面的寫入
+LOCAL_OUTBOX_MAX_BACKOFF = 300
+
+def _rows_to_frame(header, rows):
+    """略過空白列，但 index 保留原本的列位置 (index + 2 = 工作表列號)"""
+    keep = [i for i, r in enumerate(rows) if any(v != "" for v in r)]
+    if not header: return pd.DataFrame()
+    return pd.DataFrame([rows[i] for i in keep], columns=header, index=keep)
+
+class SheetsBackend:
+    """直接讀寫 Google Sheets (原本的行為)"""
+    name = "sheets"
+
+    def read_worksheet(self, source_str, worksheet_name):
+        """回傳 (標題列, 資料列)"""
+        values = with_worksheet(source_str, worksheet_name, lambda ws: ws.get_all_values())
+        if not values: return [], []
+        header = _trim_row(values[0])
+        return header, [_pad_row(r, len(header)) for r in values[1:]]
+
+    def read_transactions(self, source_str, include=None):
+        """回傳 [(分頁名稱, 標題列, 資料列)]，包含所有名稱含 Transaction 的分頁 (include 可再依名稱篩選)"""
+        def _read():
+            shards = [ws for ws in list_worksheets(source_str) if "Transaction" in ws.title and (include is None or include(ws.title))]
+            return sync_worksheets_values(source_str, shards)
+        try: return _read()
+        except gspread.exceptions.APIError as e:
+            # 分頁被刪除或改名 (範圍無效)：重新列出分頁再讀一次
+            if api_status(e) not in (400, 404): raise
+            invalidate_handles(source_str)
+            return _read()
+
+    def append_rows(self, source_str, worksheet_name, rows):
+        with_worksheet(source_str, worksheet_name, lambda ws: ws.append_rows(rows))
+
+    def overwrite_worksheet(self, source_str, worksheet_name, header, rows):
+        def _overwrite(worksheet):
+            worksheet.clear(); worksheet.update(values=[header] + rows)
+        with_worksheet(source_str, worksheet_name, _overwrite)
+
+    def update_cell(self, source_str, worksheet_name, row_no, col_no, value):
+        with_worksheet(source_str, worksheet_name, lambda ws: ws.update_cell(row_no, col_no, value))
+
+    def update_cells(self, source_str, worksheet_name, cells):
+        """cells = [(列號, 欄號, 值)]，合併成一次 batch_update"""
+        updates = [{'range': gspread.utils.rowcol_to_a1(r, c), 'values': [[v]]} for r, c, v in cells]
+        with_worksheet(source_str, worksheet_name, lambda ws: ws.batch_update(updates))
+
+    def delete_row(self, source_str, worksheet_name, row_no):
+        with_worksheet(source_str, worksheet_name, lambda ws: ws.delete_rows(row_no))
+
+    def delete_rows(self, source_str, worksheet_name, row_nos):
+        """一次刪除多個 (不一定相連的) 列：連續的列合併成一段，由下往上刪才不會影響前面的列號"""
+        spans = []
+        for r in sorted(set(row_nos)):
+            if spans and spans[-1][1] == r - 1: spans[-1][1] = r
+            else: spans.append([r, r])
+        def _delete(ws):
+            requests = [{"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": a - 1, "endIndex": b}}} for a, b in reversed(spans)]
+            get_spreadsheet(source_str).batch_update({"requests": requests})
+        if spans: with_worksheet(source_str, worksheet_name, _delete)
+
+class LocalSQLiteBackend:
+    """本機 SQLite 鏡像：讀取走本機，寫入先落地再由背景執行緒同步回 Google Sheets"""
+    name = "local"
+
+    def __init__(self, db_path, remote, sync_interval=LOCAL_SYNC_SECONDS):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.remote = remote
+        self.sync_interval = sync_interval
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sheet_meta (source TEXT, worksheet TEXT, header TEXT, synced_at REAL, PRIMARY KEY (source, worksheet));
+            CREATE TABLE IF NOT EXISTS sheet_rows (source TEXT, worksheet TEXT, row_no INTEGER, data TEXT, PRIMARY KEY (source, worksheet, row_no));
+            CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, worksheet TEXT, op TEXT, payload TEXT);
+            CREATE TABLE IF NOT EXISTS outbox_dead (id INTEGER PRIMARY KEY, source TEXT, worksheet TEXT, op TEXT, payload TEXT, error TEXT, failed_at REAL);
+        """)
+        # 舊版建立的 outbox 沒有重試次數欄位
+        if "attempts" not in [c[1] for c in self.conn.execute("PRAGMA table_info(outbox)")]:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN attempts INTEGER DEFAULT 0")
+        self.conn.commit()
+        self._flush_thread = None
+        self._wake = threading.Event()
+        self._versions = Counter()  # (帳本, 分頁) -> 本機寫入次數；遠端讀取期間有寫入就不拿讀到的舊資料覆蓋
+
+    # --- 本機鏡像 ---
+    def _has_pending(self, source_str, worksheet_name):
+        return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE source = ? AND worksheet = ?", (source_str, worksheet_name)).fetchone()[0] > 0
+
+    def _pending_worksheets(self, source_str):
+        return {w for (w,) in self.conn.execute("SELECT DISTINCT worksheet FROM outbox WHERE source = ?", (source_str,))}
+
+    def _meta(self, source_str, worksheet_name):
+        return self.conn.execute("SELECT header, synced_at FROM sheet_meta WHERE source = ? AND worksheet = ?", (source_str, worksheet_name)).fetchone()
+
+    def _store_mirror(self, source_str, worksheet_name, header, rows):
+        with self.lock:
+            self.conn.execute("DELETE FROM sheet_rows WHERE source = ? AND worksheet = ?", (source_str, worksheet_name))
+            self.conn.executemany("INSERT INTO sheet_rows VALUES (?, ?, ?, ?)",
+                                  [(source_str, worksheet_name, i + 2, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(rows)])
+            self.conn.execute("INSERT OR REPLACE INTO sheet_meta VALUES (?, ?, ?, ?)", (source_str, worksheet_name, json.dumps(header, ensure_ascii=False), time.time()))
+            self.conn.commit()
+
+    def _load_mirror(self, source_str, worksheet_name):
+        with self.lock:
+            meta = self._meta(source_str, worksheet_name)
+            if not meta: return [], []
+            cur = self.conn.execute("SELECT data FROM sheet_rows WHERE source = ? AND worksheet = ? ORDER BY row_no", (source_str, worksheet_name))
+            return json.loads(meta[0]), [json.loads(d) for (d,) in cur]
+
+    def _is_stale(self, source_str, worksheet_name):
+        meta = self._meta(source_str, worksheet_name)
+        return meta is None or time.time() - meta[1] > self.sync_interval
+
+    def _store_if_unchanged(self, source_str, worksheet_name, header, rows, version):
+        """遠端資料讀回來時，該分頁若有新的本機寫入 (不論是否已送出) 就不覆蓋，下次再同步"""
+        with self.lock:
+            if self._versions[(source_str, worksheet_name)] != version or self._has_pending(source_str, worksheet_name): return False
+            self._store_mirror(source_str, worksheet_name, header, rows)
+            return True
+
+    def read_worksheet(self, source_str, worksheet_name):
+        # 鎖只用來判斷要不要更新；讀取遠端時不持有，其他 Session 的本機讀寫不必等網路
+        with self.lock:
+            # 還有未同步的寫入時不從遠端覆蓋，避免本機新資料被舊資料蓋掉
+            refresh = self._is_stale(source_str, worksheet_name) and not self._has_pending(source_str, worksheet_name)
+            version = self._versions[(source_str, worksheet_name)]
+        if refresh:
+            try:
+                header, rows = self.remote.read_worksheet(source_str, worksheet_name)
+                self._store_if_unchanged(source_str, worksheet_name, header, rows, version)
+            except Exception as e: print(f"Local mirror refresh failed: {e}")
+        return self._load_mirror(source_str, worksheet_name)
+
+    def read_transactions(self, source_str, include=None):
+        with self.lock:
+            titles = [t for (t,) in self.conn.execute("SELECT worksheet FROM sheet_meta WHERE source = ? AND worksheet LIKE '%Transaction%'", (source_str,))]
+            titles = [t for t in titles if include is None or include(t)]
+            stale = not titles or any(self._is_stale(source_str, t) for t in titles)
+            # 只看要讀的交易分頁有沒有未同步的寫入，其他分頁的 outbox 不影響
+            pending = [w for w in self._pending_worksheets(source_str) if "Transaction" in w and (include is None or include(w))]
+            versions = dict(self._versions)
+        if stale and not pending:
+            try:
+                shards = self.remote.read_transactions(source_str, include)
+                for title, header, rows in shards: self._store_if_unchanged(source_str, title, header, rows, versions.get((source_str, title), 0))
+                titles = [t for t, _, _ in shards]
+            except Exception as e: print(f"Local mirror refresh failed: {e}")
+        return [(t,) + tuple(self._load_mirror(source_str, t)) for t in titles]
+
+    # --- 寫入：本機先落地，再排入 outbox 由背景同步 ---
+    def _enqueue(self, source_str, worksheet_name, op, payload):
+        self._versions[(source_str, worksheet_name)] += 1
+        self.conn.execute("INSERT INTO outbox (source, worksheet, op, payload) VALUES (?, ?, ?, ?)",
+                          (source_str, worksheet_name, op, json.dumps(payload, ensure_ascii=False)))
+        self.conn.commit()
+        self.start_flush()
+
+    def append_rows(self, source_str, worksheet_name, rows):
+        with self.lock:
+            header, _ = self._load_mirror(source_str, worksheet_name)
+            last = self.conn.execute("SELECT COALESCE(MAX(row_no), 1) FROM sheet_rows WHERE source = ? AND worksheet = ?", (source_str, worksheet_name)).fetchone()[0]
+            width = len(header) if header else max(len(r) for r in rows)
+            self.conn.executemany("INSERT INTO sheet_rows VALUES (?, ?, ?, ?)",
+                                  [(source_str, worksheet_name, last + i + 1, json.dumps(_pad_row([str(v) for v in r], width), ensure_ascii=False)) for i, r in enumerate(rows)])
+            self._enqueue(source_str, worksheet_name, "append_rows", rows)
+
+    def overwrite_worksheet(self, source_str, worksheet_name, header, rows):
+        with self.lock:
+            self._store_mirror(source_str, worksheet_name, header, [[str(v) for v in r] for r in rows])
+            self._enqueue(source_str, worksheet_name, "overwrite_worksheet", {"header": header, "rows": rows})
+
+    def update_cell(self, source_str, worksheet_name, row_no, col_no, value):
+        with self.lock:
+            found = self.conn.execute("SELECT data FROM sheet_rows WHERE source = ? AND worksheet = ? AND row_no = ?", (source_str, worksheet_name, row_no)).fetchone()
+            if found:
+                row = json.loads(found[0]); row = row + [""] * (col_no - len(row)); row[col_no - 1] = str(value)
+                self.conn.execute("UPDATE sheet_rows SET data = ? WHERE source = ? AND worksheet = ? AND row_no = ?", (json.dumps(row, ensure_ascii=False), source_str, worksheet_name, row_no))
+            self._enqueue(source_str, worksheet_name, "update_cell", [row_no, col_no, value])
+
+    def update_cells(self, source_str, worksheet_name, cells):
+        with self.lock:
+            for row_no, col_no, value in cells:
+                found = self.conn.execute("SELECT data FROM sheet_rows WHERE source = ? AND worksheet = ? AND row_no = ?", (source_str, worksheet_name, row_no)).fetchone()
+                if not found: continue
+                row = json.loads(found[0]); row = row + [""] * (col_no - len(row)); row[col_no - 1] = str(value)
+                self.conn.execute("UPDATE sheet_rows SET data = ? WHERE source = ? AND worksheet = ? AND row_no = ?", (json.dumps(row, ensure_ascii=False), source_str, worksheet_name, row_no))
+            self._enqueue(source_str, worksheet_name, "update_cells", [list(c) for c in cells])
+
+    def delete_row(self, source_str, worksheet_name, row_no):
+        with self.lock:
+            self.conn.execute("DELETE FROM sheet_rows WHERE source = ? AND worksheet = ? AND row_no = ?", (source_str, worksheet_name, row_no))
+            self.conn.execute("UPDATE sheet_rows SET row_no = row_no - 1 WHERE source = ? AND worksheet = ? AND row_no > ?", (source_str, worksheet_name, row_no))
+            self._enqueue(source_str, worksheet_name, "delete_row", [row_no])
+
+    def mark_stale(self, source_str):
+        """遠端被其他流程 (例如年度封存) 直接改過，下次讀取時重新鏡像"""
+        with self.lock:
+            self.conn.execute("UPDATE sheet_meta SET synced_at = 0 WHERE source = ?", (source_str,)); self.conn.commit()
+
+    # --- 背景同步 ---
+    def pending_count(self, source_str=None):
+        with self.lock:
+            if source_str: return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE source = ?", (source_str,)).fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def dead_count(self):
+        with self.lock: return self.conn.execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+
+    def start_flush(self):
+        self._wake.set()
+        if self._flush_thread and self._flush_thread.is_alive(): return
+        self._flush_thread = threading.Thread(target=self.flush_outbox, daemon=True)
+        self._flush_thread.start()
+
+    def _push(self, source_str, worksheet_name, op, payload):
+        if op == "append_rows": self.remote.append_rows(source_str, worksheet_name, payload)
+        elif op == "overwrite_worksheet": self.remote.overwrite_worksheet(source_str, worksheet_name, payload["header"], payload["rows"])
+        elif op == "update_cell": self.remote.update_cell(source_str, worksheet_name, *payload)
+        elif op == "update_cells": self.remote.update_cells(source_str, worksheet_name, payload)
+        elif op == "delete_row": self.remote.delete_row(source_str, worksheet_name, *payload)
+
+    def _dead_letter(self, item_id, source_str, worksheet_name, error):
+        """移到 outbox_dead，並讓該分頁的鏡像下次讀取時改用遠端資料 (放棄本機這筆改動)"""
+        self.conn.execute("INSERT OR REPLACE INTO outbox_dead SELECT id, source, worksheet, op, payload, ?, ? FROM outbox WHERE id = ?", (error, time.time(), item_id))
+        self.conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+        self.conn.execute("UPDATE sheet_meta SET synced_at = 0 WHERE source = ? AND worksheet = ?", (source_str, worksheet_name))
+
+    def flush_outbox(self):
+        """把 outbox 推送到 Google Sheets：同一分頁依序送出，某個分頁失敗時只有該分頁退避重試，其他分頁照常同步"""
+        retry_at = {}  # (帳本, 分頁) -> 下次可以重試的時間
+        while True:
+            self._wake.clear()
+            with self.lock:
+                items = self.conn.execute("SELECT id, source, worksheet, op, payload, attempts FROM outbox ORDER BY id").fetchall()
+            if not items:
+                if self._wake.is_set(): continue
+                return
+            now = time.time(); blocked = set()
+            for item_id, source_str, worksheet_name, op, payload, attempts in items:
+                group = (source_str, worksheet_name)
+                # 後面同一分頁的操作要等前面的成功才能送 (列號有先後關係)
+                if group in blocked or retry_at.get(group, 0) > now: blocked.add(group); continue
+                try: self._push(source_str, worksheet_name, op, json.loads(payload))
+                except Exception as e:
+                    get_sheets_metrics().record_error(source_str, f"local_outbox:{op} {worksheet_name}", e)
+                    attempts = (attempts or 0) + 1
+                    with self.lock:
+                        if attempts >= LOCAL_OUTBOX_MAX_ATTEMPTS: self._dead_letter(item_id, source_str, worksheet_name, str(e))
+                        else: self.conn.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (attempts, item_id))
+                        self.conn.commit()
+                    retry_at[group] = time.time() + min(LOCAL_OUTBOX_MAX_BACKOFF, 2 ** attempts)
+                    blocked.add(group)
+                    continue
+                retry_at.pop(group, None)
+                with self.lock:
+                    self.conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,)); self.conn.commit()
+            if not blocked: continue
+            # 等到最早可以重試的分頁；有新的寫入時提早醒來
+            waits = [t - time.time() for g, t in retry_at.items() if g in blocked]
+            self._wake.wait(max(min(waits), 0.05) if waits else 1)
+
+@st.cache_resource
+def get_storage_backend():
+    remote = SheetsBackend()
+    if st.secrets.get("storage_backend", "sheets") == "local":
+        backend = LocalSQLiteBackend(os.path.join(LOCAL_DATA_DIR, "ledger.db"), remote)
+        backend.start_flush()  # 重啟後先把上次沒送完的寫入補送
+        return backend
+    return remote
+
+# ==========================================
+# [新增] 帳本快取 (依 帳本 + 分頁 精準失效)
+# ==========================================
+# 取代 st.cache_data.clear()：寫入只會失效自己碰到的 (帳本, 分頁)，不影響匯率快取與其他使用者的帳本
+TX_CACHE_KEY = "*Transactions"  # 使用中 (未封存) 的 Transaction 分頁合併後的資料
+CUBE_CACHE_KEY = "*MonthlyCube"  # 月份彙總 (使用中分頁 + 往年封存摘要，新增交易時增量更新)
+ARCHIVE_CUBE_KEY = "*ArchiveCube"  # 往年封存分頁的月份彙總
+ARCHIVE_YEARS_KEY = "*ArchiveYears"  # 已存在的 Transactions_YYYY 年度
+ARCHIVE_SHARD_RE = re.compile(r"^Transactions_(\d{4})$")
+TX_COLUMNS = ["Date", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Amount_Original", "Amount_Def", "Note", "Created_At", "Recorder"]
+# 快取上限：超過筆數或總大小時先丟最久沒用到的；超過 TTL 或閒置太久的項目定期清掉 (封存年度沒有 TTL，只會因閒置被清)
+BOOK_CACHE_MAX_ENTRIES = 256
+BOOK_CACHE_MAX_BYTES = 512 * 2**20
+BOOK_CACHE_IDLE_SECONDS = 3600
+BOOK_CACHE_SWEEP_SECONDS = 60
+
+@st.cache_resource
+def get_book_cache():
+    """跨 Session 共用：{(帳本來源, 分頁名稱): {"value": DataFrame, "at": 載入時間, "ttl", "used": 最後使用時間, "bytes"}}
+    entries 依最後使用的先後排列 (最舊的在前面)"""
+    return {"lock": threading.Lock(), "entries": {}, "swept_at": 0}
+
+def _cache_bytes(value):
+    """DataFrame 以實際記憶體計算；其他 (彙總用的 dict) 很小，不計"""
+    return int(value.memory_usage(index=True, deep=True).sum()) if isinstance(value, pd.DataFrame) else 0
+
+def _sweep_book_cache(cache, now, keep=None):
+    """呼叫端持有 cache["lock"]：清掉過期 / 閒置的項目，再依 LRU 降到上限以內 (keep 是剛放進去的，不清)"""
+    entries = cache["entries"]
+    for key in [k for k, e in entries.items() if k != keep and (now - e["at"] > e["ttl"] or now - e["used"] > BOOK_CACHE_IDLE_SECONDS)]:
+        del entries[key]
+    total = sum(e["bytes"] for e in entries.values())
+    for key in list(entries):
+        if len(entries) <= BOOK_CACHE_MAX_ENTRIES and total <= BOOK_CACHE_MAX_BYTES: break
+        if key == keep: continue
+        total -= entries.pop(key)["bytes"]
+    cache["swept_at"] = now
+
+def cached_entry(source_str, worksheet_name, ttl, loader):
+    """回傳快取項目本身 (不複製)；過期或不存在才呼叫 loader，loader 發生例外不寫入快取"""
+    cache = get_book_cache()
+    key = (source_str, worksheet_name)
+    now = time.time()
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        hit = entry is not None and now - entry["at"] <= ttl
+        if hit:
+            # 移到最後面 = 最近用過
+            cache["entries"][key] = cache["entries"].pop(key); entry["used"] = now
+            if now - cache["swept_at"] > BOOK_CACHE_SWEEP_SECONDS: _sweep_book_cache(cache, now, keep=key)
+    get_sheets_metrics().record_cache(source_str, hit)
+    if not hit:
+        value = loader()
+        now = time.time()
+        entry = {"value": value, "at": now, "ttl": ttl, "used": now, "bytes": _cache_bytes(value)}
+        with cache["lock"]:
+            cache["entries"].pop(key, None); cache["entries"][key] = entry
+            _sweep_book_cache(cache, now, keep=key)
+    return entry
+
+def cached_frame(source_str, worksheet_name, ttl, loader):
+    """命中就回傳副本 (呼叫端可以安心修改)"""
+    return cached_entry(source_str, worksheet_name, ttl, loader)["value"].copy()
+
+def archive_year_of(title):
+    """Transactions_YYYY -> YYYY，其他分頁回傳 None"""
+    m = ARCHIVE_SHARD_RE.match(title)
+    return int(m.group(1)) if m else None
+
+def invalidate_book_cache(source_str, worksheet_name=None):
+    """只清掉指定帳本 (與分頁) 的快取；寫入 Transaction 分頁時連同合併資料一起失效"""
+    cache = get_book_cache()
+    with cache["lock"]:
+        for key in list(cache["entries"].keys()):
+            if key[0] != source_str: continue
+            if worksheet_name is None or key[1] == worksheet_name or ("Transaction" in worksheet_name and (key[1] == TX_CACHE_KEY or key[1].startswith(CUBE_CACHE_KEY))):
+                del cache["entries"][key]
+
+def get_transactions_header(source_str):
+    """主要 Transactions 分頁的標題列 (取自同步狀態)，尚未同步過就用預設欄位順序"""
+    registry = get_sheet_sync_registry()
+    with registry["lock"]: state = registry["sheets"].get((source_str, "Transactions"))
+    return state["header"] if state and state["header"] else TX_COLUMNS
+
+def patch_cached_transactions(source_str, rows, header=None):
+    """把剛寫入的交易直接接到快取中的 DataFrame 後面，不必重新下載整本帳"""
+    header = header or get_transactions_header(source_str)
+    cache = get_book_cache()
+    key = (source_str, TX_CACHE_KEY)
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        cache["entries"].pop((source_str, "Transactions"), None)
+        if entry is None: return
+        new_df = build_transaction_frame(rows_to_columns(header, [_pad_row([str(v) for v in r], len(header)) for r in rows]))
+        # 類別不同的 category 欄位合併後會退回 object，重新轉一次
+        old_df = entry["value"]
+        entry["value"] = _categorize_transactions(pd.concat([old_df, new_df], ignore_index=True)) if not old_df.empty else new_df
+        entry["bytes"] += _cache_bytes(new_df)  # 約略值，下次重新載入時重算
+        # 搜尋索引只加入新的列
+        index = entry.get("search_index")
+        if index is not None and index.df is old_df: index.extend(new_df, entry["value"])
+        delta = build_monthly_cube(new_df)
+        cube_entry = cache["entries"].get((source_str, CUBE_CACHE_KEY))
+        if cube_entry is not None: cube_entry["value"] = merge_monthly_cube(cube_entry["value"], delta)
+        # 預算的累計支出也只加上新的交易
+        spend_entry = cache["entries"].get((source_str, BUDGET_SPEND_KEY))
+        if spend_entry is not None: add_cube_to_spend(spend_entry["value"], delta)
+        # 其他顯示幣別的彙總直接丟掉，下次查看時重算
+        for key in [k for k in cache["entries"] if k[0] == source_str and k[1].startswith(CUBE_CACHE_KEY + ":")]: del cache["entries"][key]
+
+# 交易資料集的統一格式：各分頁共用，Tab 1 / Tab 2 與之後的報表都讀同一份
+TX_CATEGORY_COLUMNS = ["Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Recorder"]
+TX_AMOUNT_COLUMNS = ["Amount_Original", "Amount_Def"]
+
+def _categorize_transactions(df):
+    """重複值多的文字欄位轉成 category (合併後類別不一致退回 object 時也用這個轉回來)"""
+    for col in TX_CATEGORY_COLUMNS + ["Month"]:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("object").where(df[col].notna(), "").astype("category")
+    return df
+
+def _parse_tx_dates(values):
+    """先用固定格式快速解析，少數其他寫法 (例如 2024/1/5) 再逐筆判斷"""
+    dates = pd.to_datetime(pd.Series(values, dtype="object"), format="%Y-%m-%d", errors="coerce")
+    retry = dates.isna().to_numpy() & np.array([bool(v) for v in values], dtype=bool)
+    if retry.any(): dates[retry] = pd.to_datetime(pd.Series(values, dtype="object")[retry], format="mixed", errors="coerce")
+    return dates
+
+def build_transaction_frame(columns):
+    """{欄位名稱: 原始字串 list} -> 精簡型別的交易 DataFrame
+    文字欄位用 category、金額 float64、日期 datetime64、月份用 int32 的 Month_Code (year*12 + month-1，無日期為 -1)"""
+    n = len(next(iter(columns.values()))) if columns else 0
+    if n == 0: return pd.DataFrame()
+    data = {}
+    for name, values in columns.items():
+        if name == "Date": data[name] = _parse_tx_dates(values)
+        elif name in TX_AMOUNT_COLUMNS:
+            data[name] = pd.to_numeric(pd.Series(values, dtype="object").astype(str).str.replace(",", ""), errors="coerce").fillna(0).astype("float64")
+        elif name in TX_CATEGORY_COLUMNS: data[name] = pd.Categorical(values)
+        else: data[name] = pd.Series(values, dtype="object")
+    for col in ["Recorder", "Type"]:
+        if col not in data: data[col] = pd.Categorical([""] * n)
+    df = pd.DataFrame(data)
+    if "Date" not in df.columns: df["Date"] = pd.Series(pd.NaT, index=df.index, dtype="datetime64[ns]")
+    has_date = df["Date"].notna()
+    codes = np.full(n, -1, dtype=np.int32)
+    codes[has_date.to_numpy()] = (df["Date"].dt.year[has_date] * 12 + df["Date"].dt.month[has_date] - 1).to_numpy(dtype=np.int32)
+    df["Month_Code"] = codes
+    df["Year"] = pd.Series(np.where(codes >= 0, codes // 12, 0), dtype="int16").where(has_date)
+    # Month 標籤只需要對每個不重複的月份格式化一次
+    uniq = np.unique(codes)
+    labels = {c: (f"{c // 12:04d}-{c % 12 + 1:02d}" if c >= 0 else "") for c in uniq}
+    df["Month"] = pd.Categorical.from_codes(np.searchsorted(uniq, codes), categories=[labels[c] for c in uniq]) if len(set(labels.values())) == len(uniq) else pd.Categorical([labels[c] for c in codes])
+    return df
+
+def rows_to_columns(header, rows, columns=None):
+    """列資料直接轉成欄位 list (略過空白列)，可以累加到既有的 columns 上"""
+    columns = {} if columns is None else columns
+    rows = [r for r in rows if any(v != "" for v in r)]
+    existing = len(next(iter(columns.values()))) if columns else 0
+    for name in header:
+        if name and name not in columns: columns[name] = [""] * existing
+    for i, name in enumerate(header):
+        if name: columns[name].extend(r[i] if i < len(r) else "" for r in rows)
+    for name, values in columns.items():
+        if name not in header: values.extend([""] * len(rows))
+    return columns
+
+def _load_worksheet_frame(source_str, worksheet_name):
+    header, rows = get_storage_backend().read_worksheet(source_str, worksheet_name)
+    df = _rows_to_frame(header, rows)
+    if worksheet_name == "Settings":
+        for col in ["Main_Category", "Sub_Category", "Payment_Method", "Currency", "Default_Currency"]:
+            if col not in df.columns: df[col] = ""
+    if worksheet_name == "Recurring":
+        for col in ["Day", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Amount_Original", "Note", "Last_Run_Month"]:
+            if col not in df.columns: df[col] = ""
+    if not df.empty: df = df.dropna(how='all')
+    return df
+
 def get_data(worksheet_name, source_str):
-    client = get_gspread_client()
-    try:
-        sheet = open_spreadsheet(client, source_str)
-        worksheet = sheet.worksheet(worksheet_name)
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        if worksheet_name == "Settings":
-            for col in ["Main_Category", "Sub_Category", "Payment_Method", "Currency", "Default_Currency"]:
-                if col not in df.columns: df[col] = ""
-        if worksheet_name == "Recurring":
-            for col in ["Day", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Amount_Original", "Note", "Last_Run_Month"]:
-                if col not in df.columns: df[col] = ""
-        if not df.empty: df = df.dropna(how='all')
-        return df
+    try: return cached_frame(source_str, worksheet_name, 300, lambda: _load_worksheet_frame(source_str, worksheet_name))
     except: return pd.DataFrame()
 
-@st.cache_data(ttl=60)  # 將快取縮短為 60 秒，讓同步更快
+def _load_current_transactions(source_str):
+    # 各分頁直接合併成欄位 list，最後只做一次型別轉換 (不經過 list of dict，也避免 category 合併退化)
+    # 已封存的 Transactions_YYYY 不在這裡讀，改由 get_archived_transactions 個別快取
+    columns = {}
+    for _, header, rows in get_storage_backend().read_transactions(source_str, include=lambda t: archive_year_of(t) is None):
+        rows_to_columns(header, rows, columns)
+    # 尚未同步到 Sheets 的新交易也要算進去 (先讀 Sheets 再取佇列，寧可暫時少算也不要重複)
+    pending = get_write_queue().pending_rows(source_str, "Transactions")
+    if pending:
+        header = get_transactions_header(source_str)
+        rows_to_columns(header, [_pad_row([str(v) for v in r], len(header)) for r in pending], columns)
+    return build_transaction_frame(columns)
+
+# ==========================================
+# [新增] 月份彙總 Cube (月份 × 收支 × 大類 × 子類 × 付款方式 × 記錄者)
+# ==========================================
+CUBE_DIMENSIONS = ["Month", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Recorder"]
+
+def build_monthly_cube(df_tx):
+    """交易明細 -> 彙總表 (Amount 加總、Count 筆數)；之後畫面只讀這張表，成本只跟月份數有關"""
+    if df_tx.empty or "Month" not in df_tx.columns: return pd.DataFrame(columns=CUBE_DIMENSIONS + ["Amount", "Count"])
+    df = df_tx.reindex(columns=CUBE_DIMENSIONS + ["Amount_Def"])
+    df = df[(df_tx["Month_Code"] >= 0).to_numpy()] if "Month_Code" in df_tx.columns else df[df["Month"].notna() & (df["Month"] != "")]
+    for col in CUBE_DIMENSIONS[1:]:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype): df[col] = df[col].fillna("").astype(str)
+    return df.groupby(CUBE_DIMENSIONS, observed=True)["Amount_Def"].agg(Amount="sum", Count="count").reset_index()
+
+def merge_monthly_cube(cube, delta):
+    if delta.empty: return cube
+    if cube.empty: return delta
+    return pd.concat([cube, delta], ignore_index=True).groupby(CUBE_DIMENSIONS, observed=True)[["Amount", "Count"]].sum().reset_index()
+
+def get_monthly_cube(source_str):
+    # 使用中分頁重新彙總，往年直接用封存摘要
+    try: return cached_frame(source_str, CUBE_CACHE_KEY, 60, lambda: merge_monthly_cube(build_monthly_cube(get_current_transactions(source_str)), get_archive_cube(source_str)))
+    except Exception as e:
+        print(f"Error building monthly cube: {e}")
+        return build_monthly_cube(pd.DataFrame())
+
+def cube_month_totals(cube, month_str):
+    """回傳 (收入, 支出)"""
+    m = cube[cube["Month"] == month_str]
+    return m.loc[m["Type"] == "收入", "Amount"].sum(), m.loc[m["Type"] != "收入", "Amount"].sum()
+
+def _current_entry(source_str):
+    # 將快取縮短為 60 秒，讓同步更快 (過期後只做增量同步)
+    return cached_entry(source_str, TX_CACHE_KEY, 60, lambda: _load_current_transactions(source_str))
+
+def get_current_transactions(source_str):
+    try: return _current_entry(source_str)["value"].copy()
+    except Exception as e:
+        print(f"Error fetching transactions: {e}")
+        return pd.DataFrame()
+
 def get_all_transactions(source_str):
-    client = get_gspread_client()
-    all_data = []
+    return query_transactions(source_str)
+
+# ==========================================
+# [新增] 區間查詢 (只取需要的月份與欄位)
+# ==========================================
+def month_code_of(value):
+    """'YYYY-MM' / 'YYYY-MM-DD' / date -> year*12 + month-1 (與 Month_Code 相同)"""
+    if isinstance(value, (int, np.integer)): return int(value)
+    if isinstance(value, (date, datetime)): return value.year * 12 + value.month - 1
+    y, m = str(value)[:7].split("-")
+    return int(y) * 12 + int(m) - 1
+
+def _slice_months(entry, start_code, end_code, columns=None):
+    """用依 Month_Code 排序的位置索引切出區間 (索引跟著快取項目，資料更新後第一次查詢才重建)"""
+    df = entry["value"]
+    if df.empty or "Month_Code" not in df.columns: return df.iloc[0:0]
+    index = entry.get("month_order")
+    if index is None or index[0] is not df:
+        codes = df["Month_Code"].to_numpy()
+        order = np.argsort(codes, kind="stable")
+        index = (df, order, codes[order])
+        entry["month_order"] = index
+    _, order, sorted_codes = index
+    lo, hi = np.searchsorted(sorted_codes, [start_code, end_code + 1])
+    cols = [c for c in columns if c in df.columns] if columns else list(df.columns)
+    return df.iloc[np.sort(order[lo:hi]), [df.columns.get_loc(c) for c in cols]]
+
+def query_transactions(source_str, start=None, end=None, columns=None):
+    """查詢 start ~ end 月份 (含頭尾，None 表示不限) 的交易；只會載入區間涵蓋到的年度封存分頁
+    columns 指定要回傳的欄位，其餘欄位不複製"""
+    start_code = month_code_of(start) if start is not None else 0
+    end_code = month_code_of(end) if end is not None else np.iinfo(np.int32).max - 1
     try:
-        sheet = open_spreadsheet(client, source_str)
-        for ws in sheet.worksheets():
-            # 修改判定：只要分頁名稱包含 "Transaction" 就抓取
-            if "Transaction" in ws.title:
-                data = ws.get_all_records()
-                if data: all_data.extend(data)
-        
-        df = pd.DataFrame(all_data)
-        if not df.empty:
-            df = df.dropna(how='all')
-            # 確保日期格式正確
-            df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
-            # 確保金額是數字，處理可能出現的逗號或非數字字元
-            df['Amount_Def'] = pd.to_numeric(df['Amount_Def'], errors='coerce').fillna(0)
-            df['Year'] = df['Date'].dt.year
-            df['Month'] = df['Date'].dt.strftime('%Y-%m')
-            if "Recorder" not in df.columns: df["Recorder"] = ""
-            if "Type" not in df.columns: df["Type"] = ""
-        return df
+        frames = [_slice_months(_current_entry(source_str), start_code, end_code, columns)]
+        for y in list_archived_years(source_str):
+            if start_code // 12 <= y <= end_code // 12:
+                frames.append(_slice_months(_archived_entry(source_str, y), start_code, end_code, columns))
     except Exception as e:
-        print(f"Error fetching transactions: {e}")
+        print(f"Error querying transactions: {e}")
         return pd.DataFrame()
+    frames = [f for f in frames if not f.empty]
+    if not frames: return pd.DataFrame(columns=columns) if columns else pd.DataFrame()
+    if len(frames) == 1: return frames[0].reset_index(drop=True)
+    return _categorize_transactions(pd.concat(frames, ignore_index=True))
+
+def get_display_cube(source_str, currency):
+    """用 Amount_Original / Currency 依交易日匯率換算成 currency 的月份彙總 (不依賴已存的 Amount_Def)"""
+    def _load():
+        df = query_transactions(source_str, columns=CUBE_DIMENSIONS + ["Date", "Amount_Original", "Currency"])
+        if df.empty: return build_monthly_cube(df)
+        df["Amount_Def"] = convert_amounts(df["Amount_Original"].to_numpy(), df["Currency"].astype(str).to_numpy(), currency, dates=df["Date"])
+        return build_monthly_cube(df)
+    try: return cached_frame(source_str, f"{CUBE_CACHE_KEY}:{currency}", 60, _load)
+    except Exception as e:
+        print(f"Error building {currency} cube: {e}")
+        return build_monthly_cube(pd.DataFrame())
+
+def get_month_index(source_str):
+    """有資料的月份與筆數 (由月份彙總而來，不必掃描交易明細)"""
+    cube = get_monthly_cube(source_str)
+    if cube.empty: return pd.DataFrame(columns=["Month", "Count"])
+    counts = cube.groupby(cube["Month"].astype(str), observed=True)["Count"].sum()
+    counts = counts[counts.index != ""]
+    return counts.sort_index().rename_axis("Month").reset_index()
+
+# ==========================================
+# [新增] 每月預算 (各類別累計支出增量維護 + 超支提醒)
+# ==========================================
+BUDGET_SHEET = "Budgets"
+BUDGET_COLUMNS = ["Month", "Main_Category", "Sub_Category", "Amount", "Alert_Ratio"]
+BUDGET_DEFAULT_ALERT = 0.8
+# 以 CUBE_CACHE_KEY 開頭：交易分頁被修改 / 刪除時跟月份彙總一起失效，新增交易時在 patch_cached_transactions 增量累加
+BUDGET_SPEND_KEY = CUBE_CACHE_KEY + "#BudgetSpend"
+
+def add_cube_to_spend(spend, cube):
+    """把月份彙總的支出累加到 {月份: Counter{(大類, 子類): 金額}}；(大類, "") 是整個大類的合計"""
+    exp = cube[(cube["Type"].astype(str) != "收入").to_numpy()]
+    if exp.empty: return spend
+    groups = exp.groupby([exp["Month"].astype(str), exp["Main_Category"].astype(str), exp["Sub_Category"].astype(str)])["Amount"].sum()
+    for (month, main, sub), amount in groups.items():
+        bucket = spend.setdefault(month, Counter())
+        bucket[(main, "")] += float(amount)
+        if sub: bucket[(main, sub)] += float(amount)
+    return spend
+
+def _budget_spend_entry(source_str):
+    # 只在快取不存在時從月份彙總建立一次 (成本與月份 × 類別數有關，不必掃描交易明細)
+    return cached_entry(source_str, BUDGET_SPEND_KEY, 60, lambda: add_cube_to_spend({}, get_monthly_cube(source_str)))
+
+def _load_budget_frame(source_str):
+    # 還沒設定過預算時分頁不存在，快取空表，避免每次畫面更新都去問一次 Sheets
+    try: return _load_worksheet_frame(source_str, BUDGET_SHEET)
+    except gspread.exceptions.WorksheetNotFound: return pd.DataFrame(columns=BUDGET_COLUMNS)
+
+def load_budget_table(source_str):
+    """Budgets 分頁 -> 固定欄位的 DataFrame (Amount / Alert_Ratio 轉成數字)"""
+    try: df = cached_frame(source_str, BUDGET_SHEET, 300, lambda: _load_budget_frame(source_str))
+    except: df = pd.DataFrame()
+    df = df.reindex(columns=BUDGET_COLUMNS).fillna("")
+    for col in ["Month", "Main_Category", "Sub_Category"]: df[col] = df[col].astype(str).str.strip()
+    df["Amount"] = pd.to_numeric(df["Amount"], errors="coerce").fillna(0.0)
+    # 提醒比例一律是 0~1 的比例 (與設定頁的編輯器相同)；空白或超出範圍的用預設值
+    ratio = pd.to_numeric(df["Alert_Ratio"], errors="coerce")
+    df["Alert_Ratio"] = ratio.where((ratio > 0) & (ratio <= 1), BUDGET_DEFAULT_ALERT)
+    return df.reset_index(drop=True)
+
+def save_budgets(budget_df, source_str):
+    try:
+        df = budget_df.reindex(columns=BUDGET_COLUMNS).fillna("")
+        df = df[df["Main_Category"].astype(str).str.strip() != ""]
+        # 第一次使用時分頁還不存在，先建立
+        get_worksheet(source_str, BUDGET_SHEET, create_header=BUDGET_COLUMNS)
+        get_storage_backend().overwrite_worksheet(source_str, BUDGET_SHEET, BUDGET_COLUMNS, df.values.tolist())
+        invalidate_book_cache(source_str, BUDGET_SHEET)
+        return True
+    except: return False
+
+def get_budget_status(source_str, month_str):
+    """本月各預算的使用狀況 (依使用比例由高到低)；只查表，成本只跟預算項目數有關"""
+    budgets = load_budget_table(source_str)
+    if budgets.empty: return []
+    applied = {}
+    for rec in budgets.to_dict("records"):
+        month = rec["Month"] or "*"
+        key = (rec["Main_Category"], rec["Sub_Category"])
+        if month not in ("*", month_str) or not key[0] or rec["Amount"] <= 0: continue
+        # 指定月份的設定優先於每月通用 (*) 的設定
+        if month == "*" and key in applied: continue
+        applied[key] = rec
+    if not applied: return []
+    try:
+        entry = _budget_spend_entry(source_str)
+        with get_book_cache()["lock"]: spent_map = dict(entry["value"].get(month_str, {}))
+    except Exception as e:
+        print(f"Error loading budget spend: {e}")
+        spent_map = {}
+    status = []
+    for (main, sub), rec in applied.items():
+        alert = rec["Alert_Ratio"]
+        spent = spent_map.get((main, sub), 0.0); ratio = spent / rec["Amount"]
+        level = "over" if ratio >= 1 else "warn" if ratio >= alert else "ok"
+        status.append({"Main_Category": main, "Sub_Category": sub, "Budget": rec["Amount"], "Spent": spent, "Ratio": ratio, "Alert_Ratio": alert, "Level": level})
+    return sorted(status, key=lambda b: -b["Ratio"])
+
+# ==========================================
+# [新增] 交易搜尋 (反向索引 + 金額 / 日期排序索引)
+# ==========================================
+SEARCH_TEXT_COLUMNS = ["Note", "Main_Category", "Sub_Category", "Payment_Method", "Recorder", "Type"]
+SEARCH_FACET_COLUMNS = ["Type", "Main_Category", "Payment_Method", "Recorder"]
+SEARCH_TOKEN_RE = re.compile(r"[0-9a-z]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+SEARCH_RESULT_LIMIT = 200
+SEARCH_REBUILD_RATIO = 0.2  # 增量加入的列超過基底的這個比例就整個重建
+SEARCH_NO_DATE = np.iinfo(np.int64).min
+
+def _search_runs(text):
+    """全形轉半形、轉小寫後切成英數字串與中日文字串"""
+    return SEARCH_TOKEN_RE.findall(unicodedata.normalize("NFKC", str(text)).lower())
+
+def search_tokens(text):
+    """建索引用：英數整個字，中日文用單字 + 相鄰兩字 (bigram)"""
+    tokens = set()
+    for run in _search_runs(text):
+        if run.isascii(): tokens.add(run)
+        else:
+            tokens.update(run)
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def search_query_terms(text):
+    """查詢用：回傳 [(詞, 是否前綴比對)]；英數用前綴 (邊打字邊查)，中日文兩字以上只用 bigram"""
+    terms = []
+    for run in _search_runs(text):
+        if run.isascii(): terms.append((run, True))
+        elif len(run) == 1: terms.append((run, False))
+        else: terms.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return list(dict.fromkeys(terms))
+
+def _date_days(dates):
+    """datetime64 -> 自 1970 起的天數，沒有日期為 SEARCH_NO_DATE"""
+    days = dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]").astype(np.int64)
+    days[dates.isna().to_numpy()] = SEARCH_NO_DATE
+    return days
+
+class TransactionSearchIndex:
+    """單一交易 DataFrame 的搜尋索引 (跟著快取項目，和 month_order 一樣)
+    - 文字欄位：每個不重複值只斷詞一次，詞 -> [(欄位, 值編號)]；值編號 -> 列號用排序後的位置表 (CSR)
+    - 金額 / 日期：排序後的值 + 列號，範圍查詢用 searchsorted
+    - 新增的交易 (patch_cached_transactions) 用 extend 增量加入，累積太多才重建"""
+
+    def __init__(self, df):
+        self.lock = threading.Lock()
+        self.df = df
+        self.n = len(df)
+        self.base_n = self.n
+        self.value_ids = {}  # 欄位 -> {值: 編號}
+        self.codes = {}  # 欄位 -> 每列的值編號
+        self.by_value = {}  # 欄位 -> (依值編號排序的列號, 每個值的起點)
+        self.extra_rows = {}  # (欄位, 值編號) -> [增量加入的列號]
+        self.postings = {}  # 詞 -> set((欄位, 值編號))
+        self.terms = []  # 排序後的所有詞 (前綴查詢)
+        for col in SEARCH_TEXT_COLUMNS:
+            values = df[col].astype("object").where(df[col].notna(), "").astype(str) if col in df.columns else pd.Series([""] * self.n)
+            codes, uniques = pd.factorize(values.to_numpy(), sort=False)
+            codes = codes.astype(np.int32)
+            self.codes[col] = codes
+            self.value_ids[col] = {v: i for i, v in enumerate(uniques)}
+            order = np.argsort(codes, kind="stable")
+            self.by_value[col] = (order, np.searchsorted(codes[order], np.arange(len(uniques) + 1)))
+            for i, v in enumerate(uniques): self._register(col, i, v)
+        self.terms = sorted(self.postings)
+        self.amounts = df["Amount_Def"].to_numpy(dtype="float64") if "Amount_Def" in df.columns else np.zeros(self.n)
+        self.days = _date_days(df["Date"]) if "Date" in df.columns else np.full(self.n, SEARCH_NO_DATE, dtype=np.int64)
+        self.amount_order = np.argsort(self.amounts, kind="stable"); self.amount_sorted = self.amounts[self.amount_order]
+        self.day_order = np.argsort(self.days, kind="stable"); self.day_sorted = self.days[self.day_order]
+
+    def _register(self, col, value_id, value):
+        for token in search_tokens(value): self.postings.setdefault(token, set()).add((col, value_id))
+
+    def extend(self, new_df, full_df):
+        """full_df = 原本的列 + new_df (順序不變)"""
+        with self.lock:
+            offset = self.n
+            added_terms = False
+            for col in SEARCH_TEXT_COLUMNS:
+                values = new_df[col].astype("object").where(new_df[col].notna(), "").astype(str).tolist() if col in new_df.columns else [""] * len(new_df)
+                ids = self.value_ids[col]
+                codes = []
+                for i, v in enumerate(values):
+                    vid = ids.get(v)
+                    if vid is None:
+                        vid = ids[v] = len(ids)
+                        self._register(col, vid, v); added_terms = True
+                    codes.append(vid)
+                    self.extra_rows.setdefault((col, vid), []).append(offset + i)
+                self.codes[col] = np.concatenate([self.codes[col], np.array(codes, dtype=np.int32)])
+            if added_terms: self.terms = sorted(self.postings)
+            self.amounts = np.concatenate([self.amounts, new_df["Amount_Def"].to_numpy(dtype="float64") if "Amount_Def" in new_df.columns else np.zeros(len(new_df))])
+            self.days = np.concatenate([self.days, _date_days(new_df["Date"]) if "Date" in new_df.columns else np.full(len(new_df), SEARCH_NO_DATE, dtype=np.int64)])
+            self.n += len(new_df)
+            self.df = full_df
+
+    def needs_rebuild(self):
+        return self.n - self.base_n > max(1000, self.base_n * SEARCH_REBUILD_RATIO)
+
+    def _value_rows(self, col, value_id):
+        order, starts = self.by_value[col]
+        base = order[starts[value_id]:starts[value_id + 1]] if value_id + 1 < len(starts) else order[0:0]
+        extra = self.extra_rows.get((col, value_id))
+        return np.concatenate([base, np.array(extra, dtype=order.dtype)]) if extra else base
+
+    def _term_rows(self, term, prefix):
+        keys = set()
+        if prefix:
+            i = bisect.bisect_left(self.terms, term)
+            while i < len(self.terms) and self.terms[i].startswith(term):
+                keys |= self.postings[self.terms[i]]; i += 1
+        else: keys = self.postings.get(term, set())
+        if not keys: return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate([self._value_rows(col, vid) for col, vid in keys]))
+
+    def _range_rows(self, values, order, sorted_values, lo, hi):
+        """基底用排序索引切範圍，增量加入的列直接比對"""
+        rows = order[np.searchsorted(sorted_values, lo, side="left"):np.searchsorted(sorted_values, hi, side="right")]
+        if self.n > self.base_n:
+            tail = np.arange(self.base_n, self.n)
+            rows = np.concatenate([rows, tail[(values[self.base_n:] >= lo) & (values[self.base_n:] <= hi)]])
+        return np.sort(rows)
+
+    def search(self, text="", amount_range=None, day_range=None, facets=None):
+        """回傳符合條件的列號 (遞增)；先用最有選擇性的索引取候選，其餘條件只在候選上比對"""
+        with self.lock:
+            terms = search_query_terms(text)
+            candidates = None
+            for term, prefix in terms:
+                rows = self._term_rows(term, prefix)
+                candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+                if len(candidates) == 0: return candidates
+            amounts = self.amounts[:self.n]; days = self.days[:self.n]
+            if candidates is None:
+                if day_range is not None: candidates = self._range_rows(days, self.day_order, self.day_sorted, *day_range)
+                elif amount_range is not None: candidates = self._range_rows(amounts, self.amount_order, self.amount_sorted, *amount_range)
+                else: candidates = np.arange(self.n)
+            keep = np.ones(len(candidates), dtype=bool)
+            if amount_range is not None: keep &= (amounts[candidates] >= amount_range[0]) & (amounts[candidates] <= amount_range[1])
+            if day_range is not None: keep &= (days[candidates] >= day_range[0]) & (days[candidates] <= day_range[1])
+            for col, selected in (facets or {}).items():
+                if not selected: continue
+                ids = [self.value_ids[col][v] for v in selected if v in self.value_ids[col]]
+                keep &= np.isin(self.codes[col][candidates], ids)
+            return candidates[keep]
+
+def _search_index(entry):
+    """快取項目上的搜尋索引，資料重新載入 (DataFrame 換了) 或增量太多才重建"""
+    index = entry.get("search_index")
+    if index is None or index.df is not entry["value"] or index.needs_rebuild():
+        index = TransactionSearchIndex(entry["value"])
+        entry["search_index"] = index
+    return index
+
+def search_transactions(source_str, text="", amount_range=None, date_range=None, facets=None, limit=SEARCH_RESULT_LIMIT):
+    """跨所有交易分頁搜尋；回傳 (最新的 limit 筆結果, 符合筆數, 各分面的筆數)
+    date_range = (起, 迄) 日期，只會載入涵蓋到的封存年度"""
+    day_range = None
+    if date_range is not None:
+        date_range = tuple(d.date() if isinstance(d, datetime) else d for d in date_range)
+        day_range = tuple((d - date(1970, 1, 1)).days for d in date_range)
+    try:
+        entries = [_current_entry(source_str)]
+        for y in list_archived_years(source_str):
+            if date_range is None or date_range[0].year <= y <= date_range[1].year: entries.append(_archived_entry(source_str, y))
+    except Exception as e:
+        print(f"Error searching transactions: {e}")
+        return pd.DataFrame(), 0, {}
+    frames = []; total = 0; facet_counts = {col: Counter() for col in SEARCH_FACET_COLUMNS}
+    for entry in entries:
+        if entry["value"].empty: continue
+        index = _search_index(entry)
+        rows = index.search(text, amount_range, day_range, facets)
+        if len(rows) == 0: continue
+        total += len(rows)
+        for col in SEARCH_FACET_COLUMNS:
+            counts = np.bincount(index.codes[col][rows])
+            names = {vid: v for v, vid in index.value_ids[col].items()}
+            for vid in np.flatnonzero(counts): facet_counts[col][names[vid]] += int(counts[vid])
+        # 每個分頁只需要取日期最新的 limit 筆
+        newest = rows[np.argsort(index.days[rows], kind="stable")[::-1][:limit]]
+        frames.append(index.df.iloc[newest])
+    if not frames: return pd.DataFrame(), 0, facet_counts
+    result = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0].reset_index(drop=True)
+    return result.sort_values("Date", ascending=False, kind="stable").head(limit).reset_index(drop=True), total, facet_counts
+
+# ==========================================
+# [新增] 帳本預先載入 (登入後在背景把其他帳本的快取暖好)
+# ==========================================
+PREFETCH_WORKERS = 4
+PREFETCH_MIN_INTERVAL = 60
+
+@st.cache_resource
+def get_prefetch_registry():
+    """跨 Session 共用的執行緒池；futures 讓同一本帳同時只預載一次"""
+    return {"pool": ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"), "lock": threading.Lock(), "futures": {}}
+
+def warm_book(source_str):
+    """載入一本帳在 Tab 1 / Tab 2 會用到的資料 (月份彙總會一併載入使用中的交易與封存摘要)"""
+    get_data("Settings", source_str)
+    get_data("Recurring", source_str)
+    get_monthly_cube(source_str)
+
+def prefetch_books(sources):
+    """同時預載多本帳，回傳實際送出的帳本；剛預載過或正在預載的會略過"""
+    registry = get_prefetch_registry()
+    submitted = []
+    with registry["lock"]:
+        for source_str in dict.fromkeys(s for s in sources if s):
+            future = registry["futures"].get(source_str)
+            if future is not None and (not future.done() or time.time() - future.finished_at < PREFETCH_MIN_INTERVAL): continue
+            future = registry["pool"].submit(warm_book, source_str)
+            future.finished_at = float("inf")
+            future.add_done_callback(lambda f: setattr(f, "finished_at", time.time()))
+            registry["futures"][source_str] = future
+            submitted.append(source_str)
+    return submitted
+
+def wait_for_prefetch(source_str, timeout=30):
+    """目前帳本如果正在背景預載，等它做完再讀，避免同一份資料下載兩次"""
+    registry = get_prefetch_registry()
+    with registry["lock"]: future = registry["futures"].get(source_str)
+    if future is None or future.done(): return
+    try: future.result(timeout=timeout)
+    except Exception as e: print(f"Prefetch failed ({source_str}): {e}")
+
+# ==========================================
+# [新增] 年度封存 (Transactions -> Transactions_YYYY)
+# ==========================================
+# 流程：複製到年度分頁 -> 比對筆數與 checksum -> 從 Transactions 刪除 -> 寫入月份摘要
+# 每一步都記在 Archive_Log，而且都可以重跑 (已複製過的列不會重複複製)，中斷後下次開啟會接著做完
+ARCHIVE_LOG_SHEET = "Archive_Log"
+ARCHIVE_LOG_COLUMNS = ["Year", "Rows", "Checksum", "Status", "Updated_At"]
+ARCHIVE_SUMMARY_SHEET = "Archive_Summary"
+ARCHIVE_SUMMARY_COLUMNS = CUBE_DIMENSIONS + ["Amount", "Count"]
+ARCHIVE_CHECK_SECONDS = 6 * 3600
+
+def list_archived_years(source_str):
+    def _load():
+        return sorted(y for y in (archive_year_of(ws.title) for ws in list_worksheets(source_str)) if y is not None)
+    try: return cached_frame(source_str, ARCHIVE_YEARS_KEY, FULL_RESYNC_SECONDS, _load)
+    except Exception as e:
+        print(f"Error listing archive shards: {e}")
+        return []
+
+def _archived_entry(source_str, year):
+    """已封存年度：內容不會再變，快取到封存作業主動失效為止"""
+    def _load():
+        header, rows = get_storage_backend().read_worksheet(source_str, f"Transactions_{year}")
+        return build_transaction_frame(rows_to_columns(header, rows))
+    return cached_entry(source_str, f"Transactions_{year}", float("inf"), _load)
+
+def get_archived_transactions(source_str, year):
+    try: return _archived_entry(source_str, year)["value"].copy()
+    except Exception as e:
+        print(f"Error fetching archive {year}: {e}")
+        return pd.DataFrame()
+
+def _read_archive_summary(source_str):
+    try: header, rows = get_storage_backend().read_worksheet(source_str, ARCHIVE_SUMMARY_SHEET)
+    except gspread.exceptions.WorksheetNotFound: header, rows = [], []
+    df = _rows_to_frame(header, rows).reindex(columns=ARCHIVE_SUMMARY_COLUMNS)
+    df["Amount"] = pd.to_numeric(df["Amount"], errors="coerce").fillna(0.0)
+    df["Count"] = pd.to_numeric(df["Count"], errors="coerce").fillna(0).astype(int)
+    for col in CUBE_DIMENSIONS: df[col] = df[col].fillna("").astype(str)
+    return df.reset_index(drop=True)
+
+def _load_archive_cube(source_str):
+    years = list_archived_years(source_str)
+    cube = build_monthly_cube(pd.DataFrame())
+    if not years: return cube
+    summary = _read_archive_summary(source_str)
+    summary_years = summary["Month"].str[:4]
+    for y in years:
+        part = summary[summary_years == str(y)]
+        # 沒有摘要的年度分頁 (例如手動建立的) 直接從分頁內容彙總
+        if part.empty: part = build_monthly_cube(get_archived_transactions(source_str, y))
+        cube = merge_monthly_cube(cube, part)
+    return cube
+
+def get_archive_cube(source_str):
+    try: return cached_frame(source_str, ARCHIVE_CUBE_KEY, FULL_RESYNC_SECONDS, lambda: _load_archive_cube(source_str))
+    except Exception as e:
+        print(f"Error building archive cube: {e}")
+        return build_monthly_cube(pd.DataFrame())
+
+@st.cache_resource
+def get_archive_registry():
+    """同一個帳本同時只跑一個封存作業：{running: set(來源), checked_at: {來源: 時間}, results: {來源: (成功與否, 訊息)}}"""
+    return {"lock": threading.Lock(), "running": set(), "checked_at": {}, "results": {}}
+
+def _row_year(value):
+    m = re.match(r"\s*(\d{4})[-/]", str(value))
+    return int(m.group(1)) if m else None
+
+def _rows_checksum(rows):
+    """與順序無關的 checksum (複製到年度分頁後列的順序可能不同)"""
+    h = hashlib.md5()
+    for line in sorted(json.dumps(_trim_row([str(v) for v in r]), ensure_ascii=False) for r in rows): h.update(line.encode('utf-8'))
+    return h.hexdigest()
+
+def _row_key(row):
+    return tuple(_trim_row([str(v) for v in row]))
+
+class ArchiveLog:
+    """Archive_Log 分頁：每個年度一列，記錄最近一次封存的筆數、checksum 與進度"""
+
+    def __init__(self, source_str):
+        self.source_str = source_str
+        values = with_worksheet(source_str, ARCHIVE_LOG_SHEET, lambda ws: ws.get_all_values(), create_header=ARCHIVE_LOG_COLUMNS)
+        self.header = _trim_row(values[0]) if values else ARCHIVE_LOG_COLUMNS
+        self.entries = {}
+        self.next_row = max(len(values), 1) + 1
+        for i, r in enumerate(values[1:]):
+            rec = dict(zip(self.header, _pad_row(r, len(self.header))))
+            if str(rec.get("Year", "")).isdigit(): self.entries[int(rec["Year"])] = dict(rec, _row=i + 2)
+
+    def years_with(self, status):
+        return sorted(y for y, rec in self.entries.items() if rec.get("Status") == status)
+
+    def set(self, year, status, rows=None, checksum=None):
+        rec = self.entries.get(year, {"_row": None, "Rows": "", "Checksum": ""})
+        rec.update({"Year": str(year), "Status": status, "Updated_At": datetime.now(timezone(timedelta(hours=8))).strftime("%Y-%m-%d %H:%M:%S")})
+        if rows is not None: rec["Rows"] = str(rows)
+        if checksum is not None: rec["Checksum"] = checksum
+        values = [rec[c] for c in ARCHIVE_LOG_COLUMNS]
+        if rec["_row"]:
+            with_worksheet(self.source_str, ARCHIVE_LOG_SHEET, lambda ws: ws.update(values=[values], range_name=f"A{rec['_row']}:{_col_letter(len(values))}{rec['_row']}"))
+        else:
+            with_worksheet(self.source_str, ARCHIVE_LOG_SHEET, lambda ws: ws.append_row(values))
+            rec["_row"] = self.next_row; self.next_row += 1
+        self.entries[year] = rec
+
+def _copy_year_to_shard(source_str, year, header, moving):
+    """把 moving 複製到 Transactions_YYYY 並驗證；回傳 True 表示年度分頁確實包含全部列"""
+    shard = f"Transactions_{year}"
+    read = lambda ws: ws.get_all_values()
+    values = with_worksheet(source_str, shard, read, create_header=header)
+    if values and _trim_row(values[0]) != _trim_row(header):
+        print(f"Archive {year}: 年度分頁欄位與 Transactions 不同，略過")
+        return False
+    # 續跑時年度分頁可能已經有上次複製的列，只補上還沒有的
+    have = Counter(_row_key(r) for r in values[1:])
+    missing = []
+    for r in moving:
+        k = _row_key(r)
+        if have[k] > 0: have[k] -= 1
+        else: missing.append(r)
+    if missing: with_worksheet(source_str, shard, lambda ws: ws.append_rows(missing))
+    # 重新讀回來驗證：筆數與 checksum 都要對得上
+    values = with_worksheet(source_str, shard, read)
+    copied = Counter(_row_key(r) for r in values[1:]) & Counter(_row_key(r) for r in moving)
+    copied_rows = list(copied.elements())
+    return len(copied_rows) == len(moving) and _rows_checksum(copied_rows) == _rows_checksum(moving)
+
+def _write_archive_summary(source_str, years):
+    """重新彙總指定年度的封存分頁，取代 Archive_Summary 中這些年度的列"""
+    summary = _read_archive_summary(source_str)
+    keep = summary[~summary["Month"].str[:4].isin([str(y) for y in years])]
+    parts = [keep]
+    for y in years:
+        header, rows = SheetsBackend().read_worksheet(source_str, f"Transactions_{y}")
+        parts.append(build_monthly_cube(build_transaction_frame(rows_to_columns(header, rows))))
+    out = pd.concat([p.astype({c: str for c in CUBE_DIMENSIONS}) for p in parts], ignore_index=True)
+    out = out.sort_values(CUBE_DIMENSIONS).reindex(columns=ARCHIVE_SUMMARY_COLUMNS)
+    values = [list(map(str, r[:len(CUBE_DIMENSIONS)])) + [float(r[-2]), int(r[-1])] for r in out.itertuples(index=False)]
+    def _overwrite(ws):
+        ws.clear(); ws.update(values=[ARCHIVE_SUMMARY_COLUMNS] + values)
+    with_worksheet(source_str, ARCHIVE_SUMMARY_SHEET, _overwrite, create_header=ARCHIVE_SUMMARY_COLUMNS)
+
+def archive_closed_years(source_str, current_year):
+    """把 Transactions 中 current_year 以前的交易搬到 Transactions_YYYY，回傳 (成功與否, 訊息)"""
+    backend = get_storage_backend()
+    if hasattr(backend, "pending_count") and backend.pending_count(source_str) > 0:
+        return False, "還有尚未同步的寫入，稍後再封存"
+    registry = get_archive_registry()
+    with registry["lock"]:
+        if source_str in registry["running"]: return False, "封存作業進行中"
+        registry["running"].add(source_str)
+    try:
+        remote = SheetsBackend()
+        log = ArchiveLog(source_str)
+        header, rows = remote.read_worksheet(source_str, "Transactions")
+        if "Date" not in header: return False, "Transactions 缺少 Date 欄位"
+        date_idx = header.index("Date")
+        by_year = {}
+        for i, r in enumerate(rows):
+            y = _row_year(r[date_idx])
+            if y is not None and y < current_year and any(v != "" for v in r): by_year.setdefault(y, []).append((i + 2, r))
+
+        verified = []
+        for year in sorted(by_year):
+            moving = [r for _, r in by_year[year]]
+            log.set(year, "copying", rows=len(moving), checksum=_rows_checksum(moving))
+            if not _copy_year_to_shard(source_str, year, header, moving):
+                log.set(year, "failed")
+                continue
+            log.set(year, "verified")
+            verified.append(year)
+
+        moved = 0
+        if verified:
+            targets = [(row_no, r) for y in verified for row_no, r in by_year[y]]
+            # 刪除前再讀一次，確認這些列號仍是剛剛複製的那幾列 (期間有人改過就等下次)
+            _, latest = remote.read_worksheet(source_str, "Transactions")
+            if all(row_no - 2 < len(latest) and _row_key(latest[row_no - 2]) == _row_key(r) for row_no, r in targets):
+                remote.delete_rows(source_str, "Transactions", [row_no for row_no, _ in targets])
+                moved = len(targets)
+                for y in verified: log.set(y, "archived")
+            else: return False, "Transactions 在封存途中被修改，下次再繼續"
+
+        # 摘要：本次搬移的年度 + 上次中斷、尚未完成的年度
+        summary_years = log.years_with("archived")
+        if summary_years:
+            _write_archive_summary(source_str, summary_years)
+            for y in summary_years: log.set(y, "done")
+
+        registry_sync = get_sheet_sync_registry()
+        with registry_sync["lock"]: registry_sync["sheets"].pop((source_str, "Transactions"), None)
+        if hasattr(backend, "mark_stale"): backend.mark_stale(source_str)
+        invalidate_book_cache(source_str, "Transactions")
+        for key in [ARCHIVE_CUBE_KEY, ARCHIVE_YEARS_KEY] + [f"Transactions_{y}" for y in summary_years]: invalidate_book_cache(source_str, key)
+        return True, f"已封存 {moved} 筆往年交易"
+    except Exception as e:
+        invalidate_handles(source_str)
+        return False, f"封存失敗: {e}"
+    finally:
+        with registry["lock"]: registry["running"].discard(source_str)
 
 def append_data(worksheet_name, row_data, source_str):
-    client = get_gspread_client()
     try:
-        sheet = open_spreadsheet(client, source_str)
-        worksheet = sheet.worksheet(worksheet_name)
         if worksheet_name == "Transactions":
             recorder = st.session_state.user_info.get("Nickname", st.session_state.user_info.get("Email"))
             row_data.append(recorder)
-        worksheet.append_row(row_data)
+        get_storage_backend().append_rows(source_str, worksheet_name, [row_data])
+        return True
+    except: return False
+
+def queue_append_data(worksheet_name, row_data, source_str):
+    """與 append_data 相同，但交給背景寫入佇列，不等待 Google Sheets 回應"""
+    try:
+        if worksheet_name == "Transactions":
+            recorder = st.session_state.user_info.get("Nickname", st.session_state.user_info.get("Email"))
+            row_data.append(recorder)
+        get_write_queue().enqueue(source_str, worksheet_name, row_data)
         return True
     except: return False
 
 def save_settings_data(new_settings_df, source_str):
-    client = get_gspread_client()
     try:
-        sheet = open_spreadsheet(client, source_str)
-        worksheet = sheet.worksheet("Settings"); worksheet.clear()
         new_settings_df = new_settings_df.fillna("")
-        data_to_write = [new_settings_df.columns.values.tolist()] + new_settings_df.values.tolist()
-        worksheet.update(values=data_to_write)
+        get_storage_backend().overwrite_worksheet(source_str, "Settings", new_settings_df.columns.values.tolist(), new_settings_df.values.tolist())
         return True
     except: return False
 
-def update_recurring_last_run(row_index, month_str, source_str):
-    client = get_gspread_client()
+def update_recurring_last_runs(last_runs, source_str):
+    """last_runs = {規則 index: "YYYY-MM"}，一次 batch_update 更新所有 Last_Run_Month"""
     try:
-        sheet = open_spreadsheet(client, source_str)
-        worksheet = sheet.worksheet("Recurring")
-        worksheet.update_cell(row_index + 2, 9, month_str)
+        get_storage_backend().update_cells(source_str, "Recurring", [(idx + 2, 9, month_str) for idx, month_str in last_runs.items()])
         return True
     except: return False
 
 def delete_recurring_rule(row_index, source_str):
-    client = get_gspread_client()
     try:
-        sheet = open_spreadsheet(client, source_str)
-        worksheet = sheet.worksheet("Recurring")
-        worksheet.delete_rows(row_index + 2)
+        get_storage_backend().delete_row(source_str, "Recurring", row_index + 2)
         return True
     except: return False
 
@@ -766,49 +2767,166 @@ def get_user_date(offset_hours):
     tz = timezone(timedelta(hours=offset_hours))
     return datetime.now(tz).date()
 
-@st.cache_data(ttl=3600)
+# ==========================================
+# [新增] 匯率服務 (背景更新 + 歷史匯率)
+# ==========================================
+# 預設匯率 (萬一所有 API 都失敗時使用)
+DEFAULT_RATES = {"TWD": 1.0, "USD": 32.3, "HKD": 4.12, "JPY": 0.21, "SGD": 24.1, "CNY": 4.5, "EUR": 34.5}
+RATE_REFRESH_SECONDS = 3600
+RATE_HISTORY_PATH = os.path.join(LOCAL_DATA_DIR, "rates.db")
+
+def fetch_frankfurter_rates(on_date=None):
+    """回傳 (匯率日期, {幣別: 1 單位折合多少 TWD})；on_date 有給就抓該日的歷史匯率"""
+    # 使用 Frankfurter API (免費、免 Key、穩定)
+    # 以 TWD 為基基準，獲取所有幣別匯率
+    url = f"https://api.frankfurter.app/{on_date or 'latest'}?from=TWD"
+    response = requests.get(url, timeout=10)
+    data = response.json()
+    if response.status_code != 200 or "rates" not in data: raise Exception("API 回傳異常")
+    # API 回傳的是 1 台幣等於多少外幣 (例如 1 TWD = 0.031 USD)
+    # 我們需要轉換成 1 外幣等於多少台幣 (例如 1 USD = 32.25 TWD)
+    processed_rates = {"TWD": 1.0}
+    for curr, val in data["rates"].items():
+        if val != 0: processed_rates[curr] = round(1 / val, 4)
+    return data.get("date", str(on_date or date.today())), processed_rates
+
+def stub_rate_fetcher(on_date=None):
+    """離線 / 測試用：永遠回傳預設匯率"""
+    return str(on_date or date.today()), dict(DEFAULT_RATES)
+
+class RateService:
+    """立即回傳最後一次成功的匯率，過期時在背景更新；每日匯率存進 SQLite 供依交易日期查詢"""
+
+    def __init__(self, fetcher, db_path, refresh_seconds=RATE_REFRESH_SECONDS, source_name="Frankfurter API"):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.fetcher = fetcher
+        self.source_name = source_name
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rate_history (rate_date TEXT, currency TEXT, rate REAL, PRIMARY KEY (rate_date, currency))")
+        self.conn.commit()
+        self.fetched_at = 0
+        self.last_error = None
+        self.source = "系統預設"
+        self._pending_dates = set()
+        self._failed_at = {}  # {日期: 失敗時間}，避免抓不到的歷史匯率每次 rerun 都重打 API
+        self._thread = None
+        self._version = 0  # 匯率紀錄每次寫入就 +1，rate_table 依此判斷要不要重建
+        self._table_cache = None
+        latest = self.conn.execute("SELECT MAX(rate_date) FROM rate_history").fetchone()[0]
+        self.latest_date = latest
+        self.latest = self._rates_for(latest) if latest else dict(DEFAULT_RATES)
+        if latest: self.source = "本機匯率紀錄"
+
+    def _rates_for(self, rate_date):
+        with self.lock:
+            return {c: r for c, r in self.conn.execute("SELECT currency, rate FROM rate_history WHERE rate_date = ?", (rate_date,))}
+
+    def _store(self, rate_date, rates):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO rate_history VALUES (?, ?, ?)", [(rate_date, c, r) for c, r in rates.items()])
+            self.conn.commit()
+            self._version += 1
+
+    def _refresh(self, dates):
+        for on_date in dates:
+            try:
+                rate_date, rates = self.fetcher(on_date)
+                self._store(rate_date, rates)
+                if on_date is None:
+                    with self.lock:
+                        self.latest, self.latest_date = rates, rate_date
+                        self.fetched_at = time.time(); self.last_error = None; self.source = self.source_name
+            except Exception as e:
+                print(f"匯率抓取失敗: {e}")
+                with self.lock:
+                    self.last_error = str(e)
+                    if on_date is None: self.fetched_at = time.time()  # 失敗也等下一輪再試，避免每次 rerun 都打 API
+                    else: self._failed_at[on_date] = time.time()
+            finally:
+                with self.lock: self._pending_dates.discard(on_date)
+
+    def _schedule(self, on_date):
+        with self.lock:
+            if on_date in self._pending_dates: return
+            if time.time() - self._failed_at.get(on_date, 0) < self.refresh_seconds: return
+            self._pending_dates.add(on_date)
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+
+    def prefetch(self, dates):
+        """排程背景抓取這些日期的歷史匯率 (正在抓或最近抓失敗的日期略過)，不會阻塞"""
+        for on_date in dates: self._schedule(str(on_date))
+
+    def _drain(self):
+        while True:
+            with self.lock: dates = list(self._pending_dates)
+            if not dates: return
+            self._refresh(dates)
+
+    def snapshot(self):
+        """不會阻塞：過期時只排程背景更新，先回傳手上的匯率"""
+        with self.lock:
+            if time.time() - self.fetched_at > self.refresh_seconds: self._schedule(None)
+            if self.latest_date: fetch_time = f"{self.latest_date} (背景更新中)" if None in self._pending_dates else self.latest_date
+            else: fetch_time = "尚未取得匯率，暫用預設匯率"
+            if self.last_error: fetch_time += f" | 最近一次更新失敗：{self.last_error}"
+            return {"rates": dict(self.latest), "time": fetch_time, "source": self.source}
+
+    def rates_on(self, on_date):
+        """回傳交易日 (含) 之前最近一天的匯率；本機沒有紀錄時排程背景抓取並先回傳最新匯率"""
+        on_date = str(on_date)
+        with self.lock:
+            found = self.conn.execute("SELECT MAX(rate_date) FROM rate_history WHERE rate_date <= ?", (on_date,)).fetchone()[0]
+        if found and (datetime.strptime(on_date, "%Y-%m-%d") - datetime.strptime(found, "%Y-%m-%d")).days <= 7:
+            return self._rates_for(found)
+        # 最近幾天的交易直接用最新匯率即可；更早的日期才另外抓歷史匯率
+        if on_date >= str(date.today() - timedelta(days=3)): return dict(self.latest)
+        self.prefetch([on_date])
+        return self._rates_for(found) if found else dict(self.latest)
+
+    def rate_table(self, currencies):
+        """日期 x 幣別 的匯率表 (某天缺的幣別沿用前一天)，供向量化換算使用"""
+        currencies = sorted(set(currencies))
+        with self.lock:
+            key = (self._version, tuple(currencies))
+            if self._table_cache and self._table_cache[0] == key: return self._table_cache[1]
+            df = pd.read_sql_query(f"SELECT rate_date, currency, rate FROM rate_history WHERE currency IN ({','.join('?' * len(currencies))})",
+                                   self.conn, params=currencies)
+        table = df.pivot_table(index="rate_date", columns="currency", values="rate", aggfunc="last").reindex(columns=currencies).sort_index().ffill()
+        table.index = pd.to_datetime(table.index)
+        with self.lock: self._table_cache = (key, table)
+        return table
+
+# secrets 設定 rate_fetcher = "stub" 即可離線使用
+RATE_FETCHERS = {"frankfurter": (fetch_frankfurter_rates, "Frankfurter API"), "stub": (stub_rate_fetcher, "離線預設匯率")}
+
+@st.cache_resource
+def get_rate_service():
+    fetcher, source_name = RATE_FETCHERS.get(st.secrets.get("rate_fetcher", "frankfurter"), RATE_FETCHERS["frankfurter"])
+    return RateService(fetcher, RATE_HISTORY_PATH, source_name=source_name)
+
 def get_exchange_rates():
-    # 預設匯率 (萬一所有 API 都失敗時使用)
-    default_rates = {"TWD": 1.0, "USD": 32.3, "HKD": 4.12, "JPY": 0.21, "SGD": 24.1, "CNY": 4.5, "EUR": 34.5}
-    fetch_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    try:
-        # 使用 Frankfurter API (免費、免 Key、穩定)
-        # 以 TWD 為基基準，獲取所有幣別匯率
-        url = "https://api.frankfurter.app/latest?from=TWD"
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        
-        if response.status_code == 200 and "rates" in data:
-            # API 回傳的是 1 台幣等於多少外幣 (例如 1 TWD = 0.031 USD)
-            # 我們需要轉換成 1 外幣等於多少台幣 (例如 1 USD = 32.25 TWD)
-            api_rates = data["rates"]
-            processed_rates = {"TWD": 1.0}
-            
-            for curr, val in api_rates.items():
-                if val != 0:
-                    processed_rates[curr] = round(1 / val, 4)
-            
-            return {"rates": processed_rates, "time": fetch_time, "source": "Frankfurter API"}
-        else:
-            raise Exception("API 回傳異常")
-            
-    except Exception as e:
-        # 如果 API 失敗，嘗試第二個備用來源 (或是直接用預設值)
-        print(f"匯率抓取失敗: {e}")
-        return {"rates": default_rates, "time": f"API連線失敗，使用預設匯率 ({fetch_time})", "source": "系統預設"}
+    return get_rate_service().snapshot()
 
 # --- 2. 換算函式 (修正 Unpacking 錯誤) ---
-def calculate_exchange(amount, input_currency, target_currency, rates_data):
+def calculate_exchange(amount, input_currency, target_currency, rates_data, on_date=None):
     # 自動判斷傳進來的是整個資料包還是純字典
     if isinstance(rates_data, dict) and "rates" in rates_data:
         rates = rates_data["rates"]
     else:
         rates = rates_data # 預設傳入的就是字典
-        
     if input_currency == target_currency: 
         return amount, 1.0
-    
+    # 有給交易日期就改用當天的歷史匯率 (與整批換算共用同一套規則)，沒有歷史紀錄時用傳進來的匯率
+    if on_date is not None:
+        try:
+            converted = float(convert_amounts([amount], [input_currency], target_currency, dates=[on_date], latest_rates=rates)[0])
+            return converted, (converted / amount if amount else 1.0)
+        except Exception as e: print(f"歷史匯率查詢失敗: {e}")
+
     try:
         rate_in = rates.get(input_currency)
         rate_target = rates.get(target_currency)
@@ -822,36 +2940,492 @@ def calculate_exchange(amount, input_currency, target_currency, rates_data):
     except:
         return amount, 1.0
 
+# ==========================================
+# [新增] 批次匯入 (銀行 CSV / OFX 對帳單)
+# ==========================================
+# 檔案分段讀取 -> 對應欄位 -> 自動分類 -> 換匯 -> 去除已存在的交易 -> 大批 append_rows 寫入
+IMPORT_CHUNK_ROWS = 2000
+IMPORT_BATCH_ROWS = 5000  # 每次 append_rows 的列數 (Sheets 寫入配額是以「次」計算)
+IMPORT_FIELDS = ["Date", "Amount", "Debit", "Credit", "Currency", "Note", "Main_Category", "Sub_Category", "Payment_Method"]
+IMPORT_FIELD_LABELS = {"Date": "日期", "Amount": "金額 (有正負號)", "Debit": "支出金額", "Credit": "存入金額", "Currency": "幣別",
+                       "Note": "備註 / 摘要", "Main_Category": "大類別", "Sub_Category": "次類別", "Payment_Method": "付款方式"}
+IMPORT_COLUMN_ALIASES = {
+    "Date": ["date", "日期", "交易日期", "交易日", "入帳日", "記帳日", "posted date", "transaction date", "dtposted"],
+    "Amount": ["amount", "金額", "交易金額", "trnamt"],
+    "Debit": ["debit", "支出", "提款", "支出金額", "withdrawal"],
+    "Credit": ["credit", "存入", "存入金額", "存款", "收入金額", "deposit"],
+    "Currency": ["currency", "幣別", "币别"],
+    "Note": ["note", "description", "memo", "payee", "name", "備註", "摘要", "說明", "交易說明", "商店名稱"],
+    "Main_Category": ["main_category", "category", "大類別", "類別"],
+    "Sub_Category": ["sub_category", "subcategory", "次類別", "子類"],
+    "Payment_Method": ["payment_method", "account", "付款方式", "帳戶"],
+}
+
+def _detect_encoding(file_obj):
+    """台灣銀行匯出的 CSV 常是 Big5 (cp950)，先看開頭一段判斷"""
+    pos = file_obj.tell(); sample = file_obj.read(65536); file_obj.seek(pos)
+    try: sample[:-4].decode("utf-8"); return "utf-8-sig"
+    except UnicodeDecodeError: return "cp950"
+
+def guess_import_mapping(columns):
+    """依欄位名稱猜測 {匯入欄位: 檔案欄位}"""
+    mapping = {}
+    normalized = {str(c).strip().lower(): c for c in columns}
+    for field in IMPORT_FIELDS:
+        for alias in IMPORT_COLUMN_ALIASES.get(field, []):
+            if alias in normalized and normalized[alias] not in mapping.values():
+                mapping[field] = normalized[alias]; break
+    return mapping
+
+def read_csv_header(file_obj):
+    pos = file_obj.tell()
+    try: return list(pd.read_csv(file_obj, nrows=0, encoding=_detect_encoding(file_obj)).columns)
+    finally: file_obj.seek(pos)
+
+def iter_csv_chunks(file_obj, chunksize=IMPORT_CHUNK_ROWS):
+    """CSV 一次讀 chunksize 列，全部當字串處理"""
+    yield from pd.read_csv(file_obj, dtype=str, keep_default_na=False, chunksize=chunksize, encoding=_detect_encoding(file_obj), skipinitialspace=True)
+
+OFX_TAG_RE = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<\r\n]*)")
+OFX_MAPPING = {"Date": "Date", "Amount": "Amount", "Currency": "Currency", "Note": "Note"}
+
+def iter_ofx_chunks(file_obj, chunksize=IMPORT_CHUNK_ROWS):
+    """OFX / QFX (SGML 或 XML 皆可)：逐行掃描 <STMTTRN> 區塊，輸出欄位與 OFX_MAPPING 對應"""
+    text = io.TextIOWrapper(file_obj, encoding=_detect_encoding(file_obj), errors="replace")
+    currency = ""; rec = None; buf = []
+    def _frame(records):
+        return pd.DataFrame({
+            "Date": [r.get("DTPOSTED", "")[:8] for r in records],
+            "Amount": [r.get("TRNAMT", "") for r in records],
+            "Currency": [r.get("CURSYM") or currency for r in records],
+            "Note": [" ".join(v for v in (r.get("NAME", ""), r.get("MEMO", "")) if v) for r in records],
+        })
+    for line in text:
+        for closing, tag, value in OFX_TAG_RE.findall(line):
+            tag = tag.upper()
+            if tag == "CURDEF" and not closing: currency = value.strip()
+            elif tag == "STMTTRN":
+                if not closing: rec = {}
+                elif rec is not None:
+                    buf.append(rec); rec = None
+                    if len(buf) >= chunksize: yield _frame(buf); buf = []
+            elif rec is not None and not closing: rec[tag] = value.strip()
+    if buf: yield _frame(buf)
+
+def _parse_import_amounts(values):
+    """去掉千分位與貨幣符號，(123.45) 視為負數"""
+    s = pd.Series(values, dtype="object").fillna("").astype(str).str.strip()
+    s = s.str.replace(r"^\((.*)\)$", r"-\1", regex=True).str.replace(r"[^\d.\-+]", "", regex=True)
+    return pd.to_numeric(s, errors="coerce")
+
+def build_category_rules(cat_mapping, history=None):
+    """自動分類規則：(歷史備註 -> 最常用的大類/子類, [(關鍵字, 大類, 子類)]，關鍵字長的優先)"""
+    by_note = {}
+    if history is not None and not history.empty and {"Note", "Main_Category", "Sub_Category"} <= set(history.columns):
+        h = history[["Note", "Main_Category", "Sub_Category"]].astype(str)
+        h = h[(h["Note"].str.strip() != "") & (h["Main_Category"] != "")]
+        if not h.empty:
+            h = h.assign(Note=h["Note"].str.replace("(自動) ", "", regex=False).str.strip().str.lower())
+            top = h.groupby(["Note", "Main_Category", "Sub_Category"]).size().reset_index(name="n").sort_values("n").drop_duplicates("Note", keep="last")
+            by_note = {r.Note: (r.Main_Category, r.Sub_Category) for r in top.itertuples(index=False)}
+    keywords = []
+    for main, subs in cat_mapping.items():
+        keywords.append((main, main, ""))
+        keywords += [(sub, main, sub) for sub in subs if sub]
+    keywords.sort(key=lambda k: len(k[0]), reverse=True)
+    return by_note, keywords
+
+def auto_categorize(notes, is_income, rules, cat_mapping):
+    """回傳 (大類, 子類) 兩個 Series；先比對歷史備註，再比對類別名稱關鍵字"""
+    by_note, keywords = rules
+    key = notes.fillna("").astype(str).str.strip().str.lower()
+    hit = key.map(by_note)
+    main = hit.map(lambda v: v[0], na_action="ignore").astype(object); sub = hit.map(lambda v: v[1], na_action="ignore").astype(object)
+    for kw, m, s in keywords:
+        todo = main.isna()
+        if not todo.any(): break
+        found = todo & key.str.contains(kw.lower(), regex=False)
+        main[found] = m; sub[found] = s
+    fallback_exp = "其他" if "其他" in cat_mapping else "未分類"
+    main = main.where(main.notna(), np.where(is_income, "收入", fallback_exp))
+    return main, sub.fillna("")
+
+def _dedupe_keys(dates, amounts, currencies, notes):
+    """去重用的雜湊 (日期 + 原幣金額 + 幣別 + 備註)"""
+    key = pd.DataFrame({
+        "d": pd.Series(dates).astype(str).str[:10].to_numpy(),
+        "a": np.round(pd.to_numeric(pd.Series(amounts), errors="coerce").fillna(0).to_numpy(dtype=float), 2).astype(str),
+        "c": pd.Series(currencies).astype(str).str.strip().str.upper().to_numpy(),
+        "n": pd.Series(notes).fillna("").astype(str).str.strip().to_numpy(),
+    })
+    return pd.util.hash_pandas_object(key, index=False).to_numpy()
+
+def build_dedupe_index(existing):
+    """現有交易的雜湊次數 (同一天兩筆一模一樣的消費要能匯入兩次，所以記次數而不是集合)"""
+    if existing.empty: return pd.Series(dtype="int64")
+    keys = _dedupe_keys(existing["Date"].dt.strftime("%Y-%m-%d").fillna(""), existing["Amount_Original"], existing["Currency"], existing["Note"])
+    return pd.Series(keys).value_counts()
+
+def prepare_import_chunk(chunk, mapping, ctx):
+    """把一段原始資料轉成 Transactions 的欄位；回傳 (DataFrame, 略過的列數)"""
+    col = lambda f: chunk[mapping[f]] if mapping.get(f) in chunk.columns else pd.Series([""] * len(chunk), index=chunk.index, dtype="object")
+    if mapping.get("Amount") in chunk.columns: amount = _parse_import_amounts(col("Amount"))
+    else: amount = _parse_import_amounts(col("Credit")).fillna(0) - _parse_import_amounts(col("Debit")).fillna(0)
+    if ctx["expense_positive"]: amount = -amount
+    raw_dates = col("Date").astype(str).str.strip()
+    dates = pd.to_datetime(raw_dates, format="%Y%m%d", errors="coerce")
+    retry = dates.isna() & (raw_dates != "")
+    if retry.any(): dates[retry] = pd.to_datetime(raw_dates[retry], format="mixed", errors="coerce")
+    valid = dates.notna() & amount.notna() & (amount != 0)
+    skipped = int((~valid).sum())
+    if not valid.any(): return pd.DataFrame(), skipped
+    dates, amount = dates[valid], amount[valid]
+    notes = col("Note")[valid].astype(str).str.strip()
+    currency = col("Currency")[valid].astype(str).str.strip().str.upper()
+    currency = currency.where(currency != "", ctx["currency"])
+    is_income = (amount > 0).to_numpy()
+    main, sub = auto_categorize(notes, is_income, ctx["rules"], ctx["cat_mapping"])
+    # 檔案本身有分類就用檔案的
+    if mapping.get("Main_Category") in chunk.columns:
+        given = col("Main_Category")[valid].astype(str).str.strip()
+        main = given.where(given != "", main); sub = col("Sub_Category")[valid].astype(str).str.strip().where(given != "", sub)
+    # Type 由金額正負決定；分類與正負矛盾 (支出標成收入、退款標在食) 的列改用預設分類，維持 Type == 收入 ⇔ 大類 == 收入
+    conflict = pd.Series((main.to_numpy() == "收入") != is_income, index=main.index)
+    if conflict.any():
+        main = main.where(~conflict, pd.Series(np.where(is_income, "收入", "其他" if "其他" in ctx["cat_mapping"] else "未分類"), index=main.index))
+        sub = sub.where(~conflict, "")
+    payment = col("Payment_Method")[valid].astype(str).str.strip()
+    payment = payment.where(payment != "", ctx["payment"])
+    date_str = dates.dt.strftime("%Y-%m-%d")
+    amt_org = amount.abs().round(2)
+    out = pd.DataFrame({
+        "Date": date_str, "Type": np.where(is_income, "收入", "支出"), "Main_Category": main.to_numpy(), "Sub_Category": sub.to_numpy(),
+        "Payment_Method": payment.to_numpy(), "Currency": currency.to_numpy(), "Amount_Original": amt_org.to_numpy(),
+        "Amount_Def": convert_amounts(amt_org.to_numpy(), currency.to_numpy(), ctx["target_currency"], dates=date_str.to_numpy()), "Note": notes.to_numpy(),
+    })
+    return out.reset_index(drop=True), skipped
+
+def import_transactions(source_str, chunks, mapping, ctx, recorder, progress=None):
+    """逐段處理匯入資料並分批寫入；回傳 (成功與否, 訊息, 統計)"""
+    stats = {"read": 0, "imported": 0, "duplicates": 0, "skipped": 0}
+    header = get_transactions_header(source_str)
+    existing = query_transactions(source_str, columns=["Date", "Amount_Original", "Currency", "Note"])
+    index = build_dedupe_index(existing)
+    seen = pd.Series(dtype="int64")  # 本次匯入中每個雜湊已出現的次數
+    created_at = str(datetime.now(timezone(timedelta(hours=8))))
+    pending = []
+    # 配額用完 (429) 的退避重試由 SheetsScheduler 統一處理
+    backend = get_storage_backend()
+    try:
+        for chunk in chunks:
+            stats["read"] += len(chunk)
+            frame, skipped = prepare_import_chunk(chunk, mapping, ctx)
+            stats["skipped"] += skipped
+            if not frame.empty:
+                keys = pd.Series(_dedupe_keys(frame["Date"], frame["Amount_Original"], frame["Currency"], frame["Note"]))
+                # 第 n 次出現的同一筆，只有在帳本裡少於 n 筆時才匯入
+                occurrence = keys.groupby(keys).cumcount() + keys.map(seen).fillna(0).astype(int)
+                keep = (occurrence >= keys.map(index).fillna(0).astype(int)).to_numpy()
+                seen = seen.add(keys.value_counts(), fill_value=0).astype(int)
+                stats["duplicates"] += int((~keep).sum())
+                frame = frame[keep].assign(Created_At=created_at, Recorder=recorder)
+                pending += frame.reindex(columns=header).fillna("").values.tolist()
+            while len(pending) >= IMPORT_BATCH_ROWS:
+                backend.append_rows(source_str, "Transactions", pending[:IMPORT_BATCH_ROWS])
+                stats["imported"] += IMPORT_BATCH_ROWS; pending = pending[IMPORT_BATCH_ROWS:]
+            if progress: progress(stats)
+        if pending:
+            backend.append_rows(source_str, "Transactions", pending)
+            stats["imported"] += len(pending)
+        if progress: progress(stats)
+        return True, f"匯入 {stats['imported']} 筆，略過重複 {stats['duplicates']} 筆、無效 {stats['skipped']} 筆", stats
+    except Exception as e:
+        return False, f"匯入中斷 (已寫入 {stats['imported']} 筆，重新匯入同一個檔案會自動略過已寫入的部分): {e}", stats
+    finally:
+        if stats["imported"]: invalidate_book_cache(source_str, "Transactions")
+
+# 向量化換算時，最多替幾個缺匯率的日期排程背景抓取 (大量歷史資料不逐日打 API)
+CONVERT_SCHEDULE_LIMIT = 31
+
+def convert_amounts(amounts, currencies, target_currency, dates=None, latest_rates=None):
+    """一次換算整批金額：amounts / currencies / dates 等長，回傳換成 target_currency 後的 ndarray (小數 2 位)
+    有給 dates 時與 calculate_exchange(on_date=...) 相同規則：7 天內有紀錄就用，近 3 天用最新匯率，其餘用之前最近一天的匯率
+    latest_rates 是沒有歷史紀錄時用的匯率 (預設為目前匯率)；查不到匯率的幣別不換算 (與 calculate_exchange 相同)"""
+    amounts = np.asarray(amounts, dtype=float)
+    cur = pd.Categorical(np.asarray(currencies, dtype=object))
+    names = list(cur.categories) + [target_currency]
+    missing = len(names)  # 沒有幣別 (NaN) 的列指到最後一欄的 NaN
+    codes = np.where(cur.codes < 0, missing, cur.codes)
+    service = get_rate_service()
+    latest = latest_rates or service.snapshot()["rates"]
+    latest_vec = np.array([latest.get(c, np.nan) for c in names] + [np.nan], dtype=float)
+    rate_in = latest_vec[codes]
+    rate_out = np.full(len(amounts), latest_vec[len(names) - 1])
+    if dates is not None and len(amounts):
+        d = pd.to_datetime(pd.Series(dates), errors="coerce").to_numpy("datetime64[ns]")
+        table = service.rate_table(names)
+        recent = d >= np.datetime64(date.today() - timedelta(days=3))
+        gap = np.full(len(d), np.inf)
+        if not table.empty:
+            t_dates = table.index.to_numpy("datetime64[ns]")
+            mat = np.hstack([table.reindex(columns=names).to_numpy(dtype=float), np.full((len(table), 1), np.nan)])
+            pos = np.searchsorted(t_dates, d, side="right") - 1
+            p = np.clip(pos, 0, None)
+            found = (pos >= 0) & ~np.isnat(d)
+            gap = np.where(found, (d - t_dates[p]) / np.timedelta64(1, "D"), np.inf)
+            use_table = found & ((gap <= 7) | ~recent)
+            t_in = mat[p, codes]; t_out = mat[p, len(names) - 1]
+            rate_in = np.where(use_table & ~np.isnan(t_in), t_in, rate_in)
+            rate_out = np.where(use_table & ~np.isnan(t_out), t_out, rate_out)
+        # 舊日期附近沒有紀錄 (包含本機還沒有任何匯率紀錄)：和 rates_on 一樣排程背景抓取 (數量有限)
+        stale = np.unique(d[~np.isnat(d) & ~recent & (gap > 7)])
+        if 0 < len(stale) <= CONVERT_SCHEDULE_LIMIT:
+            service.prefetch(pd.Timestamp(day).date() for day in stale)
+    factor = rate_in / rate_out
+    factor = np.where(np.isfinite(factor) & (factor > 0), factor, 1.0)
+    factor = np.where(np.asarray(cur == target_currency), 1.0, factor)
+    return np.round(amounts * factor, 2)
+
+# ==========================================
+# [新增] 變更預設幣別後重新換算 Amount_Def (背景作業)
+# ==========================================
+# 依 Amount_Original / Currency 與交易日匯率重算所有交易分頁，分段 batch_update 寫回
+# 進度存在本機 JSON，程式重啟後從中斷的分頁與列號繼續
+REDENOMINATE_STATE_PATH = os.path.join(LOCAL_DATA_DIR, "redenominate.json")
+REDENOMINATE_CHUNK_ROWS = 2000
+
+def _parse_sheet_amounts(values):
+    return pd.to_numeric(pd.Series(values, dtype="object").astype(str).str.replace(",", "").str.strip(), errors="coerce").to_numpy(dtype=float)
+
+class RedenominationJobs:
+    """每本帳最多一個換算作業：{來源: {"id", "currency", "status", "shards", "shard_idx", "next_row", "done_rows", "error"}}"""
+
+    def __init__(self, state_path, chunk_rows=REDENOMINATE_CHUNK_ROWS):
+        self.state_path = state_path
+        self.chunk_rows = chunk_rows
+        self.lock = threading.Lock()
+        self.jobs = self._load()
+        for source_str, job in self.jobs.items():
+            if job["status"] == "running": self._spawn(source_str, job["id"])
+
+    def _load(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f: return json.load(f)
+        except (FileNotFoundError, ValueError): return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(self.jobs, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def start(self, source_str, currency):
+        """開始 (或重新開始) 換算；同一本帳之前的作業會在下一段結束後自動停止"""
+        job = {"id": uuid.uuid4().hex, "currency": currency, "status": "running", "shards": None,
+               "shard_idx": 0, "next_row": 2, "done_rows": 0, "error": "", "updated_at": time.time()}
+        with self.lock:
+            self.jobs[source_str] = job; self._save()
+        self._spawn(source_str, job["id"])
+
+    def resume(self, source_str):
+        with self.lock:
+            job = self.jobs.get(source_str)
+            if not job or job["status"] == "done": return
+            job["status"] = "running"; job["error"] = ""; self._save()
+        self._spawn(source_str, job["id"])
+
+    def progress(self, source_str):
+        with self.lock:
+            job = self.jobs.get(source_str)
+            return dict(job) if job else None
+
+    def _spawn(self, source_str, job_id):
+        threading.Thread(target=self._run, args=(source_str, job_id), daemon=True).start()
+
+    def _update(self, source_str, job_id, **fields):
+        """更新進度；作業已被新的取代就回傳 False"""
+        with self.lock:
+            job = self.jobs.get(source_str)
+            if not job or job["id"] != job_id: return False
+            job.update(fields, updated_at=time.time()); self._save()
+            return True
+
+    def _run(self, source_str, job_id):
+        registry = get_archive_registry()
+        # 與年度封存互斥 (兩者都會依列號改寫同一批分頁)
+        while True:
+            with registry["lock"]:
+                if source_str not in registry["running"]:
+                    registry["running"].add(source_str); break
+            time.sleep(5)
+        try:
+            job = self.progress(source_str)
+            if not job or job["id"] != job_id: return
+            if job["shards"] is None:
+                shards = sorted(ws.title for ws in list_worksheets(source_str) if "Transaction" in ws.title)
+                if not self._update(source_str, job_id, shards=shards): return
+                job["shards"] = shards
+            for i in range(job["shard_idx"], len(job["shards"])):
+                if not self._convert_shard(source_str, job_id, job["shards"][i], job["currency"], job["next_row"] if i == job["shard_idx"] else 2): return
+                if not self._update(source_str, job_id, shard_idx=i + 1, next_row=2): return
+            # 封存摘要的金額也是舊幣別，一起重算
+            years = sorted(y for y in (archive_year_of(t) for t in job["shards"]) if y is not None)
+            if years: _write_archive_summary(source_str, years)
+            self._update(source_str, job_id, status="done")
+        except Exception as e:
+            print(f"Redenomination failed ({source_str}): {e}")
+            self._update(source_str, job_id, status="failed", error=str(e))
+        finally:
+            with registry["lock"]: registry["running"].discard(source_str)
+            sync = get_sheet_sync_registry()
+            with sync["lock"]:
+                for key in [k for k in sync["sheets"] if k[0] == source_str]: del sync["sheets"][key]
+            backend = get_storage_backend()
+            if hasattr(backend, "mark_stale"): backend.mark_stale(source_str)
+            invalidate_book_cache(source_str)
+
+    def _convert_shard(self, source_str, job_id, title, currency, start_row):
+        values = with_worksheet(source_str, title, lambda ws: ws.get_all_values())
+        header = _trim_row(values[0]) if values else []
+        if not {"Date", "Currency", "Amount_Original", "Amount_Def"} <= set(header): return True
+        rows = [_pad_row(r, len(header)) for r in values[1:]]
+        pick = lambda name, part: [r[header.index(name)] for r in part]
+        col = _col_letter(header.index("Amount_Def") + 1)
+        for chunk_start in range(start_row, len(rows) + 2, self.chunk_rows):
+            part = rows[chunk_start - 2:chunk_start - 2 + self.chunk_rows]
+            if not part: break
+            amounts = _parse_sheet_amounts(pick("Amount_Original", part))
+            converted = convert_amounts(np.nan_to_num(amounts), pick("Currency", part), currency, dates=pick("Date", part))
+            old = _parse_sheet_amounts(pick("Amount_Def", part))
+            # 沒有原幣金額的列維持原值
+            new = np.where(np.isnan(amounts), old, converted)
+            if not np.allclose(np.nan_to_num(new), np.nan_to_num(old)):
+                cells = [["" if np.isnan(v) else float(v)] for v in new]
+                with self.lock:
+                    if self.jobs.get(source_str, {}).get("id") != job_id: return False
+                with_worksheet(source_str, title, lambda ws: ws.batch_update([{"range": f"{col}{chunk_start}:{col}{chunk_start + len(part) - 1}", "values": cells}]))
+            done = (self.progress(source_str) or {}).get("done_rows", 0) + len(part)
+            if not self._update(source_str, job_id, next_row=chunk_start + len(part), done_rows=done): return False
+        return True
+
+@st.cache_resource
+def get_redenomination_jobs():
+    return RedenominationJobs(REDENOMINATE_STATE_PATH)
+
+# 長期沒登入時最多補登幾個月，避免一次寫入過多資料
+RECURRING_MAX_CATCHUP_MONTHS = 12
+
+def compute_due_recurring(rec_df, today, max_catchup=RECURRING_MAX_CATCHUP_MONTHS):
+    """向量化計算每條規則需要補登的月份 (包含整個錯過的月份)
+    回傳 DataFrame：rule_idx, month_ord (year*12 + month-1), tx_day"""
+    day = pd.to_numeric(rec_df['Day'], errors='coerce').to_numpy()
+    last_run = pd.to_datetime(rec_df['Last_Run_Month'].astype(str).str.strip(), format="%Y-%m", errors='coerce')
+    last_ord = (last_run.dt.year * 12 + last_run.dt.month - 1).to_numpy()
+    cur_ord = today.year * 12 + today.month - 1
+    # 上次執行月份的下一個月開始；從未執行過 (New) 的規則只從本月開始
+    first_ord = np.where(np.isnan(last_ord), cur_ord, last_ord + 1)
+    # 本月還沒到排定日就只補到上個月
+    last_due_ord = np.where(today.day >= day, cur_ord, cur_ord - 1)
+    first_ord = np.maximum(first_ord, last_due_ord - max_catchup + 1)
+    counts = np.where(np.isnan(day), 0, np.clip(last_due_ord - first_ord + 1, 0, None)).astype(int)
+    if counts.sum() == 0: return pd.DataFrame(columns=["rule_idx", "month_ord", "tx_day"])
+
+    rule_pos = np.repeat(np.arange(len(rec_df)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    month_ord = first_ord[rule_pos].astype(int) + offsets
+    month_start = pd.to_datetime({"year": month_ord // 12, "month": month_ord % 12 + 1, "day": 1})
+    # 排定日超過該月天數 (例如 31 號) 就用月底
+    tx_day = np.minimum(day[rule_pos], month_start.dt.days_in_month.to_numpy()).astype(int)
+    return pd.DataFrame({"rule_idx": rec_df.index.to_numpy()[rule_pos], "month_ord": month_ord, "tx_day": tx_day})
+
+def drop_posted_recurring(tx_rows, existing_df):
+    """移除帳上已經有的自動補登列 (同月份、同類別、同金額、同備註)
+    上次寫入交易後 Last_Run_Month 沒更新成功時，同樣的月份會再算成到期，靠這裡避免重複記帳"""
+    if not tx_rows or existing_df.empty or "Note" not in existing_df.columns: return tx_rows
+    auto = existing_df[existing_df["Note"].astype(str).str.startswith("(自動) ")]
+    if auto.empty: return tx_rows
+    key_cols = ["Type", "Main_Category", "Sub_Category", "Currency", "Note"]
+    posted = Counter(zip(auto["Month"].astype(str), *(auto[c].astype(str) for c in key_cols), auto["Amount_Original"].round(2)))
+    kept = []
+    for r in tx_rows:
+        key = (r[0][:7], str(r[1]), str(r[2]), str(r[3]), str(r[5]), r[8], round(r[6], 2))
+        # 同一條規則重複設定兩次時，帳上要有兩筆才算都記過
+        if posted[key] > 0: posted[key] -= 1
+        else: kept.append(r)
+    return kept
+
 def check_and_run_recurring():
     if 'recurring_checked' in st.session_state: return 
     rec_df = get_data("Recurring", CURRENT_SHEET_SOURCE)
     if rec_df.empty: return
     sys_tz = timezone(timedelta(hours=8))
     today = datetime.now(sys_tz)
-    current_month_str = today.strftime("%Y-%m")
-    current_day = today.day
+    due = compute_due_recurring(rec_df, today)
+    if due.empty:
+        st.session_state['recurring_checked'] = True
+        return
+
+    recorder = st.session_state.user_info.get("Nickname", st.session_state.user_info.get("Email"))
+    created_at = str(datetime.now(sys_tz))
+    tx_rows = []; last_runs = {}
+    for rule_idx, month_ord, tx_day in due.itertuples(index=False):
+        row = rec_df.loc[rule_idx]
+        month_str = f"{month_ord // 12:04d}-{month_ord % 12 + 1:02d}"
+        # 本月照舊記在今天，補登的月份記在當月排定日
+        tx_date = today.strftime("%Y-%m-%d") if month_str == today.strftime("%Y-%m") else f"{month_str}-{tx_day:02d}"
+        try: amt_org = float(row['Amount_Original'])
+        except (TypeError, ValueError): continue
+        tx_rows.append([tx_date, row['Type'], row['Main_Category'], row['Sub_Category'], row['Payment_Method'], row['Currency'], amt_org, None, f"(自動) {row['Note']}", created_at, recorder])
+        last_runs[rule_idx] = max(last_runs.get(rule_idx, ""), month_str)
+    tx_rows = drop_posted_recurring(tx_rows, get_current_transactions(CURRENT_SHEET_SOURCE))
+    # 所有補登的金額一次換算
+    if tx_rows:
+        converted = convert_amounts([r[6] for r in tx_rows], [r[5] for r in tx_rows], default_currency_setting, dates=[r[0] for r in tx_rows])
+        for r, amt_target in zip(tx_rows, converted): r[7] = float(amt_target)
+
     executed = 0
-    for idx, row in rec_df.iterrows():
-        try:
-            last_run = str(row['Last_Run_Month']).strip()
-            scheduled_day = int(row['Day'])
-            if last_run != current_month_str and current_day >= scheduled_day:
-                amt_org = float(row['Amount_Original'])
-                curr = row['Currency']
-                amt_target, _ = calculate_exchange(amt_org, curr, default_currency_setting, rates)
-                tx_date = today.strftime("%Y-%m-%d")
-                tx_row = [tx_date, row['Type'], row['Main_Category'], row['Sub_Category'], row['Payment_Method'], curr, amt_org, amt_target, f"(自動) {row['Note']}", str(datetime.now(sys_tz))]
-                if append_data("Transactions", tx_row, CURRENT_SHEET_SOURCE):
-                    update_recurring_last_run(idx, current_month_str, CURRENT_SHEET_SOURCE)
-                    executed += 1
-        except: continue
+    try:
+        if tx_rows:
+            get_storage_backend().append_rows(CURRENT_SHEET_SOURCE, "Transactions", tx_rows)
+            executed = len(tx_rows)
+        # 交易都已記過 (上次只差 Last_Run_Month 沒寫成功) 也要補寫；這次再失敗，下次仍會靠 drop_posted_recurring 跳過
+        if update_recurring_last_runs(last_runs, CURRENT_SHEET_SOURCE): invalidate_book_cache(CURRENT_SHEET_SOURCE, "Recurring")
+        else: get_sheets_metrics().record_error(CURRENT_SHEET_SOURCE, "recurring", "Last_Run_Month 更新失敗")
+    except Exception as e: get_sheets_metrics().record_error(CURRENT_SHEET_SOURCE, "recurring", e)
     if executed > 0:
         st.toast(f"🤖 自動補登了 {executed} 筆固定收支！", icon="✅")
-        st.cache_data.clear()
+        # 新交易直接接到快取 (月份彙總與預算累計一起增量更新)，不必重新下載整本帳
+        patch_cached_transactions(CURRENT_SHEET_SOURCE, tx_rows)
+        st.session_state['recurring_checked'] = True
         time.sleep(1)
         st.rerun()
     st.session_state['recurring_checked'] = True
 
+def _archive_in_background(source_str, current_year):
+    try: result = archive_closed_years(source_str, current_year)
+    except Exception as e: result = (False, str(e))
+    registry = get_archive_registry()
+    with registry["lock"]: registry["results"][source_str] = result
+
+def check_and_archive_closed_years():
+    """每個帳本每隔一段時間檢查一次：Transactions 裡還有往年的交易就在背景搬到年度分頁，完成後下次載入畫面時提示"""
+    registry = get_archive_registry()
+    with registry["lock"]:
+        result = registry["results"].pop(CURRENT_SHEET_SOURCE, None)
+    if result:
+        ok, msg = result
+        if ok: st.toast(f"📦 {msg}")
+        else: print(f"Archive: {msg}")
+    with registry["lock"]:
+        if time.time() - registry["checked_at"].get(CURRENT_SHEET_SOURCE, 0) < ARCHIVE_CHECK_SECONDS: return
+        registry["checked_at"][CURRENT_SHEET_SOURCE] = time.time()
+    current_year = datetime.now(timezone(timedelta(hours=8))).year
+    df_cur = get_current_transactions(CURRENT_SHEET_SOURCE)
+    if df_cur.empty or not (df_cur["Year"] < current_year).any(): return
+    # 複製、驗證、刪除整年的資料可能要很久，不要卡住畫面載入
+    threading.Thread(target=_archive_in_background, args=(CURRENT_SHEET_SOURCE, current_year), daemon=True).start()
+    st.toast("📦 正在背景封存往年交易，完成前仍可正常記帳")
+
 def add_sub_callback(main_cat, key):
     new_val = st.session_state[key]
     if new_val:
@@ -886,7 +3460,7 @@ with st.sidebar:
         new_url = next(b["url"] for b in user_books if b["name"] == selected_book_name)
         if new_url != CURRENT_SHEET_SOURCE:
             st.session_state.current_book_url = new_url; st.session_state.current_book_name = selected_book_name
-            st.cache_data.clear(); st.rerun()
+            st.rerun()
     else: st.success(f"📘 帳本：{DISPLAY_TITLE}")
 
     if plan == "VIP": st.markdown(f"👤 **{nickname_display}** <span class='vip-badge'>  VIP</span>", unsafe_allow_html=True)
@@ -896,11 +3470,39 @@ with st.sidebar:
         except: days_left = 0
         st.markdown(f"👤 **{nickname_display}** <span class='trial-badge'>  {plan}</span>", unsafe_allow_html=True)
         if days_left > 0: st.caption(f"⏳ 試用倒數：**{days_left}** 天"); st.progress(min(days_left / 30, 1.0))
-        else: st.error(f"⛔ 試用期已結束")
+        else: st.error("⛔ 試用期已結束")
 
     if plan != "VIP":
         #st.info("##### 🚀 升級持續使用")
         if st.button("💎 升級 VIP 持續使用", type="primary", use_container_width=True): st.toast("🚧 金流功能開發中")
+
+    write_queue = get_write_queue()
+    pending_sync = write_queue.pending_count(CURRENT_SHEET_SOURCE)
+    if pending_sync > 0:
+        st.caption(f"⏳ 尚有 **{pending_sync}** 筆記帳等待同步至 Google Sheets")
+        sync_error = write_queue.last_error(CURRENT_SHEET_SOURCE)
+        if sync_error: st.caption(f"⚠️ 同步重試中：{sync_error}")
+    dead_sync = write_queue.dead_items(CURRENT_SHEET_SOURCE)
+    if dead_sync:
+        # 停止重試的記帳不會出現在帳本裡：列出來讓使用者重新同步或下載保存，不會默默消失
+        with st.expander(f"❌ {len(dead_sync)} 筆記帳同步失敗，已停止重試", expanded=True):
+            st.caption("請確認帳本仍可存取後重新同步，或先下載保存")
+            dead_header = get_transactions_header(CURRENT_SHEET_SOURCE)
+            dead_df = pd.DataFrame([_pad_row([str(v) for v in it["row"]], len(dead_header)) for it in dead_sync], columns=dead_header)
+            dead_df["Error"] = [it.get("error", "") for it in dead_sync]
+            st.dataframe(dead_df, use_container_width=True, hide_index=True)
+            c_retry, c_dl = st.columns(2)
+            if c_retry.button("🔁 重新同步", key="retry_dead_rows", use_container_width=True):
+                write_queue.retry_dead(CURRENT_SHEET_SOURCE); st.rerun()
+            c_dl.download_button("⬇️ 下載 CSV", dead_df.to_csv(index=False).encode("utf-8-sig"), file_name="unsynced_transactions.csv",
+                                 mime="text/csv", key="download_dead_rows", use_container_width=True)
+    redenom = get_redenomination_jobs().progress(CURRENT_SHEET_SOURCE)
+    if redenom and redenom["status"] == "running":
+        shard_total = len(redenom["shards"] or []) or "?"
+        st.caption(f"🔁 正在將歷史金額換算為 {redenom['currency']}：分頁 {min(redenom['shard_idx'] + 1, len(redenom['shards'] or [0]))}/{shard_total}，已處理 {redenom['done_rows']} 列")
+    elif redenom and redenom["status"] == "failed":
+        st.caption(f"⚠️ 換算為 {redenom['currency']} 時中斷：{redenom['error']}")
+        if st.button("🔁 繼續換算", key="resume_redenom"): get_redenomination_jobs().resume(CURRENT_SHEET_SOURCE); st.rerun()
     st.divider()
     if st.button("🚪 登出"):
         for key in list(st.session_state.keys()): del st.session_state[key]
@@ -913,6 +3515,12 @@ rates_info = get_exchange_rates()
 rates = rates_info["rates"] 
 # 這樣你原本的 calculate_exchange(..., rates) 就不會再報錯了
 
+# --- 登入後在背景預載其他帳本，切換帳本時就不必冷啟動 ---
+if 'books_prefetched' not in st.session_state:
+    st.session_state['books_prefetched'] = True
+    prefetch_books([b["url"] for b in st.session_state.user_info.get("Books", []) if b["url"] != CURRENT_SHEET_SOURCE])
+wait_for_prefetch(CURRENT_SHEET_SOURCE)
+
 # --- 讀取設定 ---
 settings_df = get_data("Settings", CURRENT_SHEET_SOURCE)
 cat_mapping = {}; payment_list = []; currency_list_custom = []; default_currency_setting = "TWD" 
@@ -955,9 +3563,13 @@ def save_all_to_sheet():
     final_df["Currency"] = pd.Series(list_curr).reindex(range(max_len)).fillna("")
     final_df["Default_Currency"] = ""
     if len(final_df) > 0: final_df.at[0, "Default_Currency"] = st.session_state.get('temp_default_curr', default_currency_setting)
-    if save_settings_data(final_df, CURRENT_SHEET_SOURCE): st.toast("✅ 設定已儲存！", icon="💾"); st.cache_data.clear()
+    ok = save_settings_data(final_df, CURRENT_SHEET_SOURCE)
+    if ok: st.toast("✅ 設定已儲存！", icon="💾"); invalidate_book_cache(CURRENT_SHEET_SOURCE, "Settings")
+    else: st.toast("設定儲存失敗，請稍後再試", icon="⚠️")
+    return ok
 
 check_and_run_recurring()
+check_and_archive_closed_years()
 
 # --- Tabs Content ---
 tab1, tab2, tab3 = st.tabs(["📝 每日記帳", "📊 收支分析", "⚙️ 系統設定"])
@@ -971,21 +3583,14 @@ with tab1:
     
     def on_input_change():
         c = st.session_state.form_currency; a = st.session_state.form_amount_org
-        val, _ = calculate_exchange(a, c, default_currency_setting, rates)
+        val, _ = calculate_exchange(a, c, default_currency_setting, rates, on_date=st.session_state.get("form_date"))
         st.session_state.form_amount_def = val
 
     user_today = today_date 
-    # --- 修正後的 Dashboard 計算 ---
-    df_all_raw = get_all_transactions(CURRENT_SHEET_SOURCE)
-    total_inc = 0; total_exp = 0
+    # --- 修正後的 Dashboard 計算 (讀月份彙總，不必掃描全部交易) ---
+    monthly_cube = get_monthly_cube(CURRENT_SHEET_SOURCE)
     today_dt = datetime.now(); current_month_str = today_dt.strftime("%Y-%m")
-
-    if not df_all_raw.empty:
-        mask = (df_all_raw['Date'].dt.strftime('%Y-%m') == current_month_str)
-        mtx = df_all_raw[mask].copy()
-        if not mtx.empty:
-            total_inc = mtx[mtx['Type'] == '收入']['Amount_Def'].sum()
-            total_exp = mtx[mtx['Type'] != '收入']['Amount_Def'].sum()
+    total_inc, total_exp = cube_month_totals(monthly_cube, current_month_str)
     
     bal = total_inc - total_exp
     b_cls = "val-green" if bal >= 0 else "val-red"
@@ -997,11 +3602,24 @@ with tab1:
         <div class="metric-card"><span class="metric-label">剩餘可用</span><span class="metric-value {b_cls}">${bal:,.2f}</span></div>
     </div>""", unsafe_allow_html=True)
 
+    # --- 預算提醒 (讀增量維護的各類別累計支出) ---
+    budget_status = get_budget_status(CURRENT_SHEET_SOURCE, current_month_str)
+    for b in budget_status:
+        label = f"{b['Main_Category']} > {b['Sub_Category']}" if b['Sub_Category'] else b['Main_Category']
+        usage = f"{b['Spent']:,.0f} / {b['Budget']:,.0f} {default_currency_setting} ({b['Ratio']:.0%})"
+        if b["Level"] == "over": st.error(f"🚨 {label} 已超出預算：{usage}")
+        elif b["Level"] == "warn": st.warning(f"⚠️ {label} 已使用 {b['Alert_Ratio']:.0%} 以上的預算：{usage}")
+    if budget_status:
+        with st.expander("🎯 本月預算"):
+            for b in budget_status:
+                label = f"{b['Main_Category']} > {b['Sub_Category']}" if b['Sub_Category'] else b['Main_Category']
+                st.progress(min(b["Ratio"], 1.0), text=f"{label}：{b['Spent']:,.0f} / {b['Budget']:,.0f} ({b['Ratio']:.0%})")
+
 
     with st.container():
         st.markdown("##### ✍️ 新增交易")
         c1, c2 = st.columns([1, 1])
-        with c1: date_input = st.date_input("日期", user_today)
+        with c1: date_input = st.date_input("日期", user_today, key="form_date", on_change=on_input_change)
         with c2: payment = st.selectbox("付款方式", payment_list)
         c3, c4 = st.columns([1, 1])
         with c3: main_cat = st.selectbox("大類別", main_cat_list, key="input_main_cat")
@@ -1020,26 +3638,28 @@ with tab1:
         if st.button("確認送出記帳", type="primary", use_container_width=True):
             if amount_def == 0: st.error("金額不能為 0")
             else:
-                with st.spinner('📡 資料寫入中...'):
-                    tx_type = "收入" if main_cat == "收入" else "支出"
-                    row = [str(date_input), tx_type, main_cat, sub_cat, payment, currency, amount_org, amount_def, note, str(datetime.now())]
-                    if append_data("Transactions", row, CURRENT_SHEET_SOURCE):
-                        st.success(f"✅ 已記錄！"); st.session_state['should_clear_input'] = True; st.cache_data.clear(); time.sleep(1); st.rerun()
-                    else: st.error("❌ 寫入失敗")
+                tx_type = "收入" if main_cat == "收入" else "支出"
+                row = [str(date_input), tx_type, main_cat, sub_cat, payment, currency, amount_org, amount_def, note, str(datetime.now())]
+                if queue_append_data("Transactions", row, CURRENT_SHEET_SOURCE):
+                    patch_cached_transactions(CURRENT_SHEET_SOURCE, [row])
+                    st.toast("✅ 已記錄！", icon="💾"); st.session_state['should_clear_input'] = True; st.rerun()
+                else: st.error("❌ 寫入失敗")
 
 # ================= Tab 2: 收支分析 =================
 with tab2:
     st.markdown("##### 📊 收支狀況")
-    df_tx = get_data("Transactions", CURRENT_SHEET_SOURCE)
+    # 圖表只讀月份彙總 (使用中分頁 + 往年封存摘要)，明細才按年度載入
+    display_options = list(dict.fromkeys([default_currency_setting] + currency_list_custom))
+    display_currency = st.selectbox("顯示幣別", display_options, index=0, key="display_currency")
+    if display_currency == default_currency_setting: monthly_cube = get_monthly_cube(CURRENT_SHEET_SOURCE)
+    else:
+        # 其他幣別：用原幣金額依交易日匯率重新換算整段歷史
+        monthly_cube = get_display_cube(CURRENT_SHEET_SOURCE, display_currency)
 
-    if df_tx.empty:
+    if monthly_cube.empty:
         st.info("尚無交易資料")
     else:
-        df_tx['Date'] = pd.to_datetime(df_tx['Date'], errors='coerce')
-        df_tx['Amount_Def'] = pd.to_numeric(df_tx['Amount_Def'], errors='coerce').fillna(0)
-        df_tx['Month'] = df_tx['Date'].dt.strftime('%Y-%m')
-        
-        all_months = sorted(df_tx['Month'].unique())
+        all_months = get_month_index(CURRENT_SHEET_SOURCE)['Month'].tolist()
         
         with st.expander("📅 篩選區間", expanded=True):
             if len(all_months) > 0:
@@ -1048,18 +3668,10 @@ with tab2:
                 with c_sel2: end_month = st.selectbox("結束月份", all_months, index=len(all_months)-1)
                 selected_months = [m for m in all_months if start_month <= m <= end_month]
                 
-                expense_trend = df_tx[(df_tx['Month'].isin(selected_months)) & (df_tx['Type'] != '收入')].groupby('Month')['Amount_Def'].sum().reset_index()
-                expense_trend.rename(columns={'Amount_Def': 'Amount'}, inplace=True)
-                expense_trend['Type'] = '支出'
-                
-                income_trend = df_tx[(df_tx['Month'].isin(selected_months)) & (df_tx['Type'] == '收入')].groupby('Month')['Amount_Def'].sum().reset_index()
-                income_trend.rename(columns={'Amount_Def': 'Amount'}, inplace=True)
-                income_trend['Type'] = '收入'
-                
-                trend_data = pd.concat([expense_trend, income_trend], ignore_index=True)
+                range_cube = monthly_cube[monthly_cube['Month'].isin(selected_months)]
+                trend_data = range_cube.assign(Type=np.where(range_cube['Type'] == '收入', '收入', '支出')).groupby(['Month', 'Type'])['Amount'].sum().reset_index()
                 
                 if not trend_data.empty:
-                    import plotly.express as px
                     fig_trend = px.bar(trend_data, x="Month", y="Amount", color="Type", barmode="group", 
                                      color_discrete_map={"收入": "#2ecc71", "支出": "#ff6b6b"})
                     fig_trend.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)", margin=dict(t=20, l=10, r=10, b=10))
@@ -1069,18 +3681,17 @@ with tab2:
         with st.expander("🗓️ 查看詳細月份", expanded=True):
             target_month = st.selectbox("選擇月份", sorted(all_months, reverse=True))
             
-            month_data = df_tx[df_tx['Month'] == target_month]
-            monthly_income = month_data[month_data['Type'] == '收入']['Amount_Def'].sum()
-            monthly_expense = month_data[month_data['Type'] != '收入']['Amount_Def'].sum()
+            month_cube = monthly_cube[monthly_cube['Month'] == target_month]
+            monthly_income, monthly_expense = cube_month_totals(month_cube, target_month)
             
             st.markdown(f"""
             <div class="metric-container">
                 <div class="metric-card" style="border-left: 5px solid #2ecc71;">
-                    <span class="metric-label">總收入 ({default_currency_setting})</span>
+                    <span class="metric-label">總收入 ({display_currency})</span>
                     <span class="metric-value">${monthly_income:,.2f}</span>
                 </div>
                 <div class="metric-card" style="border-left: 5px solid #ff6b6b;">
-                    <span class="metric-label">總支出 ({default_currency_setting})</span>
+                    <span class="metric-label">總支出 ({display_currency})</span>
                     <span class="metric-value">${monthly_expense:,.2f}</span>
                 </div>
                 <div class="metric-card">
@@ -1090,9 +3701,9 @@ with tab2:
             </div>
             """, unsafe_allow_html=True)
 
-            expense_only_data = month_data[month_data['Type'] != '收入']
+            expense_only_data = month_cube[month_cube['Type'] != '收入']
             if not expense_only_data.empty:
-                pie_data = expense_only_data.groupby("Main_Category")["Amount_Def"].sum().reset_index()
+                pie_data = expense_only_data.groupby("Main_Category")["Amount"].sum().reset_index().rename(columns={"Amount": "Amount_Def"})
                 pie_data = pie_data[pie_data["Amount_Def"] > 0]
                 
                 if not pie_data.empty:
@@ -1105,9 +3716,35 @@ with tab2:
                 
         # [新增] 除錯用明細表
         with st.expander("🔍 檢視本月明細 (除錯用)"):
-            debug_df = month_data[['Date', 'Main_Category', 'Sub_Category', 'Amount_Original', 'Currency', 'Amount_Def', 'Note']].sort_values(by='Date', ascending=False)
+            detail_cols = ['Date', 'Main_Category', 'Sub_Category', 'Amount_Original', 'Currency', 'Amount_Def', 'Note']
+            month_data = query_transactions(CURRENT_SHEET_SOURCE, target_month, target_month, columns=detail_cols).reindex(columns=detail_cols)
+            debug_df = month_data.sort_values(by='Date', ascending=False)
             st.dataframe(debug_df, use_container_width=True)
 
+        # [新增] 跨年度搜尋 (索引建好後每次查詢只碰到符合的列)
+        with st.expander("🔎 搜尋交易"):
+            q_text = st.text_input("關鍵字 (備註、類別、付款方式、記錄者)", key="search_text", placeholder="例如：星巴克、午餐、uber")
+            c_d1, c_d2, c_a1, c_a2 = st.columns(4)
+            with c_d1: q_from = st.date_input("開始日期", value=None, key="search_from")
+            with c_d2: q_to = st.date_input("結束日期", value=None, key="search_to")
+            with c_a1: q_min = st.number_input(f"最低金額 ({default_currency_setting})", value=None, key="search_min")
+            with c_a2: q_max = st.number_input(f"最高金額 ({default_currency_setting})", value=None, key="search_max")
+            c_f1, c_f2, c_f3 = st.columns(3)
+            with c_f1: q_type = st.multiselect("收支", ["支出", "收入"], key="search_type")
+            with c_f2: q_main = st.multiselect("大類", main_cat_list, key="search_main")
+            with c_f3: q_pay = st.multiselect("付款方式", payment_list, key="search_pay")
+            if q_text.strip() or q_from or q_to or q_min is not None or q_max is not None or q_type or q_main or q_pay:
+                date_range = (q_from or date.min, q_to or date.max) if (q_from or q_to) else None
+                amount_range = (q_min if q_min is not None else -np.inf, q_max if q_max is not None else np.inf) if (q_min is not None or q_max is not None) else None
+                search_started = time.perf_counter()
+                found, found_total, facet_counts = search_transactions(CURRENT_SHEET_SOURCE, q_text, amount_range, date_range, {"Type": q_type, "Main_Category": q_main, "Payment_Method": q_pay})
+                st.caption(f"找到 {found_total} 筆，顯示最新 {len(found)} 筆 ({(time.perf_counter() - search_started) * 1000:.0f} ms)")
+                if found_total:
+                    for col, label in [("Main_Category", "大類"), ("Payment_Method", "付款方式"), ("Recorder", "記錄者")]:
+                        top = "、".join(f"{k or '(空白)'} {v}" for k, v in facet_counts[col].most_common(6))
+                        st.caption(f"{label}：{top}")
+                    st.dataframe(found.reindex(columns=["Date", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Amount_Original", "Currency", "Amount_Def", "Note", "Recorder"]), use_container_width=True, hide_index=True)
+
 # ================= Tab 3: 設定管理 =================
 with tab3:
     st.markdown("##### ⚙️ 系統資料庫")
@@ -1130,8 +3767,6 @@ with tab3:
                     ok, msg = update_user_nickname(st.session_state.user_info["Email"], new_nick_val)
                     if ok:
                         st.session_state.user_info["Nickname"] = new_nick_val
-                        get_all_users_nickname_map.clear()
-                        st.cache_data.clear()
                         st.success(msg)
                         time.sleep(1)
                         st.rerun()
@@ -1169,7 +3804,7 @@ with tab3:
                         if ok:
                             st.success(f"已退出 {selected_manage_book_name}")
                             time.sleep(1)
-                            st.cache_data.clear()
+                            invalidate_book_cache(target_url)
                             if target_url == st.session_state.get("current_book_url"):
                                 del st.session_state["current_book_url"]
                             st.rerun()
@@ -1232,7 +3867,6 @@ with tab3:
                                                     ok, msg = transfer_book_ownership(target_url, my_email, m["Email"], book_name=selected_manage_book_name)
                                                     if ok:
                                                         st.success(msg)
-                                                        st.cache_data.clear()
                                                         time.sleep(2)
                                                         st.rerun()
                                                     else:
@@ -1246,7 +3880,7 @@ with tab3:
                                     if st.button("🚪 退出", key=f"leave_{idx}", type="primary", use_container_width=True):
                                         ok, msg = remove_binding_from_db(my_email, target_url, operator_email=my_email, book_name=selected_manage_book_name)
                                         if ok: 
-                                            st.success("已退出"); time.sleep(1); st.cache_data.clear()
+                                            st.success("已退出"); time.sleep(1); invalidate_book_cache(target_url)
                                             if target_url == st.session_state.get("current_book_url"): del st.session_state["current_book_url"]
                                             st.rerun()
                                         else: st.error(msg)
@@ -1260,18 +3894,21 @@ with tab3:
         c_inv, c_book = st.columns(2)
         with c_inv:
             with st.popover("➕ 邀請成員加入此帳本", use_container_width=True):
-                st.write("請輸入對方的註冊 Email")
-                invite_email = st.text_input("對方 Email")
+                st.write("請輸入對方的註冊 Email (多人可用逗號或換行分隔)")
+                invite_email = st.text_area("對方 Email", height=80)
                 if st.button("發送邀請"):
                     target_book_invite = next((b for b in user_books if b["name"] == selected_manage_book_name), None)
+                    invite_list = list(dict.fromkeys(e for e in re.split(r"[\s,;]+", invite_email) if e))
                     if target_book_invite:
-                        if invite_email:
-                            ok, msg = add_binding(invite_email, target_book_invite["url"], selected_manage_book_name, role="Member", operator_email=st.session_state.user_info["Email"])
-                            if ok: 
-                                st.success(msg)
+                        if invite_list:
+                            # 邀請信都排入 outbox，背景用同一條 SMTP 連線一起寄出
+                            results = [(e,) + add_binding(e, target_book_invite["url"], selected_manage_book_name, role="Member", operator_email=st.session_state.user_info["Email"]) for e in invite_list]
+                            for e, ok, msg in results:
+                                if ok: st.success(f"{e}：{msg}")
+                                else: st.error(f"{e}：{msg}")
+                            if all(ok for _, ok, _ in results):
                                 time.sleep(1)
                                 st.rerun()
-                            else: st.error(msg)
                         else: st.warning("請輸入 Email")
         with c_book:
             with st.popover("➕ 綁定其他帳本", use_container_width=True):
@@ -1282,7 +3919,7 @@ with tab3:
                     if new_sheet_url and new_book_name:
                         ok, msg = add_binding(st.session_state.user_info["Email"], new_sheet_url, new_book_name, "Owner", operator_email=st.session_state.user_info["Email"])
                         if ok: 
-                            st.success("綁定成功！請重新登入生效"); time.sleep(2); st.cache_data.clear(); st.rerun()
+                            st.success("綁定成功！請重新登入生效"); time.sleep(2); st.rerun()
                         else: st.error(msg)
     
     with st.expander("🔄 每月固定收支"):
@@ -1306,7 +3943,7 @@ with tab3:
             if st.button("儲存規則", type="primary", use_container_width=True):
                 rt = "收入" if rec_main == "收入" else "支出"
                 if append_data("Recurring", [rec_day, rt, rec_main, rec_sub, rec_pay, rec_curr, rec_amt_org, rec_note, "New", "Active"], CURRENT_SHEET_SOURCE):
-                    st.success("規則已新增"); st.cache_data.clear(); time.sleep(1); st.rerun()
+                    st.success("規則已新增"); invalidate_book_cache(CURRENT_SHEET_SOURCE, "Recurring"); time.sleep(1); st.rerun()
         st.markdown("---")
         rec_df = get_data("Recurring", CURRENT_SHEET_SOURCE)
         if not rec_df.empty:
@@ -1316,7 +3953,65 @@ with tab3:
                     with c1: st.write(f"📝 {row['Note']} ({row['Payment_Method']})")
                     with c2: 
                         if st.button("🗑️", key=f"del_{idx}"):
-                             if delete_recurring_rule(idx, CURRENT_SHEET_SOURCE): st.toast("已刪除"); st.cache_data.clear(); time.sleep(1); st.rerun()
+                             if delete_recurring_rule(idx, CURRENT_SHEET_SOURCE): st.toast("已刪除"); invalidate_book_cache(CURRENT_SHEET_SOURCE, "Recurring"); time.sleep(1); st.rerun()
+
+    with st.expander("🎯 每月預算"):
+        st.caption(f"月份填 YYYY-MM，留空或填 * 代表每個月；次類別留空代表整個大類。金額以 {default_currency_setting} 計，使用比例達到提醒比例時首頁會顯示警示。")
+        budget_edit = st.data_editor(
+            load_budget_table(CURRENT_SHEET_SOURCE), num_rows="dynamic", use_container_width=True, hide_index=True, key="budget_editor",
+            column_config={
+                "Month": st.column_config.TextColumn("月份"),
+                "Main_Category": st.column_config.SelectboxColumn("大類別", options=[c for c in main_cat_list if c != "收入"]),
+                "Sub_Category": st.column_config.TextColumn("次類別"),
+                "Amount": st.column_config.NumberColumn(f"預算 ({default_currency_setting})", min_value=0.0, step=100.0),
+                "Alert_Ratio": st.column_config.NumberColumn("提醒比例 (0~1)", min_value=0.01, max_value=1.0, step=0.05),
+            })
+        if st.button("儲存預算", key="save_budgets", type="primary", use_container_width=True):
+            if save_budgets(budget_edit, CURRENT_SHEET_SOURCE): st.toast("預算已儲存", icon="✅"); st.rerun()
+            else: st.error("儲存失敗，請稍後再試")
+
+    with st.expander("📥 匯入銀行對帳單 (CSV / OFX)"):
+        st.caption("重複匯入同一份檔案時，帳本裡已經有的交易會自動略過。")
+        import_file = st.file_uploader("選擇檔案", type=["csv", "ofx", "qfx"], key="import_file")
+        if import_file is not None:
+            is_ofx = import_file.name.lower().endswith((".ofx", ".qfx"))
+            if is_ofx: import_mapping = dict(OFX_MAPPING)
+            else:
+                try: file_cols = [str(c) for c in read_csv_header(import_file)]
+                except Exception as e: file_cols = []; st.error(f"無法讀取檔案: {e}")
+                guessed = guess_import_mapping(file_cols)
+                st.markdown("###### 欄位對應")
+                map_options = ["(無)"] + file_cols
+                import_mapping = {}
+                map_cols = st.columns(3)
+                for i, field in enumerate(IMPORT_FIELDS):
+                    with map_cols[i % 3]:
+                        picked = st.selectbox(IMPORT_FIELD_LABELS[field], map_options, index=map_options.index(guessed[field]) if field in guessed else 0, key=f"imp_map_{field}")
+                    if picked != "(無)": import_mapping[field] = picked
+            c1, c2, c3 = st.columns(3)
+            with c1: imp_currency = st.selectbox("預設幣別", currency_list_custom, index=currency_list_custom.index(default_currency_setting) if default_currency_setting in currency_list_custom else 0, key="imp_currency")
+            with c2: imp_payment = st.selectbox("付款方式", payment_list or [""], key="imp_payment")
+            with c3: imp_sign = st.selectbox("金額正負號", ["負數為支出", "正數為支出"], key="imp_sign")
+            if st.button("開始匯入", type="primary", use_container_width=True):
+                if "Date" not in import_mapping or not ({"Amount", "Debit", "Credit"} & set(import_mapping)):
+                    st.error("至少要對應「日期」與「金額」(或支出 / 存入金額) 欄位")
+                else:
+                    history = query_transactions(CURRENT_SHEET_SOURCE, columns=["Note", "Main_Category", "Sub_Category"])
+                    import_ctx = {"expense_positive": imp_sign == "正數為支出", "currency": imp_currency, "payment": imp_payment,
+                                  "target_currency": default_currency_setting, "cat_mapping": cat_mapping,
+                                  "rules": build_category_rules(cat_mapping, history)}
+                    bar = st.progress(0.0, text="匯入中...")
+                    file_size = max(import_file.size, 1)
+                    def _import_progress(stats):
+                        try: done = min(import_file.tell() / file_size, 1.0)
+                        except ValueError: done = 1.0
+                        bar.progress(done, text=f"已讀取 {stats['read']} 列，寫入 {stats['imported']} 筆")
+                    import_file.seek(0)
+                    chunks = iter_ofx_chunks(import_file) if is_ofx else iter_csv_chunks(import_file)
+                    recorder = st.session_state.user_info.get("Nickname", st.session_state.user_info.get("Email"))
+                    ok, msg, _ = import_transactions(CURRENT_SHEET_SOURCE, chunks, import_mapping, import_ctx, recorder, progress=_import_progress)
+                    if ok: st.success(msg)
+                    else: st.error(msg)
 
     with st.expander("📂 類別與子類別"):
         with st.popover("➕ 新增大類", use_container_width=True):
@@ -1353,14 +4048,66 @@ with tab3:
             st.text_input("nc", key="nc", label_visibility="collapsed")
         with c2: st.button("加入", key="bc", on_click=add_curr_callback, args=("nc",))
         st.markdown("<br>", unsafe_allow_html=True)
-        try: di = st.session_state.temp_curr_list.index(st.session_state.temp_default_curr)
-        except: di = 0
-        nd = st.selectbox("預設幣別", st.session_state.temp_curr_list, index=di, key="sel_def")
-        if nd != st.session_state.temp_default_curr: st.session_state.temp_default_curr = nd; save_all_to_sheet(); st.toast("已更新")
+        # 目前的預設幣別不在常用清單時也列出來，避免選單退回第一個幣別被當成要更改
+        cur_def = st.session_state.temp_default_curr
+        def_options = st.session_state.temp_curr_list + ([cur_def] if cur_def not in st.session_state.temp_curr_list else [])
+        nd = st.selectbox("預設幣別", def_options, index=def_options.index(cur_def), key="sel_def")
+        if nd != cur_def:
+            st.caption(f"更改預設幣別會把所有歷史交易的折合金額重新換算為 {nd}，帳本較大時需要一段時間。")
+            if st.button(f"確認改為 {nd} 並換算歷史金額", key="confirm_def_curr", type="primary", use_container_width=True):
+                st.session_state.temp_default_curr = nd
+                if save_all_to_sheet():
+                    # 既有交易的 Amount_Def 還是舊幣別，背景重新換算
+                    get_redenomination_jobs().start(CURRENT_SHEET_SOURCE, nd); st.toast("已更新，正在背景重新換算歷史金額")
+                    st.rerun()
+                else: st.session_state.temp_default_curr = cur_def
 
-    st.markdown(f"##### 💱 即時匯率參考")
+    st.markdown("##### 💱 即時匯率參考")
     st.caption(f"資料來源：{rates_info.get('source')} | 更新時間：{rates_info.get('time')}")
     with st.expander("查看當前匯率清單"):
         sorted_rates = dict(sorted(rates.items(), key=lambda item: item[1], reverse=True))
         df_rates = pd.DataFrame(list(sorted_rates.items()), columns=['幣別', f'折合 {default_currency_setting}'])
-        st.dataframe(df_rates, use_container_width=True, height=300)
\ No newline at end of file
+        st.dataframe(df_rates, use_container_width=True, height=300)
+
+# ==========================================
+# [新增] 隱藏的診斷面板 (網址加上 ?diag=1)
+# ==========================================
+def diag_allowed():
+    """診斷面板只開放給 secrets 的 diag_admins (Email 清單)，或網址的 token 與 diag_token 相同；都沒設定就不開放"""
+    admins = {str(e).strip().lower() for e in st.secrets.get("diag_admins", [])}
+    email = str(st.session_state.get("user_info", {}).get("Email", "")).strip().lower()
+    if email and email in admins: return True
+    token = str(st.secrets.get("diag_token", ""))
+    return bool(token) and hmac.compare_digest(token, str(st.query_params.get("token", "")))
+
+if st.query_params.get("diag") == "1" and diag_allowed():
+    metrics = get_sheets_metrics()
+    snap = metrics.snapshot()
+    with st.expander("🩺 診斷資訊：Google Sheets API", expanded=True):
+        st.caption(f"統計起點：{datetime.fromtimestamp(snap['started_at']).strftime('%Y-%m-%d %H:%M:%S')} | 本 Session：{metrics.current_session()}")
+        sched = snap["scheduler"]
+        if "email" in st.secrets:
+            mail = get_mail_outbox().snapshot()
+            st.caption(f"郵件：待寄 {mail['pending']} 封、失敗 {mail['failed']} 封" + (f" | 最近錯誤：{mail['last_error']}" if mail["last_error"] else ""))
+        st.caption(f"排程：讀取 {sched.get('read', 0)} / 寫入 {sched.get('write', 0)} 次，合併 {sched.get('coalesced', 0)}、重試 {sched.get('retries', 0)}、排隊 {sched['wait_seconds']} 秒 | 剩餘額度 讀 {sched['read_tokens']} / 寫 {sched['write_tokens']}")
+        if snap["calls"]:
+            df_calls = pd.DataFrame(snap["calls"]).drop(columns=["buckets"]).sort_values("seconds", ascending=False)
+            st.markdown("**API 呼叫 (依帳本 × 方法，依總耗時排序)**")
+            st.dataframe(df_calls, use_container_width=True, hide_index=True)
+        else: st.info("尚無 API 呼叫紀錄")
+        if snap["cache"]:
+            df_cache = pd.DataFrame(snap["cache"])
+            df_cache["hit_rate"] = (df_cache["hits"] / (df_cache["hits"] + df_cache["misses"])).round(3)
+            st.markdown("**資料快取命中率 (依帳本)**")
+            st.dataframe(df_cache, use_container_width=True, hide_index=True)
+        if snap["sessions"]:
+            st.markdown("**各 Session**")
+            st.dataframe(pd.DataFrame(snap["sessions"]).drop(columns=["seen"]).sort_values("calls", ascending=False), use_container_width=True, hide_index=True)
+        if snap["recent_errors"]:
+            st.markdown("**最近的錯誤**")
+            st.dataframe(pd.DataFrame(snap["recent_errors"][::-1]), use_container_width=True, hide_index=True)
+        c_json, c_prom, c_reset = st.columns(3)
+        with c_json: st.download_button("⬇️ JSON", metrics.to_json(), file_name="sheets_metrics.json", mime="application/json")
+        with c_prom: st.download_button("⬇️ Prometheus", metrics.to_prometheus(), file_name="sheets_metrics.prom", mime="text/plain")
+        with c_reset:
+            if st.button("🧹 重設統計"): metrics.reset(); st.rerun()
@@ -0,0 +1,359 @@
+"""
+資料層效能測試：用記憶體內的假 gspread Client 量測 app.py 的讀取 / 彙總路徑
+
+    python benchmarks/bench_data_layer.py                     # 帳本 1k / 10k / 100k 列、使用者 100 / 1k / 10k
+    python benchmarks/bench_data_layer.py --full              # 加上 1M 列帳本與 100k 使用者
+    python benchmarks/bench_data_layer.py --rows 50000 --users 0 --layout yearly --json out.json
+
+每個操作回報：API 呼叫次數 (依方法)、被配額擋下的 429 次數、實際執行時間 (wall)、
+模擬的 API 延遲總和 (api，依 LatencyModel 逐次累加，不計平行)、tracemalloc 量到的記憶體峰值。
+app.py 是 Streamlit 腳本，這裡只載入它的函式 / 類別 / 常數定義 (不執行畫面)，
+再把 get_gspread_client 換成包在 InstrumentedGspread 裡的假 Client (與正式環境一樣經過排程與監控)、
+time.sleep 換成模擬時間。
+"""
+import argparse
+import ast
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_gspread import DEFAULT_QUOTA_PER_MINUTE, FakeClient, LatencyModel, SimClock  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+ADMIN_URL = "https://bench.local/admin"
+BOOK_URL = "https://bench.local/book/main"
+PASSWORD = "bench-password"
+DEFAULT_ROWS = [1_000, 10_000, 100_000]
+DEFAULT_USERS = [100, 1_000, 10_000]
+FULL_ROWS = DEFAULT_ROWS + [1_000_000]
+FULL_USERS = DEFAULT_USERS + [100_000]
+
+CATEGORIES = {"收入": ["薪資", "獎金", "利息"], "食": ["早餐", "午餐", "晚餐", "飲料"], "行": ["捷運", "加油", "停車"],
+              "住": ["房租", "水電", "網路"], "樂": ["電影", "旅遊", "訂閱"], "購物": ["日用品", "服飾", "3C"]}
+PAYMENTS = ["現金", "信用卡", "悠遊卡", "轉帳"]
+NOTES = ["全家", "7-11", "星巴克", "誠品", "家樂福", "高鐵", "Uber", "Netflix", "Amazon", "麥當勞", "好市多", "午餐便當", "房東", ""]
+RECORDERS = ["小明", "小華", "Alex"]
+TX_HEADER = ["Date", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Amount_Original", "Amount_Def", "Note", "Created_At", "Recorder"]
+USER_HEADER = ["Email", "Sheet_Name", "Join_Date", "Password_Hash", "Status", "Expire_Date", "Plan", "Nickname"]
+BINDING_HEADER = ["Email", "Sheet_URL", "Book_Name", "Role"]
+RECURRING_HEADER = ["Day", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Amount_Original", "Note", "Last_Run_Month", "Status"]
+SETTINGS_HEADER = ["Main_Category", "Sub_Category", "Payment_Method", "Currency", "Default_Currency"]
+UNTHROTTLED_PER_MINUTE = 1_000_000
+DETAIL_COLUMNS = ["Date", "Main_Category", "Sub_Category", "Amount_Original", "Currency", "Amount_Def", "Note"]
+
+
+# ==========================================
+# 載入 app.py 的定義
+# ==========================================
+def _is_definition(node):
+    """只保留 import、函式、類別與全大寫常數；畫面相關的頂層敘述一律略過"""
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)): return True
+    if isinstance(node, ast.Assign):
+        return all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets)
+    return False
+
+
+def load_app(client, clock, path=APP_PATH):
+    with open(path, encoding="utf-8") as f: tree = ast.parse(f.read(), filename=path)
+    module = ast.Module(body=[n for n in tree.body if _is_definition(n)], type_ignores=[])
+    ns = {"__name__": "ledger_app", "__file__": path}
+    exec(compile(module, path, "exec"), ns)
+    # app 內的 time.sleep (退避、提示停留) 改成推進模擬時間
+    ns["time"] = types.SimpleNamespace(**{k: getattr(time, k) for k in dir(time) if not k.startswith("_")})
+    ns["time"].sleep = clock.sleep
+    ns["get_gspread_client"] = lambda: ns["InstrumentedGspread"](client)
+    ns["CURRENT_SHEET_SOURCE"] = BOOK_URL
+    ns["default_currency_setting"] = "TWD"
+    return ns
+
+
+def prepare_workdir():
+    """在暫存目錄執行：secrets 指向假 Client 的管理表，本機快取 (.ledger_data) 也寫在這裡"""
+    workdir = tempfile.mkdtemp(prefix="ledger-bench-")
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f'admin_sheet_url = "{ADMIN_URL}"\nrate_fetcher = "stub"\nstorage_backend = "sheets"\n')
+        # 排程的 token bucket 以真實時間補充，模擬時間下不讓它等待；配額由假 Client 丟出 429 模擬
+        f.write(f'sheets_read_per_minute = {UNTHROTTLED_PER_MINUTE}\nsheets_write_per_minute = {UNTHROTTLED_PER_MINUTE}\n')
+    os.chdir(workdir)
+    return workdir
+
+
+# ==========================================
+# 測試資料
+# ==========================================
+def generate_ledger(n_rows, years=3, seed=0, today=None):
+    """n_rows 筆交易，平均分佈在最近 years 年，依日期排序 (與實際逐筆新增的順序相同)"""
+    rng = np.random.default_rng(seed)
+    today = today or date.today()
+    start = date(today.year - years + 1, 1, 1)
+    days = np.sort(rng.integers(0, (today - start).days + 1, n_rows))
+    dates = (np.datetime64(start) + days.astype("timedelta64[D]")).astype(str)
+    mains = list(CATEGORIES)
+    main_idx = np.where(rng.random(n_rows) < 0.1, 0, rng.integers(1, len(mains), n_rows))
+    subs = [CATEGORIES[mains[m]][s % len(CATEGORIES[mains[m]])] for m, s in zip(main_idx.tolist(), rng.integers(0, 4, n_rows).tolist())]
+    currency = rng.choice(["TWD", "USD", "JPY"], n_rows, p=[0.9, 0.05, 0.05])
+    amount = np.round(rng.gamma(2.0, 150.0, n_rows), 0)
+    amount = np.where(main_idx == 0, amount * 40, amount)
+    rate = np.select([currency == "USD", currency == "JPY"], [32.3, 0.21], 1.0)
+    original = np.round(amount / rate, 2)
+    created = [f"{d} 12:00:00+08:00" for d in dates.tolist()]
+    columns = [
+        dates.tolist(),
+        np.where(main_idx == 0, "收入", "支出").tolist(),
+        [mains[m] for m in main_idx.tolist()],
+        subs,
+        rng.choice(PAYMENTS, n_rows).tolist(),
+        currency.tolist(),
+        [f"{v:g}" for v in original.tolist()],
+        [f"{v:g}" for v in amount.tolist()],
+        rng.choice(NOTES, n_rows).tolist(),
+        created,
+        rng.choice(RECORDERS, n_rows).tolist(),
+    ]
+    return [list(r) for r in zip(*columns)]
+
+
+def generate_directory(n_users, book_url=BOOK_URL, pwd_hash="", seed=0):
+    """Users / Book_Bindings：每人一本自己的帳本，約三分之一的人另外被邀請到別人的帳本
+    最後一位使用者擁有效能測試用的帳本 (目錄查詢的最差情況)"""
+    rng = random.Random(seed)
+    users = [USER_HEADER]; bindings = [BINDING_HEADER]
+    for i in range(n_users):
+        email = f"user{i:06d}@bench.local"
+        url = book_url if i == n_users - 1 else f"https://bench.local/book/{i}"
+        users.append([email, url, "2025-01-01", pwd_hash, "Active", "2099-12-31", "VIP" if i % 5 == 0 else "Pro", f"U{i}"])
+        bindings.append([email, url, f"帳本{i}", "Owner"])
+        if i % 3 == 0 and n_users > 1:
+            other = rng.randrange(n_users)
+            bindings.append([email, f"https://bench.local/book/{other}", f"帳本{other}", "Member"])
+    return users, bindings
+
+
+def generate_recurring(n_rules, today=None):
+    today = today or date.today()
+    last_run = f"{today.year - 1:04d}-{today.month:02d}"
+    mains = list(CATEGORIES)
+    rows = [RECURRING_HEADER]
+    for i in range(n_rules):
+        main = mains[1 + i % (len(mains) - 1)]
+        rows.append([str(1 + i % 28), "支出", main, CATEGORIES[main][0], PAYMENTS[i % len(PAYMENTS)], ["TWD", "USD", "JPY"][i % 3], str(100 + i), f"rule {i}", last_run, "Active"])
+    return rows
+
+
+def build_book_sheets(ledger, layout, n_rules):
+    """layout = single (全部在 Transactions) 或 yearly (往年已封存到 Transactions_YYYY)"""
+    pairs = [(m, s) for m, subs in CATEGORIES.items() for s in subs]
+    settings = [SETTINGS_HEADER] + [[m, s, PAYMENTS[i] if i < len(PAYMENTS) else "", "TWD" if i == 0 else "", "TWD" if i == 0 else ""] for i, (m, s) in enumerate(pairs)]
+    sheets = {"Settings": settings, "Recurring": generate_recurring(n_rules)}
+    if layout == "single":
+        sheets["Transactions"] = [TX_HEADER] + ledger
+        return sheets, []
+    current_year = date.today().year
+    by_year = {}
+    for r in ledger: by_year.setdefault(int(r[0][:4]), []).append(r)
+    sheets["Transactions"] = [TX_HEADER] + by_year.pop(current_year, [])
+    for y, rows in sorted(by_year.items()): sheets[f"Transactions_{y}"] = [TX_HEADER] + rows
+    sheets["Archive_Log"] = [["Year", "Rows", "Checksum", "Status", "Updated_At"]] + [[str(y), str(len(rows)), "", "done", ""] for y, rows in sorted(by_year.items())]
+    return sheets, sorted(by_year)
+
+
+# ==========================================
+# 量測
+# ==========================================
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.clock = SimClock(realtime=args.realtime)
+        self.client = FakeClient(latency=LatencyModel(args.latency_ms, args.per_cell_us), quota_per_minute=args.quota, clock=self.clock)
+        self.ns = load_app(self.client, self.clock)
+        self.results = []
+
+    # --- 快取控制 ---
+    def reset_caches(self):
+        """模擬重新啟動：物件快取、同步狀態、資料快取全部清空"""
+        for name in ("get_handle_cache", "get_sheet_sync_registry", "get_book_cache", "get_archive_registry"):
+            self.ns[name].clear()
+        self.ns["get_user_directory"]().invalidate()
+
+    def drop_book_entries(self, *prefixes):
+        """讓資料快取過期 (不給 prefix 就全部)，同步狀態保留"""
+        cache = self.ns["get_book_cache"]()
+        with cache["lock"]:
+            for key in [k for k in cache["entries"] if not prefixes or k[1].startswith(prefixes)]: del cache["entries"][key]
+
+    def load_book(self, n_rows, layout, n_rules):
+        sheets, archived = build_book_sheets(generate_ledger(n_rows, years=self.args.years, seed=self.args.seed), layout, n_rules)
+        self.client.books.pop(BOOK_URL, None)
+        self.client.add_book(BOOK_URL, "效能測試帳本", sheets)
+        self.reset_caches()
+        if archived: self.ns["_write_archive_summary"](BOOK_URL, archived)
+        self.reset_caches()
+
+    def load_directory(self, n_users):
+        users, bindings = generate_directory(n_users, pwd_hash=self.ns["hash_password"](PASSWORD), seed=self.args.seed)
+        self.client.add_book(ADMIN_URL, "admin", {"Users": users, "Book_Bindings": bindings, "System_Logs": [["Time", "Operator", "Action", "Target", "Book", "URL"]]})
+        self.reset_caches()
+        return users[-1][0]
+
+    # --- 執行一個操作 ---
+    def measure(self, name, params, setup, run):
+        recorder = self.client.recorder
+        recorder.reset()
+        error = ""
+        try: setup()
+        except Exception as e: error = f"setup {type(e).__name__}: {e}"
+        recorder.reset()
+        t0 = time.perf_counter()
+        if not error:
+            try: run()
+            except Exception as e: error = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - t0
+        record = dict(params, op=name, calls=recorder.total_calls(), throttled=recorder.throttled, cells=recorder.cells,
+                      wall_ms=round(wall * 1000, 1), api_ms=round(recorder.api_seconds * 1000, 1), methods=recorder.by_method(), error=error)
+        if self.args.memory and not error:
+            # tracemalloc 會拖慢執行，記憶體另外再跑一次
+            recorder.reset(); setup()
+            tracemalloc.start()
+            try: run()
+            except Exception: pass
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            record["peak_mb"] = round(peak / 2**20, 2)
+        self.results.append(record)
+        print(format_row(record), flush=True)
+        return record
+
+    # --- 帳本相關操作 ---
+    def tab2_pipeline(self):
+        """Tab 2 畫面用到的資料運算 (不含繪圖)"""
+        ns = self.ns
+        cube = ns["get_monthly_cube"](BOOK_URL)
+        months = ns["get_month_index"](BOOK_URL)["Month"].tolist()
+        if not months: return
+        trend = cube.assign(Type=np.where(cube["Type"] == "收入", "收入", "支出")).groupby(["Month", "Type"])["Amount"].sum().reset_index()
+        target = months[-1]
+        month_cube = cube[cube["Month"] == target]
+        ns["cube_month_totals"](month_cube, target)
+        month_cube[month_cube["Type"] != "收入"].groupby("Main_Category")["Amount"].sum()
+        ns["query_transactions"](BOOK_URL, target, target, columns=DETAIL_COLUMNS).sort_values(by="Date", ascending=False)
+        return trend
+
+    def bench_ledger(self, n_rows):
+        args, ns = self.args, self.ns
+        params = {"rows": n_rows, "users": None, "layout": args.layout}
+        self.load_book(n_rows, args.layout, args.rules)
+        book = self.client.books[BOOK_URL]
+        today = date.today()
+        this_month = f"{today.year:04d}-{today.month:02d}"
+        warm = lambda: ns["get_all_transactions"](BOOK_URL)
+
+        self.measure("transactions_cold", params, self.reset_caches, warm)
+
+        def append_delta():
+            warm()
+            extra = generate_ledger(args.delta, years=1, seed=args.seed + len(book._find("Transactions").values))
+            book._find("Transactions").values.extend(extra)
+            self.drop_book_entries(ns["TX_CACHE_KEY"], ns["CUBE_CACHE_KEY"])
+        self.measure("transactions_delta", params, append_delta, warm)
+        self.measure("query_month", params, warm, lambda: ns["query_transactions"](BOOK_URL, this_month, this_month, columns=DETAIL_COLUMNS))
+        self.measure("tab2_cold", params, self.reset_caches, self.tab2_pipeline)
+
+        def warm_frame_only():
+            self.tab2_pipeline()
+            self.drop_book_entries(ns["CUBE_CACHE_KEY"])
+        self.measure("tab2_rebuild_cube", params, warm_frame_only, self.tab2_pipeline)
+        self.measure("tab2_warm", params, self.tab2_pipeline, self.tab2_pipeline)
+
+        tx_sheet = book._find("Transactions"); rec_sheet = book._find("Recurring")
+        tx_len = len(tx_sheet.values); rec_values = [list(r) for r in rec_sheet.values]
+        def recurring_setup():
+            # 每次都從同一個狀態開始：移除上次補登的交易、還原 Last_Run_Month
+            del tx_sheet.values[tx_len:]
+            rec_sheet.values = [list(r) for r in rec_values]
+            self.drop_book_entries()
+            ns["get_sheet_sync_registry"].clear()
+            ns["st"].session_state["user_info"] = {"Email": "bench@bench.local", "Nickname": "bench"}
+            ns["st"].session_state.pop("recurring_checked", None)
+            warm(); ns["get_data"]("Recurring", BOOK_URL)
+        self.measure("recurring_catchup", dict(params, rules=args.rules), recurring_setup, ns["check_and_run_recurring"])
+
+    # --- 使用者目錄相關操作 ---
+    def bench_users(self, n_users):
+        email = self.load_directory(n_users)
+        params = {"rows": None, "users": n_users, "layout": None}
+        login = lambda: self._login(email)
+        def cold():
+            self.ns["get_handle_cache"].clear()
+            self.ns["get_user_directory"]().invalidate()
+        self.measure("login_cold", params, cold, login)
+        self.measure("login_warm", params, login, login)
+
+    def _login(self, email):
+        ok, info = self.ns["handle_user_login"](email, PASSWORD)
+        if not ok: raise RuntimeError(info)
+
+
+def format_row(r):
+    size = f"rows={r['rows']:,}" if r["rows"] is not None else f"users={r['users']:,}"
+    mem = f"{r['peak_mb']:>9.2f} MB" if "peak_mb" in r else ""
+    methods = " ".join(f"{k}={v}" for k, v in sorted(r["methods"].items()))
+    line = f"{r['op']:<20} {size:<16} calls={r['calls']:<4} 429={r['throttled']:<3} wall={r['wall_ms']:>10.1f} ms  api={r['api_ms']:>10.1f} ms {mem}  [{methods}]"
+    return line + (f"  ERROR {r['error']}" if r["error"] else "")
+
+
+def parse_sizes(text):
+    return [int(float(s)) for s in text.split(",") if s.strip()] if text else []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="app.py 資料層效能測試 (假 gspread Client)")
+    parser.add_argument("--rows", help="帳本列數，逗號分隔 (預設 1000,10000,100000)")
+    parser.add_argument("--users", help="使用者數，逗號分隔 (預設 100,1000,10000)；0 表示略過")
+    parser.add_argument("--full", action="store_true", help="完整規模：帳本到 1M 列、使用者到 100k")
+    parser.add_argument("--layout", choices=["single", "yearly"], default="single", help="single=全部在 Transactions，yearly=往年已封存")
+    parser.add_argument("--years", type=int, default=3, help="交易分佈的年數")
+    parser.add_argument("--rules", type=int, default=50, help="固定收支規則數 (每條補登 12 個月)")
+    parser.add_argument("--delta", type=int, default=100, help="增量同步測試新增的列數")
+    parser.add_argument("--latency-ms", type=float, default=150.0, help="每次 API 呼叫的基本延遲")
+    parser.add_argument("--per-cell-us", type=float, default=1.0, help="每個儲存格的傳輸延遲 (微秒)")
+    parser.add_argument("--quota", type=int, default=DEFAULT_QUOTA_PER_MINUTE, help="每分鐘讀 / 寫請求上限，0 表示不限")
+    parser.add_argument("--realtime", action="store_true", help="真的等待模擬延遲 (可觀察平行呼叫的效果)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="不量測記憶體峰值")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果另存成 JSON")
+    args = parser.parse_args(argv)
+
+    rows = parse_sizes(args.rows) if args.rows is not None else (FULL_ROWS if args.full else DEFAULT_ROWS)
+    users = parse_sizes(args.users) if args.users is not None else (FULL_USERS if args.full else DEFAULT_USERS)
+    users = [n for n in users if n > 0]
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = prepare_workdir()
+    print(f"# workdir={workdir} latency={args.latency_ms}ms+{args.per_cell_us}us/cell quota={args.quota or '∞'}/min layout={args.layout}", flush=True)
+    bench = Bench(args)
+    bench.load_directory(100)
+    for n in rows: bench.bench_ledger(n)
+    for n in users: bench.bench_users(n)
+
+    if json_path:
+        meta = {"generated_at": datetime.now().isoformat(timespec="seconds"), "args": vars(args)}
+        with open(json_path, "w", encoding="utf-8") as f: json.dump({"meta": meta, "results": bench.results}, f, ensure_ascii=False, indent=2)
+    summary = pd.DataFrame(bench.results).drop(columns=["methods"])
+    print()
+    print(summary.to_string(index=False))
+    return bench.results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+記憶體內的假 gspread Client (效能測試用)
+
+只實作 app.py 會用到的 Spreadsheet / Worksheet 方法，行為比照 Google Sheets API：
+- 每次呼叫依 LatencyModel 計算延遲 (基本延遲 + 每個儲存格的傳輸成本)，累加到 SimClock
+- 每分鐘的讀 / 寫請求數超過配額時丟出 HTTP 429 的 gspread APIError
+- 依 (帳本, 方法) 統計呼叫次數、儲存格數與 429 次數
+"""
+import re
+import threading
+import time
+from collections import Counter, deque
+
+import gspread
+from gspread.utils import rowcol_to_a1
+
+# Sheets API 的預設配額：每個專案每分鐘讀取 / 寫入各 300 次
+DEFAULT_QUOTA_PER_MINUTE = 300
+WRITE_METHODS = {"append_row", "append_rows", "update_cell", "update", "batch_update", "clear", "delete_rows", "add_worksheet", "spreadsheet_batch_update"}
+
+
+class FakeResponse:
+    """模擬 requests.Response，讓 gspread.exceptions.APIError 能正常建構"""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+        self._error = {"code": status_code, "message": message, "status": "RESOURCE_EXHAUSTED" if status_code == 429 else "INVALID_ARGUMENT"}
+
+    def json(self):
+        return {"error": self._error}
+
+
+def api_error(status_code, message):
+    return gspread.exceptions.APIError(FakeResponse(status_code, message))
+
+
+class SimClock:
+    """模擬時間：API 延遲與 app 內的 time.sleep 都累加在這裡，realtime=True 時才真的等待"""
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.lock = threading.Lock()
+        self.elapsed = 0.0
+
+    def now(self):
+        with self.lock: return self.elapsed
+
+    def sleep(self, seconds):
+        seconds = max(float(seconds), 0.0)
+        with self.lock: self.elapsed += seconds
+        if self.realtime: time.sleep(seconds)
+
+
+class LatencyModel:
+    """一次請求的延遲 = base_ms + 儲存格數 × per_cell_us"""
+
+    def __init__(self, base_ms=150.0, per_cell_us=1.0):
+        self.base_ms = base_ms
+        self.per_cell_us = per_cell_us
+
+    def seconds(self, cells):
+        return self.base_ms / 1000.0 + cells * self.per_cell_us / 1e6
+
+
+class Recorder:
+    """呼叫統計 + 配額檢查 (以模擬時間的 60 秒滑動視窗計算)"""
+
+    def __init__(self, clock, latency, quota_per_minute=DEFAULT_QUOTA_PER_MINUTE):
+        self.clock = clock
+        self.latency = latency
+        self.quota = quota_per_minute
+        self.lock = threading.Lock()
+        self.windows = {"read": deque(), "write": deque()}
+        self.reset()
+
+    def reset(self):
+        """清空統計與配額視窗 (每個量測項目各自從滿額開始)"""
+        with self.lock:
+            for window in self.windows.values(): window.clear()
+            self.calls = Counter()
+            self.cells = 0
+            self.throttled = 0
+            self.api_seconds = 0.0
+
+    def record(self, book, method, cells=0):
+        kind = "write" if method in WRITE_METHODS else "read"
+        with self.lock:
+            now = self.clock.now()
+            window = self.windows[kind]
+            while window and now - window[0] >= 60: window.popleft()
+            if self.quota and len(window) >= self.quota:
+                self.throttled += 1
+                throttled = True
+            else:
+                window.append(now)
+                self.calls[(book, method)] += 1
+                self.cells += cells
+                throttled = False
+            cost = self.latency.seconds(0 if throttled else cells)
+            self.api_seconds += cost
+        self.clock.sleep(cost)
+        if throttled: raise api_error(429, f"Quota exceeded for {kind} requests per minute")
+
+    def total_calls(self):
+        with self.lock: return sum(self.calls.values())
+
+    def by_method(self):
+        out = Counter()
+        with self.lock:
+            for (_, method), n in self.calls.items(): out[method] += n
+        return dict(out)
+
+
+def _col_index(letters):
+    n = 0
+    for ch in letters.upper(): n = n * 26 + ord(ch) - 64
+    return n
+
+
+def parse_range(a1):
+    """A1 範圍 -> (r1, c1, r2, c2)，1-based 含頭尾；None 表示開放到底"""
+    a1 = a1.split("!", 1)[1] if "!" in a1 else a1
+    m = re.fullmatch(r"(\d+):(\d+)", a1)
+    if m: return int(m.group(1)), 1, int(m.group(2)), None
+    m = re.fullmatch(r"([A-Za-z]+)(\d*)(?::([A-Za-z]+)(\d*))?", a1)
+    if not m: raise api_error(400, f"Unable to parse range: {a1}")
+    c1 = _col_index(m.group(1)); r1 = int(m.group(2)) if m.group(2) else 1
+    if m.group(3):
+        c2 = _col_index(m.group(3)); r2 = int(m.group(4)) if m.group(4) else None
+    else:
+        c2 = c1; r2 = r1 if m.group(2) else None
+    return r1, c1, r2, c2
+
+
+def _cells(values):
+    return sum(len(r) for r in values)
+
+
+class FakeWorksheet(gspread.Worksheet):
+    # 繼承 gspread 的類別，app 的 InstrumentedGspread 才會把它包起來排程 / 計時；
+    # 不呼叫父類別的 __init__，並用一般屬性蓋掉父類別唯讀的 id / title
+    id = title = None
+
+    def __init__(self, book, sheet_id, title, values):
+        self.book = book
+        self.id = sheet_id
+        self.title = title
+        self.values = [[str(v) for v in r] for r in values]
+
+    def _record(self, method, cells=0):
+        self.book.client.recorder.record(self.book.title, method, cells)
+
+    def _trim(self):
+        while self.values and not any(self.values[-1]): self.values.pop()
+
+    def _slice(self, a1):
+        """API 回傳格式：右側空白儲存格與尾端空白列會被省略"""
+        self._trim()
+        r1, c1, r2, c2 = parse_range(a1)
+        out = []
+        for r in self.values[r1 - 1:r2]:
+            row = r[c1 - 1:c2] if c2 else r[c1 - 1:]
+            while row and row[-1] == "": row = row[:-1]
+            out.append(row)
+        while out and not out[-1]: out.pop()
+        return out
+
+    def _all(self):
+        self._trim()
+        width = max((len(r) for r in self.values), default=0)
+        return [r + [""] * (width - len(r)) if len(r) < width else list(r) for r in self.values]
+
+    def _set(self, row, col, value):
+        while len(self.values) < row: self.values.append([])
+        cells = self.values[row - 1]
+        if len(cells) < col: cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = str(value)
+
+    def _write(self, a1, values):
+        r1, c1, _, _ = parse_range(a1)
+        for i, row in enumerate(values):
+            for j, v in enumerate(row): self._set(r1 + i, c1 + j, v)
+
+    # --- 讀取 ---
+    def get_all_values(self, **kwargs):
+        values = self._all()
+        self._record("get_all_values", _cells(values))
+        return values
+
+    def get_all_records(self, **kwargs):
+        values = self.get_all_values()
+        return [dict(zip(values[0], r)) for r in values[1:]] if values else []
+
+    def get(self, range_name=None, **kwargs):
+        values = self._slice(range_name) if range_name else self._all()
+        self._record("get", _cells(values))
+        return values
+
+    def batch_get(self, ranges, **kwargs):
+        result = [self._slice(r) for r in ranges]
+        self._record("batch_get", sum(_cells(v) for v in result))
+        return result
+
+    def row_values(self, row, **kwargs):
+        values = self._slice(f"{row}:{row}")
+        self._record("row_values", _cells(values))
+        return values[0] if values else []
+
+    def cell(self, row, col, **kwargs):
+        values = self._slice(rowcol_to_a1(row, col))
+        self._record("cell", 1)
+        return gspread.cell.Cell(row, col, values[0][0] if values and values[0] else "")
+
+    def find(self, query, **kwargs):
+        self._record("find", _cells(self.values))
+        for i, r in enumerate(self.values):
+            for j, v in enumerate(r):
+                if v == str(query): return gspread.cell.Cell(i + 1, j + 1, v)
+        return None
+
+    # --- 寫入 ---
+    def append_row(self, values, **kwargs):
+        self._record("append_row", len(values))
+        self._trim(); self.values.append([str(v) for v in values])
+
+    def append_rows(self, values, **kwargs):
+        self._record("append_rows", _cells(values))
+        self._trim(); self.values.extend([str(v) for v in r] for r in values)
+
+    def update_cell(self, row, col, value):
+        self._record("update_cell", 1)
+        self._set(row, col, value)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._record("update", _cells(values))
+        self._write(range_name or "A1", values)
+
+    def batch_update(self, data, **kwargs):
+        self._record("batch_update", sum(_cells(u["values"]) for u in data))
+        for u in data: self._write(u["range"], u["values"])
+
+    def delete_rows(self, start_index, end_index=None):
+        self._record("delete_rows")
+        del self.values[start_index - 1:end_index or start_index]
+
+    def clear(self):
+        self._record("clear")
+        self.values = []
+
+
+class FakeSpreadsheet(gspread.Spreadsheet):
+    url = title = None
+
+    def __init__(self, client, url, title, sheets):
+        self.client = client
+        self.url = url
+        self.title = title
+        self._next_id = 0
+        self.sheets = []
+        for sheet_title, values in sheets.items(): self._add(sheet_title, values)
+
+    def _add(self, title, values):
+        self._next_id += 1
+        ws = FakeWorksheet(self, self._next_id, title, values)
+        self.sheets.append(ws)
+        return ws
+
+    def _find(self, title):
+        return next((ws for ws in self.sheets if ws.title == title), None)
+
+    def worksheet(self, title):
+        self.client.recorder.record(self.title, "worksheet")
+        ws = self._find(title)
+        if ws is None: raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    def worksheets(self, **kwargs):
+        self.client.recorder.record(self.title, "worksheets")
+        return list(self.sheets)
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        self.client.recorder.record(self.title, "add_worksheet")
+        if self._find(title): raise api_error(400, f'A sheet with the name "{title}" already exists.')
+        return self._add(title, [])
+
+    def values_batch_get(self, ranges, params=None, **kwargs):
+        out = []
+        for r in ranges:
+            title, _, a1 = r.partition("!")
+            title = title[1:-1].replace("''", "'") if title.startswith("'") else title
+            ws = self._find(title)
+            if ws is None: raise api_error(400, f"Unable to parse range: {r}")
+            out.append({"range": r, "values": ws._slice(a1) if a1 else ws._all()})
+        self.client.recorder.record(self.title, "values_batch_get", sum(_cells(vr["values"]) for vr in out))
+        return {"spreadsheetId": self.url, "valueRanges": out}
+
+    def batch_update(self, body):
+        self.client.recorder.record(self.title, "spreadsheet_batch_update")
+        for req in body.get("requests", []):
+            rng = req["deleteDimension"]["range"]
+            ws = next(w for w in self.sheets if w.id == rng["sheetId"])
+            del ws.values[rng["startIndex"]:rng["endIndex"]]
+        return {}
+
+
+class FakeClient:
+    """books = {網址: (標題, {分頁名稱: 二維 list})}"""
+
+    def __init__(self, books=None, latency=None, quota_per_minute=DEFAULT_QUOTA_PER_MINUTE, clock=None):
+        self.clock = clock or SimClock()
+        self.recorder = Recorder(self.clock, latency or LatencyModel(), quota_per_minute)
+        self.books = {}
+        for url, (title, sheets) in (books or {}).items(): self.add_book(url, title, sheets)
+
+    def add_book(self, url, title, sheets):
+        self.books[url] = FakeSpreadsheet(self, url, title, sheets)
+        return self.books[url]
+
+    def open_by_url(self, url):
+        self.recorder.record("client", "open_by_url")
+        if url not in self.books: raise gspread.exceptions.SpreadsheetNotFound(url)
+        return self.books[url]
+
+    def open(self, title, **kwargs):
+        self.recorder.record("client", "open")
+        book = next((b for b in self.books.values() if b.title == title), None)
+        if book is None: raise gspread.exceptions.SpreadsheetNotFound(title)
+        return book
@@ -0,0 +1,58 @@
+"""
+app.py 的單元測試共用設定：載入方式與 benchmarks/bench_data_layer.py 相同 (只執行定義，不跑畫面)，
+Sheets 換成 benchmarks/fake_gspread.py 的記憶體假 Client，並經過 app 自己的 InstrumentedGspread 排程 / 監控。
+"""
+import os
+import shutil
+import sys
+
+import pytest
+import streamlit as st
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import bench_data_layer as bench  # noqa: E402
+from fake_gspread import FakeClient, SimClock  # noqa: E402
+
+BOOK_URL = bench.BOOK_URL
+ADMIN_URL = bench.ADMIN_URL
+TX_HEADER = bench.TX_HEADER
+
+
+@pytest.fixture(scope="session")
+def workdir():
+    """secrets 只會讀一次，整個測試共用同一個工作目錄"""
+    cwd = os.getcwd()
+    path = bench.prepare_workdir()
+    yield path
+    os.chdir(cwd)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient(clock=SimClock(), quota_per_minute=0)
+
+
+@pytest.fixture
+def app(workdir, fake_client):
+    """每個測試一份乾淨的 app：清掉跨 Session 的資源快取與本機資料"""
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    shutil.rmtree(os.path.join(workdir, ".ledger_data"), ignore_errors=True)
+    ns = bench.load_app(fake_client, fake_client.clock)
+    fake_client.add_book(ADMIN_URL, "admin", {"Users": [bench.USER_HEADER], "Book_Bindings": [bench.BINDING_HEADER],
+                                               "System_Logs": [["Time", "Operator", "Action", "Target", "Book", "URL"]]})
+    return ns
+
+
+def tx_row(day, main="食", sub="午餐", amount=100, note="", type_="支出", currency="TWD"):
+    """一筆 Transactions 列 (欄位順序同 TX_HEADER)"""
+    return [day, type_, main, sub, "現金", currency, str(amount), str(amount), note, f"{day} 12:00:00+08:00", "小明"]
+
+
+def add_book(client, rows=(), **extra_sheets):
+    """建立測試帳本：Transactions + Settings + 其他指定的分頁"""
+    sheets = {"Settings": [bench.SETTINGS_HEADER, ["食", "午餐", "現金", "TWD", "TWD"], ["收入", "薪資", "", "", ""]],
+              "Transactions": [TX_HEADER] + [list(r) for r in rows]}
+    sheets.update(extra_sheets)
+    return client.add_book(BOOK_URL, "測試帳本", sheets)
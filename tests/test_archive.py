@@ -0,0 +1,46 @@
+from conftest import BOOK_URL, add_book, tx_row
+
+ROWS = [tx_row("2024-06-01", amount=10), tx_row("2025-01-02", amount=20), tx_row("2025-12-31", amount=30), tx_row("2026-01-03", amount=40)]
+
+
+def sheet(fake_client, title):
+    return fake_client.open_by_url(BOOK_URL)._find(title)
+
+
+def cube_totals(app):
+    cube = app["get_monthly_cube"](BOOK_URL)
+    return {m: float(a) for m, a in cube.groupby(cube["Month"].astype(str), observed=True)["Amount"].sum().items()}
+
+
+def test_closed_years_move_to_yearly_sheets(app, fake_client):
+    add_book(fake_client, ROWS)
+    before = cube_totals(app)
+    ok, msg = app["archive_closed_years"](BOOK_URL, 2026)
+    assert ok, msg
+    assert [r[0] for r in sheet(fake_client, "Transactions").values[1:]] == ["2026-01-03"]
+    assert [r[0] for r in sheet(fake_client, "Transactions_2025").values[1:]] == ["2025-01-02", "2025-12-31"]
+    assert [r[0] for r in sheet(fake_client, "Transactions_2024").values[1:]] == ["2024-06-01"]
+    # 往年改從封存摘要彙總，月份統計不變
+    assert cube_totals(app) == before
+
+
+def test_archiving_again_is_a_no_op(app, fake_client):
+    add_book(fake_client, ROWS)
+    assert app["archive_closed_years"](BOOK_URL, 2026)[0]
+    ok, msg = app["archive_closed_years"](BOOK_URL, 2026)
+    assert ok and "0" in msg
+    assert len(sheet(fake_client, "Transactions_2025").values) == 3
+
+
+def test_rows_edited_during_the_copy_are_not_deleted(app, fake_client, monkeypatch):
+    add_book(fake_client, ROWS)
+    copy = app["_copy_year_to_shard"]
+
+    def copy_then_edit(*args):
+        done = copy(*args)
+        sheet(fake_client, "Transactions").values[1][8] = "edited"
+        return done
+    monkeypatch.setitem(app, "_copy_year_to_shard", copy_then_edit)
+    ok, _ = app["archive_closed_years"](BOOK_URL, 2026)
+    assert not ok
+    assert len(sheet(fake_client, "Transactions").values) == 5
@@ -0,0 +1,28 @@
+import random
+
+from conftest import BOOK_URL, add_book, tx_row
+
+
+def test_fake_client_goes_through_scheduler_and_metrics(app, fake_client):
+    add_book(fake_client, [tx_row("2026-01-05")])
+    client = app["get_gspread_client"]()
+    ws = app["open_spreadsheet"](client, BOOK_URL).worksheet("Transactions")
+    assert type(ws).__name__ == "InstrumentedGspread"
+    assert ws.get_all_values()[1][0] == "2026-01-05"
+
+    calls = {(c["book"], c["method"]): c for c in app["get_sheets_metrics"]().snapshot()["calls"]}
+    assert calls[(BOOK_URL, "get_all_values")]["cells"] == 2 * 11
+    assert (BOOK_URL, "worksheet") in calls and (BOOK_URL, "open_by_url") in calls
+    assert app["get_sheets_scheduler"]().snapshot()["read"] == 3
+
+
+def test_throttled_reads_are_retried_by_the_scheduler(app, fake_client):
+    add_book(fake_client, [tx_row("2026-01-05")])
+    random.seed(0)
+    ws = app["open_spreadsheet"](app["get_gspread_client"](), BOOK_URL).worksheet("Transactions")
+    # 開啟帳本與分頁用掉 2 次配額，第 60 秒才滑開：第一次讀取 429，退避後重試成功
+    fake_client.recorder.quota = 2
+    fake_client.clock.sleep(59.7 - fake_client.clock.now())
+    assert len(ws.get_all_values()) == 2
+    assert app["get_sheets_scheduler"]().snapshot()["retries"] >= 1
+    assert fake_client.recorder.throttled >= 1
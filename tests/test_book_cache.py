@@ -0,0 +1,43 @@
+import pandas as pd
+
+from conftest import BOOK_URL
+
+
+def load(app, name, ttl=60, value=None):
+    return app["cached_entry"](BOOK_URL, name, ttl, lambda: value if value is not None else pd.DataFrame({"x": [name]}))
+
+
+def test_entry_count_is_bounded_lru(app, monkeypatch):
+    monkeypatch.setitem(app, "BOOK_CACHE_MAX_ENTRIES", 3)
+    for name in ["a", "b", "c"]: load(app, name)
+    load(app, "a")  # a 變成最近使用
+    load(app, "d")
+    assert [k[1] for k in app["get_book_cache"]()["entries"]] == ["c", "a", "d"]
+
+
+def test_total_bytes_are_bounded(app, monkeypatch):
+    big = pd.DataFrame({"x": range(10_000)})
+    monkeypatch.setitem(app, "BOOK_CACHE_MAX_BYTES", int(big.memory_usage(deep=True).sum() * 2.5))
+    for name in ["a", "b", "c"]: load(app, name, value=big.copy())
+    assert [k[1] for k in app["get_book_cache"]()["entries"]] == ["b", "c"]
+
+
+def test_expired_and_idle_entries_are_swept(app, monkeypatch):
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(app["time"], "time", lambda: clock["now"])
+    load(app, "short", ttl=60)
+    load(app, "archive", ttl=float("inf"))
+    clock["now"] += 120
+    load(app, "other")
+    assert [k[1] for k in app["get_book_cache"]()["entries"]] == ["archive", "other"]
+    clock["now"] += app["BOOK_CACHE_IDLE_SECONDS"] + 1
+    load(app, "other")
+    assert [k[1] for k in app["get_book_cache"]()["entries"]] == ["other"]
+
+
+def test_hit_does_not_reload(app):
+    calls = []
+    loader = lambda: calls.append(1) or pd.DataFrame({"x": [1]})
+    app["cached_entry"](BOOK_URL, "k", 60, loader)
+    app["cached_entry"](BOOK_URL, "k", 60, loader)
+    assert calls == [1]
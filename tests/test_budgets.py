@@ -0,0 +1,28 @@
+from conftest import BOOK_URL, add_book, tx_row
+
+BUDGET_HEADER = ["Month", "Main_Category", "Sub_Category", "Amount", "Alert_Ratio"]
+
+
+def levels(app, month="2026-03"):
+    return {(b["Main_Category"], b["Sub_Category"]): (b["Spent"], b["Alert_Ratio"], b["Level"]) for b in app["get_budget_status"](BOOK_URL, month)}
+
+
+def test_budget_levels_follow_monthly_spend(app, fake_client):
+    add_book(fake_client, [tx_row("2026-03-01", amount=700), tx_row("2026-03-02", sub="晚餐", amount=200), tx_row("2026-02-01", amount=5000)],
+             Budgets=[BUDGET_HEADER, ["*", "食", "", "1000", "0.8"], ["*", "食", "午餐", "1000", ""], ["2026-03", "食", "晚餐", "150", "0.5"]])
+    assert levels(app) == {("食", ""): (900.0, 0.8, "warn"), ("食", "午餐"): (700.0, 0.8, "ok"), ("食", "晚餐"): (200.0, 0.5, "over")}
+
+
+def test_new_transactions_are_added_to_the_cached_spend(app, fake_client):
+    add_book(fake_client, [tx_row("2026-03-01", amount=700)], Budgets=[BUDGET_HEADER, ["*", "食", "", "1000", "0.8"]])
+    assert levels(app)[("食", "")][2] == "ok"
+    calls = fake_client.recorder.total_calls()
+    app["patch_cached_transactions"](BOOK_URL, [tx_row("2026-03-05", amount=150)])
+    assert levels(app)[("食", "")] == (850.0, 0.8, "warn")
+    assert fake_client.recorder.total_calls() == calls
+
+
+def test_alert_ratio_outside_zero_to_one_uses_the_default(app, fake_client):
+    add_book(fake_client, Budgets=[BUDGET_HEADER, ["*", "食", "", "1000", "50"], ["*", "食", "午餐", "1000", "0"], ["*", "收入", "", "1000", "0.3"]])
+    table = app["load_budget_table"](BOOK_URL)
+    assert list(table["Alert_Ratio"]) == [app["BUDGET_DEFAULT_ALERT"], app["BUDGET_DEFAULT_ALERT"], 0.3]
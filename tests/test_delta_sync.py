@@ -0,0 +1,54 @@
+from conftest import BOOK_URL, add_book, tx_row
+
+
+def open_ws(app):
+    return app["open_spreadsheet"](app["get_gspread_client"](), BOOK_URL).worksheet("Transactions")
+
+
+def methods(fake_client):
+    return {m for (_, m) in fake_client.recorder.calls}
+
+
+def test_appended_rows_are_read_incrementally(app, fake_client):
+    book = add_book(fake_client, [tx_row(f"2026-01-{d:02d}") for d in range(1, 21)])
+    ws = open_ws(app)
+    app["sync_worksheet_values"](ws, BOOK_URL)
+    book.worksheet("Transactions").values.append(tx_row("2026-02-01"))
+    fake_client.recorder.reset()
+    header, rows = app["sync_worksheet_values"](ws, BOOK_URL)
+    assert methods(fake_client) == {"batch_get"}
+    assert len(rows) == 21 and rows[-1][0] == "2026-02-01"
+
+
+def test_edit_in_the_tail_triggers_a_full_reload(app, fake_client):
+    book = add_book(fake_client, [tx_row(f"2026-01-{d:02d}") for d in range(1, 21)])
+    ws = open_ws(app)
+    app["sync_worksheet_values"](ws, BOOK_URL)
+    book.worksheet("Transactions").values[-1][8] = "edited"
+    fake_client.recorder.reset()
+    _, rows = app["sync_worksheet_values"](ws, BOOK_URL)
+    assert "get_all_values" in methods(fake_client)
+    assert rows[-1][8] == "edited"
+
+
+def test_edit_to_an_old_row_is_found_within_the_verify_passes(app, fake_client, monkeypatch):
+    monkeypatch.setitem(app, "SYNC_VERIFY_TAIL_ROWS", 5)
+    monkeypatch.setitem(app, "SYNC_VERIFY_BLOCK_ROWS", 1)
+    book = add_book(fake_client, [tx_row("2026-01-01", amount=i) for i in range(1, 101)])
+    ws = open_ws(app)
+    app["sync_worksheet_values"](ws, BOOK_URL)
+    app["sync_worksheet_values"](ws, BOOK_URL)  # 抽查段移到後面，被修改的第 1 列要等下一輪
+    book.worksheet("Transactions").values[1][8] = "edited"
+    for _ in range(app["SYNC_VERIFY_PASSES"]):
+        _, rows = app["sync_worksheet_values"](ws, BOOK_URL)
+        if rows[0][8] == "edited": break
+    assert rows[0][8] == "edited"
+
+
+def test_header_change_triggers_a_full_reload(app, fake_client):
+    book = add_book(fake_client, [tx_row("2026-01-01")])
+    ws = open_ws(app)
+    app["sync_worksheet_values"](ws, BOOK_URL)
+    book.worksheet("Transactions").values[0].append("Extra")
+    header, _ = app["sync_worksheet_values"](ws, BOOK_URL)
+    assert header[-1] == "Extra"
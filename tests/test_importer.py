@@ -0,0 +1,55 @@
+import io
+
+from conftest import BOOK_URL, add_book, tx_row
+
+CSV = "日期,金額,摘要\n2026-01-05,-100,午餐\n2026-01-05,-100,午餐\n2026-01-06,-250,晚餐\n2026-01-07,abc,壞資料\n"
+MAPPING = {"Date": "日期", "Amount": "金額", "Note": "摘要"}
+
+
+def run_import(app, text=CSV):
+    cat_mapping = {"食": ["午餐"], "收入": ["薪資"]}
+    ctx = {"expense_positive": False, "currency": "TWD", "payment": "現金", "target_currency": "TWD",
+           "cat_mapping": cat_mapping, "rules": app["build_category_rules"](cat_mapping)}
+    chunks = app["iter_csv_chunks"](io.BytesIO(text.encode("utf-8")))
+    return app["import_transactions"](BOOK_URL, chunks, MAPPING, ctx, "小明")
+
+
+def imported(book):
+    return [r for r in book._find("Transactions").values[1:] if r[10] == "小明" and r[9] != "2026-01-05 12:00:00+08:00"]
+
+
+def test_reimporting_the_same_file_skips_rows_already_in_the_ledger(app, fake_client):
+    book = add_book(fake_client)
+    ok, _, stats = run_import(app)
+    assert ok and stats == {"read": 4, "imported": 3, "duplicates": 0, "skipped": 1}
+    ok, _, stats = run_import(app)
+    assert ok and stats["imported"] == 0 and stats["duplicates"] == 3
+    assert len(imported(book)) == 3
+
+
+def test_identical_rows_count_against_existing_occurrences(app, fake_client):
+    # 帳上已有一筆 1/5 的午餐：檔案裡的兩筆只再匯入一筆
+    add_book(fake_client, [tx_row("2026-01-05", amount=100, note="午餐")])
+    ok, _, stats = run_import(app)
+    assert ok and stats["imported"] == 2 and stats["duplicates"] == 1
+
+
+def test_throttled_append_is_retried_by_the_scheduler(app, fake_client):
+    book = add_book(fake_client)
+    # 寫入配額剛好用完、幾秒後才滑開：第一次 append_rows 429，排程退避後重試成功
+    recorder = fake_client.recorder; recorder.quota = 100
+    recorder.windows["write"].extend([fake_client.clock.now() - 55] * recorder.quota)
+    ok, _, stats = run_import(app)
+    assert ok and stats["imported"] == 3
+    assert app["get_sheets_scheduler"]().snapshot()["retries"] >= 1
+    assert len(book._find("Transactions").values) == 4
+
+
+def test_exhausted_quota_fails_after_one_round_of_retries(app, fake_client):
+    add_book(fake_client)
+    recorder = fake_client.recorder; recorder.quota = 100
+    recorder.windows["write"].extend([fake_client.clock.now() + 3600] * recorder.quota)
+    ok, msg, stats = run_import(app)
+    assert not ok and stats["imported"] == 0 and "429" in msg
+    # 只有排程那一層在重試，不再疊一層退避
+    assert app["get_sheets_scheduler"]().snapshot()["retries"] == app["SCHEDULER_MAX_RETRIES"]
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+
+from conftest import BOOK_URL, TX_HEADER, add_book, tx_row
+
+
+class BlockingRemote:
+    """包住真正的 SheetsBackend；讀到資料後、回傳前執行 during_read (模擬回應還在路上時其他 Session 的動作)"""
+
+    def __init__(self, app):
+        self.inner = app["SheetsBackend"]()
+        self.during_read = None
+
+    def read_worksheet(self, source_str, worksheet_name):
+        result = self.inner.read_worksheet(source_str, worksheet_name)
+        if self.during_read: self.during_read()
+        return result
+
+    def read_transactions(self, source_str, include=None):
+        result = self.inner.read_transactions(source_str, include)
+        if self.during_read: self.during_read()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+
+def make_backend(app, workdir, remote):
+    return app["LocalSQLiteBackend"](os.path.join(workdir, ".ledger_data", "test.db"), remote, sync_interval=0)
+
+
+def test_remote_read_does_not_hold_the_lock(app, workdir, fake_client):
+    add_book(fake_client, [tx_row("2026-01-05")])
+    remote = BlockingRemote(app)
+    backend = make_backend(app, workdir, remote)
+    acquired = []
+
+    def other_session():
+        t = threading.Thread(target=lambda: acquired.append(backend.lock.acquire(timeout=2) and backend.lock.release() is None))
+        t.start(); t.join()
+    remote.during_read = other_session
+    header, rows = backend.read_worksheet(BOOK_URL, "Transactions")
+    assert acquired == [True]
+    assert header == TX_HEADER and rows[0][0] == "2026-01-05"
+
+
+def test_write_during_remote_read_is_not_overwritten(app, workdir, fake_client):
+    add_book(fake_client, [tx_row("2026-01-05")])
+    remote = BlockingRemote(app)
+    backend = make_backend(app, workdir, remote)
+    backend.read_worksheet(BOOK_URL, "Transactions")
+    # 讀取遠端期間本機新增一筆，而且背景同步已經送完：讀回來的舊資料不能蓋掉它
+    remote.during_read = lambda: (backend.append_rows(BOOK_URL, "Transactions", [tx_row("2026-01-06")]), wait_flushed(backend))
+    _, rows = backend.read_transactions(BOOK_URL)[0][1:]
+    assert [r[0] for r in rows] == ["2026-01-05", "2026-01-06"]
+    remote.during_read = None
+    _, rows = backend.read_transactions(BOOK_URL)[0][1:]
+    assert [r[0] for r in rows] == ["2026-01-05", "2026-01-06"]
+
+
+def wait_flushed(backend, timeout=5):
+    end = time.time() + timeout
+    while backend.pending_count() and time.time() < end: time.sleep(0.01)
+    assert backend.pending_count() == 0
+
+
+def test_failing_worksheet_does_not_block_other_books(app, workdir, fake_client, monkeypatch):
+    add_book(fake_client)
+    backend = make_backend(app, workdir, app["SheetsBackend"]())
+    monkeypatch.setitem(app, "LOCAL_OUTBOX_MAX_ATTEMPTS", 2)
+    backend.append_rows("https://missing.local/book", "Transactions", [tx_row("2026-01-01")])
+    backend.append_rows(BOOK_URL, "Transactions", [tx_row("2026-01-02")])
+    end = time.time() + 10
+    while backend.dead_count() == 0 and time.time() < end: time.sleep(0.05)
+    assert backend.dead_count() == 1 and backend.pending_count() == 0
+    assert fake_client.books[BOOK_URL].worksheet("Transactions").values[-1][0] == "2026-01-02"
@@ -0,0 +1,36 @@
+import json
+import os
+
+SETTINGS = {"sender": "noreply@test.local", "password": "", "host": "127.0.0.1", "port": 9, "security": "none", "timeout": 1.0}
+
+
+def test_otp_mail_stays_in_memory_only(app, workdir):
+    path = os.path.join(workdir, ".ledger_data", "mail_outbox.json")
+    outbox = app["MailOutbox"](path, SETTINGS)
+    otp_id = outbox.enqueue("a@test.local", "驗證碼", "驗證碼：123456", ttl=300)
+    outbox.enqueue("b@test.local", "邀請", "歡迎加入")
+    assert outbox.status(otp_id)["state"] == "pending"
+
+    with open(path, encoding="utf-8") as f: saved = json.load(f)
+    assert [it["to"] for it in saved["pending"]] == ["b@test.local"]
+    assert "123456" not in json.dumps(saved, ensure_ascii=False)
+
+
+def test_otp_mail_left_by_an_older_version_is_not_reloaded(app, workdir):
+    path = os.path.join(workdir, ".ledger_data", "mail_outbox.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    old = [{"id": "1", "to": "a@test.local", "subject": "驗證碼", "body": "驗證碼：654321", "attempts": 0, "next_at": 9e9, "queued_at": 0, "expires_at": 9e9},
+           {"id": "2", "to": "b@test.local", "subject": "邀請", "body": "歡迎", "attempts": 0, "next_at": 9e9, "queued_at": 0, "expires_at": None}]
+    with open(path, "w", encoding="utf-8") as f: json.dump({"pending": old, "failed": []}, f)
+    outbox = app["MailOutbox"](path, SETTINGS)
+    assert [it["id"] for it in outbox.items] == ["2"]
+
+
+def test_expired_otp_mail_is_dropped_without_body(app, workdir):
+    outbox = app["MailOutbox"](os.path.join(workdir, ".ledger_data", "mail_outbox.json"), SETTINGS)
+    with outbox.cond:
+        item = {"id": "x", "to": "a@test.local", "subject": "驗證碼", "body": "驗證碼：111111", "attempts": 6, "next_at": 9e9, "queued_at": 0, "expires_at": 9e9}
+        outbox.items.append(item)
+        outbox._drop(item, "failed", "refused")
+    assert outbox.status("x")["state"] == "failed"
+    assert "body" not in outbox.failed[-1]
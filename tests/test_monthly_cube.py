@@ -0,0 +1,32 @@
+from conftest import BOOK_URL, add_book, tx_row
+
+
+def totals(app, month):
+    return tuple(float(v) for v in app["cube_month_totals"](app["get_monthly_cube"](BOOK_URL), month))
+
+
+def test_cube_totals_match_the_ledger(app, fake_client):
+    add_book(fake_client, [tx_row("2026-03-01", amount=100), tx_row("2026-03-02", sub="晚餐", amount=250),
+                           tx_row("2026-03-05", main="收入", sub="薪資", amount=5000, type_="收入"), tx_row("2026-04-01", amount=80), tx_row("", amount=999)])
+    cube = app["get_monthly_cube"](BOOK_URL)
+    assert totals(app, "2026-03") == (5000.0, 350.0) and totals(app, "2026-04") == (0.0, 80.0)
+    # 沒有日期的列不進彙總；同一組維度合併成一列
+    assert int(cube["Count"].sum()) == 4
+    assert len(cube[(cube["Month"] == "2026-03") & (cube["Type"] == "支出")]) == 2
+
+
+def test_new_rows_update_the_cube_without_reading_sheets(app, fake_client):
+    add_book(fake_client, [tx_row("2026-03-01", amount=100)])
+    assert totals(app, "2026-03") == (0.0, 100.0)
+    calls = fake_client.recorder.total_calls()
+    app["patch_cached_transactions"](BOOK_URL, [tx_row("2026-03-02", amount=40), tx_row("2026-05-01", amount=7)])
+    assert totals(app, "2026-03") == (0.0, 140.0) and totals(app, "2026-05") == (0.0, 7.0)
+    assert fake_client.recorder.total_calls() == calls
+
+
+def test_editing_transactions_rebuilds_the_cube(app, fake_client):
+    book = add_book(fake_client, [tx_row("2026-03-01", amount=100)])
+    assert totals(app, "2026-03") == (0.0, 100.0)
+    book._find("Transactions").values[1][7] = "300"
+    app["invalidate_book_cache"](BOOK_URL, "Transactions")
+    assert totals(app, "2026-03") == (0.0, 300.0)
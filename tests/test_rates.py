@@ -0,0 +1,48 @@
+import os
+import time
+from datetime import date, timedelta
+
+import pytest
+
+
+def wait_for(cond, timeout=5):
+    end = time.time() + timeout
+    while not cond() and time.time() < end: time.sleep(0.01)
+    assert cond()
+
+
+@pytest.fixture
+def service(app, workdir):
+    fetched = []
+
+    def fetcher(on_date=None):
+        fetched.append(on_date)
+        return str(on_date or date.today()), {"TWD": 1.0, "USD": 30.0 if on_date else 32.0}
+    svc = app["RateService"](fetcher, os.path.join(workdir, ".ledger_data", f"rates_{time.time_ns()}.db"))
+    svc.fetched = fetched
+    app["get_rate_service"] = lambda: svc
+    return svc
+
+
+def test_prefetch_fetches_each_date_once(service):
+    service.prefetch(["2025-01-02", "2025-01-02", "2025-01-03"])
+    wait_for(lambda: service.rates_on("2025-01-03")["USD"] == 30.0)
+    assert sorted(d for d in service.fetched if d) == ["2025-01-02", "2025-01-03"]
+
+
+def test_convert_amounts_prefetches_old_dates_without_history(app, service):
+    old = str(date.today() - timedelta(days=400))
+    assert list(app["convert_amounts"]([10], ["USD"], "TWD", dates=[old], latest_rates={"TWD": 1.0, "USD": 31.0})) == [310.0]
+    wait_for(lambda: old in service.fetched)
+    assert list(app["convert_amounts"]([10], ["USD"], "TWD", dates=[old])) == [300.0]
+
+
+def test_calculate_exchange_on_date_falls_back_to_the_given_rates(app, service):
+    today = str(date.today())
+    value, factor = app["calculate_exchange"](10, "USD", "TWD", {"rates": {"TWD": 1.0, "USD": 33.0}}, on_date=today)
+    assert (value, factor) == (330.0, 33.0)
+    # 本機有當天紀錄時用歷史匯率
+    service.prefetch(["2025-06-02"])
+    wait_for(lambda: "2025-06-02" in service.fetched)
+    wait_for(lambda: not service._pending_dates)
+    assert app["calculate_exchange"](10, "USD", "TWD", {"TWD": 1.0, "USD": 33.0}, on_date="2025-06-03")[0] == 300.0
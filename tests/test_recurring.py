@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from conftest import BOOK_URL, add_book
+
+RECURRING_HEADER = ["Day", "Type", "Main_Category", "Sub_Category", "Payment_Method", "Currency", "Amount_Original", "Note", "Last_Run_Month", "Status"]
+
+
+def months_ago(n):
+    today = datetime.now(timezone(timedelta(hours=8)))
+    ord_ = today.year * 12 + today.month - 1 - n
+    return f"{ord_ // 12:04d}-{ord_ % 12 + 1:02d}"
+
+
+def run_recurring(app):
+    st = app["st"]
+    st.session_state["user_info"] = {"Email": "a@b.com", "Nickname": "小明"}
+    st.session_state.pop("recurring_checked", None)
+    try: app["check_and_run_recurring"]()
+    except Exception as e:
+        # 畫面外呼叫 st.rerun 會丟出重新執行的例外
+        assert type(e).__name__ == "RerunException"
+
+
+def test_compute_due_recurring_catches_up_missed_months(app):
+    rec = pd.DataFrame([["31", "2025-11"], ["1", ""]], columns=["Day", "Last_Run_Month"])
+    due = app["compute_due_recurring"](rec, datetime(2026, 2, 28), max_catchup=12)
+    rule0 = due[due["rule_idx"] == 0]
+    assert [f"{m // 12}-{m % 12 + 1:02d}" for m in rule0["month_ord"]] == ["2025-12", "2026-01"]
+    # 排定日超過該月天數就用月底 (2 月 28 日還沒到 31 號，本月不補)
+    assert list(rule0["tx_day"]) == [31, 31]
+    # 從未執行過的規則只從本月開始
+    assert list(due[due["rule_idx"] == 1]["month_ord"]) == [2026 * 12 + 1]
+
+
+def test_failed_last_run_update_does_not_repost(app, fake_client, monkeypatch):
+    book = add_book(fake_client, Recurring=[RECURRING_HEADER, ["1", "支出", "食", "午餐", "現金", "TWD", "500", "房租", months_ago(3), "Active"]])
+    tx = book._find("Transactions")
+    monkeypatch.setitem(app, "update_recurring_last_runs", lambda last_runs, source: False)
+    run_recurring(app)
+    posted = [r for r in tx.values[1:] if r[8] == "(自動) 房租"]
+    assert len(posted) == 3
+    assert book._find("Recurring").values[1][8] == months_ago(3)
+
+    # 下一個 Session：交易已經在帳上，只補寫 Last_Run_Month
+    monkeypatch.undo()
+    app["invalidate_book_cache"](BOOK_URL)
+    run_recurring(app)
+    assert [r for r in tx.values[1:] if r[8] == "(自動) 房租"] == posted
+    assert book._find("Recurring").values[1][8] == months_ago(0)
+
+
+def test_duplicate_rules_each_post_once(app):
+    existing = app["build_transaction_frame"]({"Date": ["2026-03-05"], "Type": ["支出"], "Main_Category": ["食"], "Sub_Category": ["午餐"],
+                                               "Currency": ["TWD"], "Amount_Original": ["500"], "Note": ["(自動) 房租"]})
+    row = ["2026-03-01", "支出", "食", "午餐", "現金", "TWD", 500.0, None, "(自動) 房租", "", ""]
+    kept = app["drop_posted_recurring"]([list(row), list(row), row[:6] + [600.0] + row[7:]], existing)
+    assert [r[6] for r in kept] == [500.0, 600.0]
@@ -0,0 +1,43 @@
+from datetime import date
+
+from conftest import BOOK_URL, TX_HEADER, add_book, tx_row
+
+
+def notes(result):
+    return list(result["Note"])
+
+
+def test_tokens_cover_words_and_chinese_bigrams(app):
+    assert app["search_tokens"]("ＡＴＭ 提款 7-11") == {"atm", "提", "款", "提款", "7", "11"}
+    assert app["search_query_terms"]("Star 咖啡店") == [("star", True), ("咖啡", False), ("啡店", False)]
+
+
+def test_text_amount_and_facet_filters(app, fake_client):
+    add_book(fake_client, [tx_row("2026-03-01", amount=120, note="Starbucks 咖啡"), tx_row("2026-03-02", amount=60, note="便利商店咖啡"),
+                           tx_row("2026-03-03", sub="晚餐", amount=300, note="拉麵"), tx_row("2026-03-04", main="收入", sub="薪資", amount=5000, note="薪水", type_="收入")])
+    result, total, facets = app["search_transactions"](BOOK_URL, "咖啡")
+    assert total == 2 and notes(result) == ["便利商店咖啡", "Starbucks 咖啡"]
+    assert facets["Main_Category"] == {"食": 2}
+    assert notes(app["search_transactions"](BOOK_URL, "star")[0]) == ["Starbucks 咖啡"]
+    assert notes(app["search_transactions"](BOOK_URL, "", amount_range=(100, 500))[0]) == ["拉麵", "Starbucks 咖啡"]
+    assert notes(app["search_transactions"](BOOK_URL, "", facets={"Type": ["收入"]})[0]) == ["薪水"]
+
+
+def test_new_rows_are_searchable_without_reloading(app, fake_client):
+    add_book(fake_client, [tx_row("2026-03-01", note="早午餐")])
+    assert app["search_transactions"](BOOK_URL, "拉麵")[1] == 0
+    calls = fake_client.recorder.total_calls()
+    app["patch_cached_transactions"](BOOK_URL, [tx_row("2026-03-05", note="拉麵")])
+    result, total, _ = app["search_transactions"](BOOK_URL, "拉麵")
+    assert total == 1 and notes(result) == ["拉麵"]
+    assert fake_client.recorder.total_calls() == calls
+
+
+def test_date_range_only_loads_the_archived_years_it_covers(app, fake_client):
+    add_book(fake_client, [tx_row("2026-02-01", note="房租")],
+             Transactions_2024=[TX_HEADER, tx_row("2024-02-01", note="房租")], Transactions_2025=[TX_HEADER, tx_row("2025-02-01", note="房租")])
+    result, total, _ = app["search_transactions"](BOOK_URL, "房租", date_range=(date(2025, 1, 1), date(2026, 12, 31)))
+    assert total == 2 and [str(d.date()) for d in result["Date"]] == ["2026-02-01", "2025-02-01"]
+    loaded = {ws for src, ws in app["get_book_cache"]()["entries"] if src == BOOK_URL}
+    assert "Transactions_2025" in loaded and "Transactions_2024" not in loaded
+    assert app["search_transactions"](BOOK_URL, "房租")[1] == 3
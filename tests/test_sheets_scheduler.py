@@ -0,0 +1,34 @@
+from conftest import BOOK_URL, TX_HEADER, add_book, tx_row
+
+
+def open_book(app):
+    return app["open_spreadsheet"](app["get_gspread_client"](), BOOK_URL)
+
+
+def test_parallel_sync_workers_keep_the_callers_session(app, fake_client, monkeypatch):
+    add_book(fake_client, [tx_row("2026-01-05")], Transactions_2025=[TX_HEADER, tx_row("2025-03-01")])
+    book = open_book(app)
+    sheets = [book.worksheet("Transactions"), book.worksheet("Transactions_2025")]
+    app["sync_worksheets_values"](BOOK_URL, sheets)
+
+    metrics = app["get_sheets_metrics"](); bucket = app["get_sheets_scheduler"]().buckets["read"]
+    priorities = []
+    acquire = bucket.acquire
+    monkeypatch.setattr(bucket, "acquire", lambda priority: priorities.append(priority) or acquire(priority))
+    metrics.bind_session("s1", "a@b.com")
+    background = metrics.sessions.get("background", {}).get("calls", 0)
+    before = metrics.sessions["s1"]["calls"]
+    result = app["sync_worksheets_values"](BOOK_URL, sheets)
+
+    assert [r[0] for r in result] == ["Transactions", "Transactions_2025"]
+    assert priorities and set(priorities) == {app["PRIORITY_INTERACTIVE_READ"]}
+    assert metrics.sessions["s1"]["calls"] - before == len(priorities)
+    assert metrics.sessions.get("background", {}).get("calls", 0) == background
+
+
+def test_update_cell_counts_one_cell(app, fake_client):
+    add_book(fake_client, [tx_row("2026-01-05")])
+    open_book(app).worksheet("Transactions").update_cell(2, 9, "edited")
+    calls = {(c["book"], c["method"]): c for c in app["get_sheets_metrics"]().snapshot()["calls"]}
+    assert calls[(BOOK_URL, "update_cell")]["cells"] == 1
+    assert fake_client.open_by_url(BOOK_URL)._find("Transactions").values[1][8] == "edited"
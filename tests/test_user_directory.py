@@ -0,0 +1,69 @@
+import threading
+
+from conftest import ADMIN_URL, BOOK_URL
+
+import bench_data_layer as bench
+
+
+def load_directory(app, fake_client, n_users=20):
+    users, bindings = bench.generate_directory(n_users, pwd_hash=app["hash_password"]("pw"))
+    book = fake_client.books[ADMIN_URL]
+    book.worksheet("Users").values = [list(r) for r in users]
+    book.worksheet("Book_Bindings").values = [list(r) for r in bindings]
+    return users
+
+
+def test_lookups_are_served_from_the_index(app, fake_client):
+    users = load_directory(app, fake_client)
+    directory = app["get_user_directory"]()
+    email = users[-1][0]
+    assert directory.get_user(email)["Sheet_Name"] == BOOK_URL
+    fake_client.recorder.reset()
+    assert directory.books_of(email)[0]["Role"] == "Owner"
+    assert directory.owner_of(BOOK_URL)["Email"] == email
+    assert fake_client.recorder.total_calls() == 0
+
+
+def test_failed_logins_force_at_most_one_refresh_per_interval(app, fake_client, monkeypatch):
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(app["time"], "time", lambda: clock["now"])
+    users = load_directory(app, fake_client)
+    app["get_user_directory"]().get_user(users[1][0])
+    clock["now"] += app["USER_DIRECTORY_FORCE_SECONDS"] + 1
+    fake_client.recorder.reset()
+    for _ in range(5):
+        ok, msg = app["handle_user_login"](users[1][0], "wrong")
+        assert not ok and msg == "Password Incorrect"
+    assert fake_client.recorder.calls[("admin", "values_batch_get")] == 1
+
+
+def test_refresh_reads_sheets_without_holding_the_lock(app):
+    directory = None
+    acquired = []
+
+    def loader():
+        t = threading.Thread(target=lambda: acquired.append(directory.lock.acquire(timeout=2) and directory.lock.release() is None))
+        t.start(); t.join()
+        return [bench.USER_HEADER, ["a@test.local", BOOK_URL, "", "", "Active", "", "Pro", "A"]], [bench.BINDING_HEADER]
+    directory = app["UserDirectory"](loader)
+    assert directory.get_user("a@test.local")["Nickname"] == "A"
+    assert acquired == [True]
+
+
+def test_local_update_during_refresh_is_kept(app):
+    directory = None
+
+    def loader():
+        # 讀取期間其他 Session 新增了使用者 (Sheets 已寫入，但這次讀到的是寫入前的資料)
+        directory.add_user({"Email": "new@test.local", "Nickname": "N"})
+        return [bench.USER_HEADER], [bench.BINDING_HEADER]
+    directory = app["UserDirectory"](loader)
+    directory.refresh()
+    assert directory.users_by_email["new@test.local"]["Nickname"] == "N"
+
+
+def test_missing_bindings_sheet_is_created(app, fake_client):
+    book = fake_client.books[ADMIN_URL]
+    book.sheets = [ws for ws in book.sheets if ws.title != "Book_Bindings"]
+    users, bindings = app["_load_user_directory_tables"]()
+    assert bindings == [bench.BINDING_HEADER]
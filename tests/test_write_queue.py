@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+from conftest import BOOK_URL
+
+
+def wait_for(cond, timeout=5):
+    end = time.time() + timeout
+    while not cond() and time.time() < end: time.sleep(0.01)
+    assert cond()
+
+
+def make_queue(app, workdir, writer, **kwargs):
+    path = os.path.join(workdir, ".ledger_data", f"spool_{time.time_ns()}.json")
+    return app["WriteBehindQueue"](path, writer, batch_window=0.05, max_backoff=0.01, **kwargs)
+
+
+def test_rows_are_batched_per_worksheet(app, workdir):
+    sent = []
+    q = make_queue(app, workdir, lambda src, ws, rows: sent.append((src, ws, rows)))
+    for i in range(3): q.enqueue(BOOK_URL, "Transactions", [str(i)])
+    wait_for(lambda: q.pending_count() == 0)
+    assert sent == [(BOOK_URL, "Transactions", [["0"], ["1"], ["2"]])]
+
+
+def test_rows_in_flight_are_not_reported_as_pending(app, workdir):
+    release = threading.Event(); started = threading.Event()
+
+    def writer(src, ws, rows):
+        started.set(); release.wait(5)
+    q = make_queue(app, workdir, writer)
+    q.enqueue(BOOK_URL, "Transactions", ["a"])
+    started.wait(5)
+    assert q.pending_rows(BOOK_URL, "Transactions") == [] and q.pending_count() == 1
+    release.set()
+    wait_for(lambda: q.pending_count() == 0)
+
+
+def test_failing_book_is_dead_lettered_without_blocking_others(app, workdir):
+    sent = []
+
+    def writer(src, ws, rows):
+        if src == "https://gone.local": raise RuntimeError("帳本已刪除")
+        sent.append(rows)
+    q = make_queue(app, workdir, writer, max_attempts=3)
+    q.enqueue("https://gone.local", "Transactions", ["x"])
+    q.enqueue(BOOK_URL, "Transactions", ["y"])
+    wait_for(lambda: q.dead_count() == 1 and q.pending_count() == 0)
+    assert sent == [[["y"]]]
+    dead = q.dead_items("https://gone.local")
+    assert dead[0]["row"] == ["x"] and dead[0]["error"] == "帳本已刪除"
+    errors = app["get_sheets_metrics"]().snapshot()["recent_errors"]
+    assert errors[-1]["method"] == "write_queue:Transactions" and errors[-1]["message"] == "帳本已刪除"
+
+
+def test_dead_rows_can_be_retried(app, workdir):
+    broken = {"on": True}; sent = []
+
+    def writer(src, ws, rows):
+        if broken["on"]: raise RuntimeError("沒有權限")
+        sent.append(rows)
+    q = make_queue(app, workdir, writer, max_attempts=2)
+    q.enqueue(BOOK_URL, "Transactions", ["x"])
+    wait_for(lambda: q.dead_count(BOOK_URL) == 1)
+    broken["on"] = False
+    assert q.retry_dead(BOOK_URL) == 1
+    wait_for(lambda: q.pending_count() == 0)
+    assert sent == [[["x"]]] and q.dead_count() == 0
+
+
+def test_spool_survives_a_restart(app, workdir):
+    path = os.path.join(workdir, ".ledger_data", "restart.json")
+    q = app["WriteBehindQueue"](path, lambda *a: (_ for _ in ()).throw(RuntimeError("offline")), batch_window=0.05, max_backoff=60)
+    q.enqueue(BOOK_URL, "Transactions", ["kept"])
+    sent = []
+    q2 = app["WriteBehindQueue"](path, lambda src, ws, rows: sent.append(rows), batch_window=0.05)
+    wait_for(lambda: sent == [[["kept"]]])
+    assert q2.pending_count() == 0